@@ -2,20 +2,23 @@ from fastapi import (
     File,
     HTTPException,
     Request,
+    Response,
     UploadFile,
     Depends,
     status,
     Query,
     BackgroundTasks,
 )
+from fastapi.responses import StreamingResponse
 from pydantic import ValidationError
-from managers import process_csv_file
+from managers import enqueue_csv_file, process_upload_job
 from mangum import Mangum
 from utils.exceptions import (
     LimitIsNotSet,
     LimitExceeded,
     GroupIsNotFound,
     PreviousProcessNotCompleted,
+    InvalidPageToken,
 )
 from auth.verifier import (
     operator,
@@ -23,14 +26,25 @@ from auth.verifier import (
     operator_or_programmatic_access,
 )
 from central_config import app, api_v1_router
-from utils.db import DBManager
+from utils.db import REPORT_PAGE_SIZE, DBManager
+from utils.export import (
+    CSV_MEDIA_TYPE,
+    accepts_gzip,
+    gzip_chunks,
+    iter_chunks,
+    iter_csv,
+    iter_ndjson,
+    negotiate_export_media_type,
+)
+from utils.jobs import LocalJobQueue, get_job_queue
 from utils.pydant_model import (
     AuthenticatedEntity,
     SearchQuery,
-    StagedRecord,
     GroupedStagedRecords,
     Action,
 )
+from datetime import timezone
+from email.utils import format_datetime
 from uuid import uuid4
 from utils.logger import log
 
@@ -44,24 +58,30 @@ async def create_upload_file(
     file: UploadFile = File(...),
     authenticated_entity: AuthenticatedEntity = Depends(operator),
 ):
-    """This is the endpoint to upload a CSV file and process it.
+    """This is the endpoint to upload a CSV file and queue it for processing.
+    The file is scanned, validated and inserted by the worker, the staged
+    process and the report are available once it is completed.
 
     Args:
         file (UploadFile, optional): The CSV file to be uploaded
 
     Raises:
         HTTPException:
-            status_code: 422 if the CSV file contains invalid records
-            status_code: 200 if all records in the CSV file is successfully processed and inserted into the database
+            status_code: 422 if a previous process is not completed yet
+            status_code: 400 if the file could not be queued
 
     Returns:
-        _type_: _description_
+        dict: The message and the report ID of the upload
     """
     # Generate a unique ID for the CSV file
     report_id = str(uuid4())
     try:
-        content = await file.read()
-        process_csv_file(content, authenticated_entity, report_id)
+        job_queue = get_job_queue()
+        # The spooled upload is streamed to S3, not read in memory
+        enqueue_csv_file(file.file, authenticated_entity, report_id, job_queue)
+        if isinstance(job_queue, LocalJobQueue):
+            # No worker is consuming the local queue, process it after the response
+            background_tasks.add_task(job_queue.process, process_upload_job)
     except PreviousProcessNotCompleted:
         raise HTTPException(
             status_code=422,
@@ -82,24 +102,51 @@ async def create_upload_file(
 async def get_report(
     authenticated_entity: AuthenticatedEntity = Depends(operator),
     report_id: str = Query(..., description="The request ID for the report"),
+    category: str = Query(
+        None, description="Only the invalid records of this category"
+    ),
+    limit: int = Query(
+        None,
+        ge=1,
+        description=(
+            "The maximum number of invalid records per page, "
+            f"{REPORT_PAGE_SIZE} if only the page is given, every record if neither is"
+        ),
+    ),
+    page: int = Query(
+        None, ge=1, description="The page of invalid records to retrieve"
+    ),
 ):
     """This is the endpoint to get the report for the CSV file uploaded.
+    The report is deleted once its last page is retrieved without a category,
+    or once it expires.
 
     Args:
         report_id (str): The request ID for the report
+        category (str): Only the invalid records of this category
+        limit (int): The maximum number of invalid records per page
+        page (int): The page of invalid records to retrieve
 
     Raises:
         HTTPException: status_code: 404 if the report is not found
+        HTTPException: status_code: 422 if the page exceeds the records
 
     Returns:
         report (json) : json format of the report.
     """
-    records_report = DBManager.get_report_then_delete_it_from_db(
-        authenticated_entity, report_id
-    )
-    if not records_report:
+    try:
+        result = DBManager.get_report(
+            authenticated_entity, report_id, category=category, limit=limit, page=page
+        )
+    except LimitExceeded as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not result:
         raise HTTPException(status_code=404, detail={"message": "Report not found"})
-    return {"Report": records_report, "ReportStatus": "Completed"}
+    records_report, has_next_page = result
+    res = {"Report": records_report, "ReportStatus": "Completed"}
+    if has_next_page:
+        res.update({"next_page": (page or 1) + 1})
+    return res
 
 
 @api_v1_router.get("/stage", status_code=status.HTTP_200_OK)
@@ -108,6 +155,10 @@ async def geting_staged_records(
     stagedProcessOnly: str = Query(
         "No", description="Whether to retrieve only the staged process"
     ),
+    limit: int = Query(
+        None, ge=1, description="The maximum number of licences per page"
+    ),
+    page: int = Query(None, ge=1, description="The page of licences to retrieve"),
 ):
     """
     This endpoint has the following functionalities:
@@ -117,11 +168,14 @@ async def geting_staged_records(
     Args:
         authenticated_entity (AuthenticatedEntity): The authenticated entity
         stagedProcessOnly (str): Whether to retrieve only the staged process
+        limit (int): The maximum number of licences per page
+        page (int): The page of licences to retrieve
 
     Raises:
         HTTPException: status_code: 404 if no staged process found
         HTTPException: status_code: 425 if the staging process is not done yet
         HTTPException: status_code: 422 if the value for stagedProcessOnly is invalid
+        HTTPException: status_code: 422 if the page is given without a limit, or exceeds the licences
 
     Returns:
         Process (json): The staged process
@@ -148,36 +202,22 @@ async def geting_staged_records(
         )
         if staged_process_only:
             return {"processes": processes, "status": "Completed"}
-        print("Getting staged process")
-        print(processes)
         process = processes[0]
-        print(process.get("stage_id"))
-        records = DBManager.get_staged_records(
-            authenticated_entity, process.get("stage_id")
+        records, has_next_page = DBManager.get_staged_records(
+            authenticated_entity, process.get("stage_id"), limit=limit, page=page
         )
-        staged_records = []
-        for record in records:
-            staged_records.append(StagedRecord(**record))
-        grouped_records = {}
-
-        for record in staged_records:
-            if record.licence_number not in grouped_records:
-                grouped_records[record.licence_number] = GroupedStagedRecords(
-                    licence_number=record.licence_number,
-                    operator_name=record.operator_name,
-                    registration_numbers=[],
-                )
-            grouped_records[record.licence_number].registration_numbers.append(
-                record.registration_number
-            )
-        values = list(grouped_records.values())
-        return {
-            "records": values,
+        res = {
+            "records": [GroupedStagedRecords(**record) for record in records],
             "status": "Completed",
             "stage_id": process.get("stage_id"),
             "next_step": "Commit or Discard",
         }
+        if has_next_page:
+            res.update({"next_page": (page or 1) + 1})
+        return res
 
+    except (LimitIsNotSet, LimitExceeded) as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         log.error(f"Error: {e}")
         if str(e) == "Staging process is not done yet":
@@ -235,14 +275,14 @@ def get_staged_records_action(
         if action.action == "commit":
             result = DBManager.commit_staged_records(authenticated_entity, stage_id)
             if result:
-                return {"message": "Staged records committed successfully"}
+                return {"message": "Staged records committed successfully", **result}
         # Discard the staged records
         if action.action == "discard":
             result = DBManager.commit_staged_records(
                 authenticated_entity, stage_id, commit=False
             )
             if result:
-                return {"message": "Staged records discarded successfully"}
+                return {"message": "Staged records discarded successfully", **result}
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail={"message": "Staged records not found"},
@@ -285,6 +325,9 @@ async def search_records(
     activeOnly: str = Query(
         "No", description="Whether to retrieve only the active records"
     ),
+    cursor: str = Query(
+        None, description="The token of the next page, given in the NextPage URL"
+    ),
     request: Request = None,
 ):
     """This is the endpoint to search for records in the database.
@@ -299,11 +342,13 @@ async def search_records(
         strictMode (str): Strict mode for search
         page (str): The page number to retrieve
         activeOnly (str): Whether to retrieve only the active records
+        cursor (str): The token of the next page, given in the NextPage URL
 
     Raises:
         HTTPException: status_code: 422 if the search query is invalid
         HTTPException: status_code: 401 if the group is not found
         HTTPException: status_code: 422 if the limit is not set, or the limit is exceeded
+        HTTPException: status_code: 422 if the cursor is invalid
 
 
     Returns:
@@ -311,7 +356,7 @@ async def search_records(
     """
     try:
         search_query = SearchQuery(
-            license_number=licenseNumber,
+            licenseNumber=licenseNumber,
             registrationNumber=registrationNumber,
             operatorName=operatorName,
             routeNumber=routeNumber,
@@ -320,14 +365,17 @@ async def search_records(
             strictMode=strictMode,
             page=page,
             activeOnly=activeOnly,
+            cursor=cursor,
         )
-        records = DBManager.get_records(**search_query.model_dump())
+        records, next_page_token = DBManager.get_records(**search_query.model_dump())
 
         # Get the host and path from the request
         host = request.headers.get("host")
         path = request.url.path
 
-        next_page = DBManager.construct_next_page_url(search_query, host, path)
+        next_page = DBManager.construct_next_page_url(
+            search_query, next_page_token, host, path
+        )
 
         res = {"Results": records}
         if next_page:
@@ -347,6 +395,8 @@ async def search_records(
         raise HTTPException(status_code=422, detail=str(e))
     except LimitExceeded as e:
         raise HTTPException(status_code=422, detail=str(e))
+    except InvalidPageToken as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 def read_root():
@@ -356,19 +406,26 @@ def read_root():
 
 
 @api_v1_router.get("/view-registrations/status", status_code=status.HTTP_200_OK)
-async def view_registrations(authenticated_entity: str = Depends(operator)):
+async def view_registrations(
+    response: Response, authenticated_entity: str = Depends(operator)
+):
     """This is the endpoint to view active records and their status
 
     Raises:
         HTTPException: status_code: 400 if an error occurred while fetching the records
 
     Returns:
-        records (json): The records grouped by licence number and operator and their status
+        records (json): The records grouped by licence number and operator and their status,
+            the Last-Modified header is when the summary was computed
     """
     try:
-        records = DBManager.get_record_required_attention_percentage(
+        records, refreshed_at = DBManager.get_record_required_attention_percentage(
             authenticated_entity
         )
+        if refreshed_at:
+            response.headers["Last-Modified"] = format_datetime(
+                refreshed_at.replace(tzinfo=timezone.utc), usegmt=True
+            )
         return records
     except GroupIsNotFound as e:
         print("GroupIsNotFound", e)
@@ -380,6 +437,7 @@ async def view_registrations(authenticated_entity: str = Depends(operator)):
 
 @api_v1_router.get("/all-records", status_code=status.HTTP_200_OK)
 def get_all_records(
+    request: Request,
     authenticated_entity: str = Depends(operator_or_programmatic_access),
     latestOnly: str = Query(
         "No", description="Whether to retrieve only the latest records"
@@ -389,8 +447,18 @@ def get_all_records(
     ),
 ):
     """This is the endpoint to get all records in the database.
+    Records are streamed as NDJSON or CSV when the Accept header asks for
+    application/x-ndjson or text/csv, gzip compressed when the Accept-Encoding
+    header allows it.
+
+    Behind Mangum and API Gateway the response is buffered whole before it is
+    sent, and is bound by the 6 MB Lambda response payload limit: the
+    streaming only keeps the records out of memory while the body is built,
+    the compressed body is still held. Exports larger than the limit need a
+    presigned S3 object or a response streaming Function URL.
 
     Args:
+        request (Request): The request
         authenticated_entity (str): The authenticated entity
         latestOnly (str): Whether to retrieve only the latest records
         activeOnly (str): Whether to retrieve only the active records
@@ -425,19 +493,36 @@ def get_all_records(
                 "message": "Invalid value for activeOnly, it should be either 'Yes','No', 'True' or 'False'"
             },
         )
+    media_type = negotiate_export_media_type(request.headers.get("accept"))
     try:
-        records = DBManager.get_all_records(
+        if media_type is None:
+            records = DBManager.get_all_records(
+                authenticated_entity,
+                latest_only=user_choice_latest_only,
+                active_only=user_choice_active_only,
+            )
+            return records
+        fieldnames, records = DBManager.stream_all_records(
             authenticated_entity,
             latest_only=user_choice_latest_only,
             active_only=user_choice_active_only,
         )
-        return records
     except Exception as e:
         log.error(f"Error: {e}")
         raise HTTPException(
             status_code=422, detail={"message": "Error occurred while fetching records"}
         )
 
+    if media_type == CSV_MEDIA_TYPE:
+        body = iter_chunks(iter_csv(fieldnames, records))
+    else:
+        body = iter_chunks(iter_ndjson(records))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if accepts_gzip(request.headers.get("accept-encoding")):
+        body = gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
 
 app.include_router(api_v1_router)
 lambda_handler = Mangum(app, lifespan="off")
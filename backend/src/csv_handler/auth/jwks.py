@@ -0,0 +1,153 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from cognitojwt import CognitoJWTException
+from cognitojwt.constants import PUBLIC_KEYS_URL_TEMPLATE
+from cognitojwt.token_utils import (
+    check_expired,
+    get_unverified_claims,
+    get_unverified_headers,
+)
+from jose import jwk
+from jose.utils import base64url_decode
+from utils.logger import log
+
+# Timeout of the JWKS requests, in seconds
+JWKS_REQUEST_TIMEOUT = 5
+
+
+class JWKSCache:
+    """Public keys of a Cognito user pool, fetched once and refreshed when
+    they are older than the TTL or a token is signed with an unknown key
+    """
+
+    def __init__(self, keys_url: str, ttl: float, min_refetch_interval: float):
+        """
+        Args:
+            keys_url (str): URL of the JWKS, or path of a local JWKS file
+            ttl (float): Seconds after which the keys are refreshed
+            min_refetch_interval (float): Minimum seconds between two fetches
+                triggered by unknown keys, so forged key IDs cannot flood Cognito
+        """
+        self.keys_url = keys_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def _fetch(self) -> dict:
+        if self.keys_url.startswith("http"):
+            response = requests.get(self.keys_url, timeout=JWKS_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            jwks = response.json()
+        else:
+            with open(self.keys_url, "r") as f:
+                jwks = json.load(f)
+        return {key["kid"]: jwk.construct(key) for key in jwks.get("keys", [])}
+
+    def _refresh(self):
+        log.debug(f"Fetching the JWKS from {self.keys_url}")
+        self._keys = self._fetch()
+        self._fetched_at = time.monotonic()
+
+    def get_key(self, kid: str):
+        """Get the public key of a key ID
+
+        Args:
+            kid (str): The key ID of the token header
+
+        Raises:
+            CognitoJWTException: If the key is not in the JWKS
+
+        Returns:
+            jose.jwk.Key: The public key
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._fetched_at is None or now - self._fetched_at >= self.ttl:
+                self._refresh()
+            elif (
+                kid not in self._keys
+                and now - self._fetched_at >= self.min_refetch_interval
+            ):
+                # The keys may have been rotated since they were fetched
+                self._refresh()
+            key = self._keys.get(kid)
+        if key is None:
+            raise CognitoJWTException("Public key not found in jwks.json")
+        return key
+
+
+class VerifiedClaimsCache:
+    """LRU of the claims of the tokens already verified, keyed by the hash of
+    the token, an entry expires with its token
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        """Get the claims of a verified token, None if it was not verified or
+        has expired since
+        """
+        key = self._key(token)
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry is None:
+                return None
+            claims, exp = entry
+            if time.time() >= exp:
+                del self._claims[key]
+                return None
+            self._claims.move_to_end(key)
+            return dict(claims)
+
+    def set(self, token: str, claims: dict):
+        """Remember the claims of a verified token until it expires"""
+        key = self._key(token)
+        with self._lock:
+            self._claims[key] = (dict(claims), claims["exp"])
+            self._claims.move_to_end(key)
+            while len(self._claims) > self.maxsize:
+                self._claims.popitem(last=False)
+
+
+def jwks_url(region: str, userpool_id: str) -> str:
+    """URL of the JWKS of a Cognito user pool"""
+    return PUBLIC_KEYS_URL_TEMPLATE.format(region, userpool_id)
+
+
+def decode_token(token: str, jwks_cache: JWKSCache) -> dict:
+    """Verify the signature and expiry of a Cognito token, as cognitojwt.decode
+    does, with the public keys of the JWKS cache
+
+    Args:
+        token (str): The token
+        jwks_cache (JWKSCache): The public keys of the user pool
+
+    Raises:
+        CognitoJWTException: If the token is not signed by a key of the user pool or has expired
+
+    Returns:
+        dict: The claims of the token
+    """
+    message, encoded_signature = str(token).rsplit(".", 1)
+    decoded_signature = base64url_decode(encoded_signature.encode("utf-8"))
+    public_key = jwks_cache.get_key(get_unverified_headers(token)["kid"])
+    if not public_key.verify(message.encode("utf-8"), decoded_signature):
+        raise CognitoJWTException("Signature verification failed")
+
+    claims = get_unverified_claims(token)
+    check_expired(claims["exp"])
+    return claims
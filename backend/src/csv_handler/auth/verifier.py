@@ -1,9 +1,16 @@
-import cognitojwt
-
-from central_config import AWS_REGION, USERPOOL_ID, APP_CLIENT_ID
+from central_config import (
+    AWS_REGION,
+    USERPOOL_ID,
+    APP_CLIENT_ID,
+    COGNITO_JWKS_URL,
+    JWKS_CACHE_TTL,
+    JWKS_MIN_REFETCH_INTERVAL,
+    VERIFIED_TOKEN_CACHE_SIZE,
+)
 from fastapi import Depends, HTTPException, Request, Security, status
 from fastapi.security import HTTPBearer
 from typing import Tuple
+from .jwks import JWKSCache, VerifiedClaimsCache, decode_token, jwks_url
 from utils.exceptions import RegionIsNotSet, UserPoolIdIsNotSet, AppClientIdIsNotSet
 from utils.logger import log
 from utils.pydant_model import AuthenticatedEntity
@@ -27,9 +34,24 @@ class CustomHTTPBearer(HTTPBearer):
             raise
 
 
+# Shared by the requests handled by the container
+_jwks_caches = {}
+_verified_claims = VerifiedClaimsCache(VERIFIED_TOKEN_CACHE_SIZE)
+
+
+def get_jwks_cache(region: str, userpool_id: str) -> JWKSCache:
+    """Get the JWKS cache of the user pool, created on first use"""
+    keys_url = COGNITO_JWKS_URL or jwks_url(region, userpool_id)
+    if keys_url not in _jwks_caches:
+        _jwks_caches[keys_url] = JWKSCache(
+            keys_url, JWKS_CACHE_TTL, JWKS_MIN_REFETCH_INTERVAL
+        )
+    return _jwks_caches[keys_url]
+
+
 class TokenVerifier:
     """
-    Class to verify tokens using Cognito JWT library.
+    Class to verify tokens against the cached public keys of the Cognito user pool.
     """
 
     def __init__(self, token: str):
@@ -59,21 +81,22 @@ class TokenVerifier:
 
     def verify_token(self):
         """
-        Verify the token using Cognito JWT library.
+        Verify the token, the claims of a token already verified are reused
+        until it expires.
 
         Returns:
             bool: True if the token is valid, False otherwise.
         """
         try:
-            self.claims = None
-            self.claims: dict = cognitojwt.decode(
-                self.token,
-                self.REGION,
-                self.USERPOOL_ID,
-                # app_client_id=self.APP_CLIENT_ID,
-            )
+            self.claims = _verified_claims.get(self.token)
+            if self.claims is None:
+                self.claims: dict = decode_token(
+                    self.token, get_jwks_cache(self.REGION, self.USERPOOL_ID)
+                )
+                _verified_claims.set(self.token, self.claims)
             return True
         except Exception:
+            self.claims = None
             return False
 
 
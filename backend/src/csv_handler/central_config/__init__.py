@@ -3,10 +3,23 @@ from .env import (
     AWS_REGION,
     USERPOOL_ID,
     APP_CLIENT_ID,
+    COGNITO_JWKS_URL,
+    JWKS_CACHE_TTL,
+    JWKS_MIN_REFETCH_INTERVAL,
+    VERIFIED_TOKEN_CACHE_SIZE,
     LOGGER_LEVEL,
     LOGGER_MOD,
     OTC_CLIENT_API_URL,
+    OTC_LICENCE_CACHE_TTL,
+    OTC_LICENCE_NEGATIVE_CACHE_TTL,
+    REPORT_TTL,
     BUCKET_NAME,
+    CLAMAV_SCAN_TIMEOUT,
+    CLAMAV_POLL_INITIAL_DELAY,
+    CLAMAV_POLL_MAX_DELAY,
+    CLAMAV_NOTIFICATION_QUEUE_URL,
+    UPLOAD_QUEUE_URL,
+    STAGE_TIMEOUT,
 )
 from .fastapi_conf import app, api_v1_router
 
@@ -17,8 +30,21 @@ __all__ = [
     "AWS_REGION",
     "USERPOOL_ID",
     "APP_CLIENT_ID",
+    "COGNITO_JWKS_URL",
+    "JWKS_CACHE_TTL",
+    "JWKS_MIN_REFETCH_INTERVAL",
+    "VERIFIED_TOKEN_CACHE_SIZE",
     "LOGGER_LEVEL",
     "LOGGER_MOD",
     "OTC_CLIENT_API_URL",
+    "OTC_LICENCE_CACHE_TTL",
+    "OTC_LICENCE_NEGATIVE_CACHE_TTL",
+    "REPORT_TTL",
     "BUCKET_NAME",
+    "CLAMAV_SCAN_TIMEOUT",
+    "CLAMAV_POLL_INITIAL_DELAY",
+    "CLAMAV_POLL_MAX_DELAY",
+    "CLAMAV_NOTIFICATION_QUEUE_URL",
+    "UPLOAD_QUEUE_URL",
+    "STAGE_TIMEOUT",
 ]
@@ -14,5 +14,32 @@ USERPOOL_ID = getenv("COGNITO_USERPOOL_ID", "COGNITO_USERPOOL_ID is not set")
 APP_CLIENT_ID = getenv("COGNITO_APP_CLIENT_ID", "APP_CLIENT_ID is not set")
 BUCKET_NAME = getenv("CLAMAV_S3_BUCKET_NAME", "CLAMAV_S3_BUCKET_NAME is not set")
 
+# COGNITO TOKEN VERIFICATION
+COGNITO_JWKS_URL = getenv("AWS_COGNITO_JWKS_PATH")
+JWKS_CACHE_TTL = float(getenv("JWKS_CACHE_TTL", "3600"))
+JWKS_MIN_REFETCH_INTERVAL = float(getenv("JWKS_MIN_REFETCH_INTERVAL", "30"))
+VERIFIED_TOKEN_CACHE_SIZE = int(getenv("VERIFIED_TOKEN_CACHE_SIZE", "1024"))
+
+# CLAMAV SCAN RESULT WAIT
+CLAMAV_SCAN_TIMEOUT = float(getenv("CLAMAV_SCAN_TIMEOUT", "150"))
+CLAMAV_POLL_INITIAL_DELAY = float(getenv("CLAMAV_POLL_INITIAL_DELAY", "0.5"))
+CLAMAV_POLL_MAX_DELAY = float(getenv("CLAMAV_POLL_MAX_DELAY", "10"))
+CLAMAV_NOTIFICATION_QUEUE_URL = getenv("CLAMAV_NOTIFICATION_QUEUE_URL")
+
+# UPLOAD PROCESSING QUEUE
+UPLOAD_QUEUE_URL = getenv("UPLOAD_QUEUE_URL")
+# Staged process not updated for this long, in seconds, is discarded as its upload job
+# timed out, crashed or was moved to the dead-letter queue. Longer than the worker timeout.
+STAGE_TIMEOUT = float(getenv("STAGE_TIMEOUT", str(60 * 60)))
+
 # OTC CLIENT API
-OTC_CLIENT_API_URL = getenv("OTC_CLIENT_API_URL", "OTC_CLIENT_API_URL is not set")
\ No newline at end of file
+OTC_CLIENT_API_URL = getenv("OTC_CLIENT_API_URL", "OTC_CLIENT_API_URL is not set")
+
+# OTC LICENCE CACHE, in seconds
+OTC_LICENCE_CACHE_TTL = float(getenv("OTC_LICENCE_CACHE_TTL", str(24 * 60 * 60)))
+OTC_LICENCE_NEGATIVE_CACHE_TTL = float(
+    getenv("OTC_LICENCE_NEGATIVE_CACHE_TTL", str(60 * 60))
+)
+
+# UPLOAD REPORTS, in seconds, reports not read to their last page are deleted once older
+REPORT_TTL = float(getenv("REPORT_TTL", str(7 * 24 * 60 * 60)))
\ No newline at end of file
@@ -1,4 +1,4 @@
-from .csv_manager import CSVManager, process_csv_file
+from .csv_manager import CSVManager, enqueue_csv_file, process_upload_job
 
 
-__all__ = ["CSVManager", "process_csv_file"]
+__all__ = ["CSVManager", "enqueue_csv_file", "process_upload_job"]
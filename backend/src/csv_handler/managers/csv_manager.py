@@ -1,190 +1,309 @@
-import csv
-from io import StringIO
-from utils.csv_validator import csv_data_structure_check
+from contextlib import closing
+from itertools import islice
+from utils.csv_stream import iter_csv_rows
+from utils.csv_validator import VALIDATION_BATCH_SIZE, iter_validated_records
 from utils.db import (
+    RegistrationWriter,
+    ReportWriter,
     complete_stage_process,
     initiate_stage_process,
-    send_to_db,
+    restart_stage_process,
+    update_stage_process,
+    report_exists,
     send_report_to_db,
 )
 from utils.validate import validate_licence_number_existence
-from copy import deepcopy
-from utils.pydant_model import AuthenticatedEntity
-from utils.aws import ClamAVClient
+from utils.constants import StageStatus
+from utils.pydant_model import AuthenticatedEntity, UploadJob
+from utils.aws import SCAN_CLEAN, SCAN_INFECTED, ClamAVClient
 from utils.logger import log
 
+STRUCTURE_CHECK_DESCRIPTION = "CSV data structure check"
+OTC_VALIDATION_DESCRIPTION = "Warning - Record failed due to OTC validation"
+ALREADY_EXISTS_DESCRIPTION = "Record already exists"
+OTC_LOOKUP_FAILED_DESCRIPTION = "OTC lookup failed, retry"
+FILE_INFECTED_DESCRIPTION = "File is infected"
+FILE_NOT_PROCESSED_DESCRIPTION = "File could not be processed"
+# Categories of the invalid records, in the order of the report
+REPORT_DESCRIPTIONS = [
+    STRUCTURE_CHECK_DESCRIPTION,
+    OTC_VALIDATION_DESCRIPTION,
+    OTC_LOOKUP_FAILED_DESCRIPTION,
+    ALREADY_EXISTS_DESCRIPTION,
+]
+
 
 class CSVManager:
     def __init__(
         self,
-        csv_data: str,
+        csv_data,
         authenticated_entity: AuthenticatedEntity = None,
         report_id: str = None,
         stage_id: str = None,
+        batch_size: int = VALIDATION_BATCH_SIZE,
     ):
         self.csv_data = csv_data
         self.group_name = authenticated_entity.group
         self.user_name = authenticated_entity.name
         self.report_id = report_id
         self.stage_id = stage_id
+        self.batch_size = batch_size
+        # Row numbers of the valid records, keyed by (licence, variation, registration, route)
+        self._record_keys = {}
+        # Licences of the upload already requested from the OTC API
+        self._licences = {}
 
     def validation_and_insertion_steps(self) -> dict:
-        """This function performs the following steps:
+        """This function reads the CSV data lazily, and performs the following
+        steps on each batch of records:
         1. Validate the CSV data structure.
-        2. Check if the licence numbers exist in the database.
-        3. Send the validated records to the database.
-        4. Remove the licence details from the validated records.
-        5. Add the count of valid records to the validated_records dictionary.
-
-        Returns:
-             Record reports: A dictionary containing the valid and invalid records and the count of valid records.
+        2. Put aside the records duplicating an earlier record of the upload.
+        3. Check if the licence numbers exist in the OTC DB.
+        4. Send the validated records to the database.
+        5. Send the invalid records to the report entries.
+        Then the duplicated records are reported, and removed from the database,
+        and the report with the count of valid and invalid records is sent to
+        the database.
+        Only a batch of records is held in memory at a time.
         """
-        validated_records = self._validate_csv_data()
-        self._check_duplicate_records(validated_records)
-        self._check_licence_number_existence(validated_records)
-        self._send_to_db(
-            validated_records, self.group_name, self.user_name, self.stage_id
-        )
-        self._remove_licence_details(validated_records)
-        # Add the count of valid records to the validated_records dictionary
-        validated_records["valid_records_count"] = len(
-            validated_records["valid_records"]
-        )
-        del validated_records["valid_records"]
+        valid_records_count = 0
+        with self._report_writer() as report, self._registration_writer() as writer:
+            for description in REPORT_DESCRIPTIONS:
+                report.write(description, {})
+            for batch_number, records in enumerate(self._validate_csv_data()):
+                self._check_duplicate_records(records)
+                self._check_licence_number_existence(records)
+                if batch_number == 0:
+                    self._update_stage_status(StageStatus.Inserting)
+                self._send_to_db(records, writer)
+                for invalid_records in records["invalid_records"]:
+                    report.write(
+                        invalid_records["description"], invalid_records["records"]
+                    )
+                valid_records_count += len(records["valid_records"])
+            valid_records_count -= self._report_duplicate_records(report, writer)
 
-        if validated_records["invalid_records"] == {}:
-            del validated_records["invalid_records"]
+            validated_records = {
+                "invalid_records": [
+                    {"count": count, "description": description}
+                    for description, count in report.counts.items()
+                    if count or description == STRUCTURE_CHECK_DESCRIPTION
+                ],
+                "valid_records_count": valid_records_count,
+            }
         # Send the report to the database
         self._send_report_to_db(
             validated_records, self.user_name, self.group_name, self.report_id
         )
 
     def _validate_csv_data(self):
-        return csv_data_structure_check(self.csv_data)
+        """Validate the records lazily, in batches of batch_size records"""
+        validated_records = iter_validated_records(self.csv_data, self.batch_size)
+        while batch := list(islice(validated_records, self.batch_size)):
+            yield {
+                "invalid_records": [
+                    {
+                        "records": {
+                            idx: errors for idx, _, errors in batch if errors is not None
+                        },
+                        "description": STRUCTURE_CHECK_DESCRIPTION,
+                    }
+                ],
+                "valid_records": {
+                    idx: record for idx, record, errors in batch if errors is None
+                },
+            }
 
     def _check_duplicate_records(self, records):
-        records_copy = deepcopy(records)
+        # Records with the same (licence, variation, registration, route) as an
+        # earlier record of the upload are put aside, and reported once the whole
+        # upload is read, by _report_duplicate_records
+        for idx, record in list(records["valid_records"].items()):
+            key = (
+                record.licence_number,
+                record.variation_number,
+                record.registration_number,
+                record.route_number,
+            )
+            record_numbers = self._record_keys.setdefault(key, [])
+            record_numbers.append(idx)
+            if len(record_numbers) > 1:
+                del records["valid_records"][idx]
+
+    def _report_duplicate_records(self, report, writer) -> int:
+        """Report all the records of the duplicated keys, the first record of
+        each key is removed from the database if it was inserted
+
+        Returns:
+            int: The number of records removed from the database
+        """
         duplicated_check_records = {}
-        for idx, record in records_copy["valid_records"].items():
-            duplicated_records = []
-            for idx2, records2 in records_copy["valid_records"].items():
-                if (
-                    idx != idx2
-                    and record.licence_number == records2.licence_number
-                    and record.variation_number == records2.variation_number
-                    and record.registration_number == records2.registration_number
-                    and record.route_number == records2.route_number
-                ):
-                    duplicated_records.append(idx2)
-            if duplicated_records:
-                # if records["invalid_records"].get(idx):
-                #     records["invalid_records"][idx].appand(
-                #         {"CSV contains duplicated records": duplicated_records}
-                #     )
-                # else:
-                # records["invalid_records"]["duplicated_records"][idx] = [
+        first_records = {}
+        for key, record_numbers in self._record_keys.items():
+            if len(record_numbers) < 2:
+                continue
+            for idx in record_numbers:
+                duplicated_records = [idx2 for idx2 in record_numbers if idx2 != idx]
                 duplicated_check_records[idx] = [
                     {"": f"""Duplicate of record {(', ').join(duplicated_records)}"""}
                 ]
-                try:
-                    del records["valid_records"][idx]
-                except KeyError:
-                    pass
-                for i in duplicated_records:
-                    try:
-                        del records["valid_records"][i]
-                    except KeyError:
-                        pass
-        if len(duplicated_check_records) > 0:
-            if records.get("invalid_records") is None:
-                records["invalid_records"] = []
-                validation_description = "CSV data structure check"
-                records["invalid_records"].append(
-                    {
-                        "records": duplicated_check_records,
-                        "description": validation_description,
-                    }
-                )
-            else:
-                data_structure_invalid = records["invalid_records"][0]
-                data_structure_invalid["records"].update(duplicated_check_records)
-                records["invalid_records"][0] = data_structure_invalid
+            first_records[record_numbers[0]] = key
+        if not first_records:
+            return 0
+        # The first records which were not inserted are reported in another category
+        not_inserted = set()
+        for description in (
+            OTC_VALIDATION_DESCRIPTION,
+            OTC_LOOKUP_FAILED_DESCRIPTION,
+            ALREADY_EXISTS_DESCRIPTION,
+        ):
+            not_inserted |= report.remove(description, set(first_records) - not_inserted)
+        inserted_keys = {
+            key for idx, key in first_records.items() if idx not in not_inserted
+        }
+        if inserted_keys:
+            writer.delete(inserted_keys)
+        report.write(
+            STRUCTURE_CHECK_DESCRIPTION,
+            {
+                idx: duplicated_check_records[idx]
+                for idx in sorted(duplicated_check_records, key=int)
+            },
+        )
+        return len(inserted_keys)
 
     def _check_licence_number_existence(self, records):
-        validate_licence_number_existence(records)
-
-    def _send_to_db(self, records, group_name, user_name, staged_id):
-        send_to_db(records, group_name, user_name, staged_id)
-
-    def _remove_licence_details(self, records):
-        """Removing the licence details from validated records."""
-        try:
-            if "valid_records" in records:
-                for idx, record in records["valid_records"].items():
-                    if record and len(record) > 0:
-                        records["valid_records"][idx] = record[0].model_dump(
-                            exclude=["serviceCode"]
-                        )
-                    else:
-                        print(f"Error: Invalid record at index {idx}")
-            else:
-                print("Error: 'valid_records' key not found in records")
-        except Exception as e:
-            print(f"Error: {e}")
-        return records
+        validate_licence_number_existence(records, self._licences)
+
+    def _update_stage_status(self, stage_status):
+        if self.stage_id is not None:
+            update_stage_process(self.stage_id, stage_status)
+
+    def _registration_writer(self):
+        return RegistrationWriter(self.group_name, self.user_name, self.stage_id)
+
+    def _report_writer(self):
+        return ReportWriter(self.report_id)
+
+    def _send_to_db(self, records, writer):
+        already_exists_records = writer.write(records["valid_records"])
+        # Remove records from the valid_records dictionary that were not added to the database
+        for idx in already_exists_records:
+            del records["valid_records"][idx]
+        if len(already_exists_records) > 0:
+            records["invalid_records"].append(
+                {
+                    "records": already_exists_records,
+                    "description": ALREADY_EXISTS_DESCRIPTION,
+                }
+            )
 
     def _send_report_to_db(self, records_report, user_name, group_name, report_id):
         send_report_to_db(records_report, user_name, group_name, report_id)
 
 
-def process_csv_file(content, authenticated_entity, report_id):
-    scan_result = False
-    # try:
+def enqueue_csv_file(content, authenticated_entity, report_id, job_queue):
+    """Stage the upload and queue it for the worker. The file is uploaded to the
+    scanned bucket, which starts the scan while the job waits in the queue.
+
+    Args:
+        content (bytes | BinaryIO): The content of the uploaded file
+        authenticated_entity (AuthenticatedEntity): The authenticated entity
+        report_id (str): The ID of the report of the upload
+        job_queue (SQSJobQueue | LocalJobQueue): The queue of the upload jobs
+
+    Raises:
+        PreviousProcessNotCompleted: If the user has a staged process already
+
+    Returns:
+        UploadJob: The queued job
+    """
     stage_id = initiate_stage_process(
         authenticated_entity.name, authenticated_entity.group, report_id
     )
-    # except Exception as e:
-    #     log.info(f"exception: {e}")
-    #     return
-    # Decode the CSV data
-    csv_str = None
-    for encoding_types in ["utf-8-sig", "utf-8", "Latin-1", "ISO-8859-1"]:
-        try:
-            csv_str = content.decode(encoding_types)
-            break
-        except:
-            pass
-    if csv_str is None:
-        raise Exception("File encoding not found")
+    try:
+        ClamAVClient(report_id, content).upload()
+        job = UploadJob(
+            report_id=report_id,
+            stage_id=stage_id,
+            user_name=authenticated_entity.name,
+            group_name=authenticated_entity.group,
+        )
+        job_queue.send(job)
+    except Exception:
+        complete_stage_process(stage_id)
+        raise
+    return job
+
+
+def process_upload_job(job: UploadJob):
+    """Scan, validate and insert the records of a queued upload. The file is
+    streamed from the scanned bucket, and deleted once processed. The stage
+    status follows the steps, and is completed whatever the outcome.
 
+    A job which times out or crashes is redelivered by the queue: the
+    registrations inserted by the earlier attempt are discarded before it
+    starts again. A redelivered job whose report was already sent is
+    skipped, as its file is deleted, and a job whose stage was discarded as
+    stale is reported as a file which could not be processed.
+
+    Args:
+        job (UploadJob): The queued job
+    """
+    if report_exists(job.report_id):
+        log.warning(f"Upload job {job.report_id} is already processed, skipping.")
+        return
+    authenticated_entity = AuthenticatedEntity(
+        type="user", name=job.user_name, group=job.group_name
+    )
+    clamav_client = None
+    stage_discarded = False
     try:
-        scan_result = ClamAVClient(report_id, content).scan()
+        clamav_client = ClamAVClient(job.report_id)
+        if not restart_stage_process(job.stage_id):
+            stage_discarded = True
+            log.warning(f"Upload job {job.report_id} has no staged process, skipping.")
+            send_invalid_file_report(job, FILE_NOT_PROCESSED_DESCRIPTION)
+            return
+        scan_status = clamav_client.scan_status(delete=False)
+        if scan_status == SCAN_CLEAN:
+            process_scanned_file(clamav_client, authenticated_entity, job)
+        elif scan_status == SCAN_INFECTED:
+            send_invalid_file_report(job, FILE_INFECTED_DESCRIPTION)
+        else:
+            log.error(f"error: no scan result for file {job.report_id}")
+            send_invalid_file_report(job, FILE_NOT_PROCESSED_DESCRIPTION)
+    except Exception as e:
+        log.error(f"error: {e}")
+        send_invalid_file_report(job, FILE_NOT_PROCESSED_DESCRIPTION)
+    finally:
+        if clamav_client is not None:
+            try:
+                clamav_client.delete()
+            except Exception as e:
+                log.error(f"error: {e}")
+        if not stage_discarded:
+            complete_stage_process(job.stage_id)
 
-        if scan_result:
-            # Convert the CSV data into a dictionary
-            csv_data = list(csv.DictReader(StringIO(csv_str)))
+
+def process_scanned_file(clamav_client, authenticated_entity, job: UploadJob):
+    try:
+        update_stage_process(job.stage_id, StageStatus.Validating)
+        with closing(clamav_client.open()) as stream:
+            # The rows are decoded, parsed and validated while the file is read
             csv_handler = CSVManager(
-                csv_data, authenticated_entity, report_id, stage_id
+                iter_csv_rows(stream), authenticated_entity, job.report_id, job.stage_id
             )
-            # Validate the CSV input data
             csv_handler.validation_and_insertion_steps()
-        else:
-            print("scan failed")
-            send_report_to_db(
-                {"invalid_file": [{"description": "File is infected"}]},
-                authenticated_entity.name,
-                authenticated_entity.group,
-                report_id,
-            )
-            complete_stage_process(stage_id)
-
     except Exception as e:
         log.error(f"error: {e}")
-        print("scan failed")
-        send_report_to_db(
-            {"invalid_file": [{"description": "File is infected"}]},
-            authenticated_entity.name,
-            authenticated_entity.group,
-            report_id,
-        )
-        complete_stage_process(stage_id)
+        send_invalid_file_report(job, FILE_NOT_PROCESSED_DESCRIPTION)
+
+
+def send_invalid_file_report(job: UploadJob, description: str):
+    send_report_to_db(
+        {"invalid_file": [{"description": description}]},
+        job.user_name,
+        job.group_name,
+        job.report_id,
+    )
@@ -1,25 +1,23 @@
-from typing import List
+from typing import Iterable
 import requests
 from .logger import log
 import json
 from central_config import OTC_CLIENT_API_URL
 
 
-def verify_otc_api(licence_numbers: List):
+def verify_otc_api(licence_numbers: Iterable[str]):
     """
     This function sends a list of licence numbers to the OTC api.
 
     Args:
-        licence_numbers (List): A list of licence numbers.
+        licence_numbers (Iterable[str]): The licence numbers.
 
     Returns:
         [dict]: For eact found licence, with a licence details.
     """
     try:
-        licence_numbers_list = set()
+        licence_numbers_list = set(licence_numbers)
         log.info("Sending list to OTC API")
-        for key, registration in licence_numbers.items():
-            licence_numbers_list.add(registration.licence_number)
 
         if OTC_CLIENT_API_URL != "OTC_API_URL is not set":
             url = OTC_CLIENT_API_URL
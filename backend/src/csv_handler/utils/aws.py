@@ -1,9 +1,40 @@
 import boto3
-from central_config import AWS_REGION, BUCKET_NAME, PROJECT_ENV
+import json
+from central_config import (
+    AWS_REGION,
+    BUCKET_NAME,
+    PROJECT_ENV,
+    CLAMAV_SCAN_TIMEOUT,
+    CLAMAV_POLL_INITIAL_DELAY,
+    CLAMAV_POLL_MAX_DELAY,
+    CLAMAV_NOTIFICATION_QUEUE_URL,
+)
 from os import getenv
-from time import sleep
+from time import monotonic, sleep
 from .logger import log
 
+_boto_clients = {}
+
+# Values of the av-status tag set by the scanner
+SCAN_CLEAN = "clean"
+SCAN_INFECTED = "infected"
+
+
+def get_boto_client(service_name: str):
+    """Get the boto3 client of a service, created once per container
+
+    Args:
+        service_name (str): The name of the AWS service
+
+    Returns:
+        client: The boto3 client
+    """
+    client = _boto_clients.get(service_name)
+    if client is None:
+        client = boto3.client(service_name=service_name, region_name=AWS_REGION)
+        _boto_clients[service_name] = client
+    return client
+
 
 def upload_file_to_S3(
     file_path, bucket, bucket_path, local_file_name, file_name_in_s3
@@ -37,66 +68,191 @@ def upload_file_to_S3(
         log.error(f"Errors: {e}")
 
 
+class BackoffWait:
+    """Poll the tags of the uploaded file with an exponential backoff,
+    until the scan result is found or the deadline is reached.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = CLAMAV_POLL_INITIAL_DELAY,
+        max_delay: float = CLAMAV_POLL_MAX_DELAY,
+        timeout: float = CLAMAV_SCAN_TIMEOUT,
+        multiplier: float = 2,
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.multiplier = multiplier
+
+    def wait(self, clamav_client, bucket_name, s3_folder, file_name):
+        """Wait for the scan result of a file
+
+        Args:
+            clamav_client (ClamAVClient): The client used to read the tags
+            bucket_name (str): The name of the S3 bucket
+            s3_folder (str): The folder in the S3 bucket
+            file_name (str): The name of the file
+
+        Returns:
+            list: The tags of the file, None if the deadline is reached
+        """
+        deadline = monotonic() + self.timeout
+        delay = self.initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            tags = clamav_client.read_file_tags(bucket_name, s3_folder, file_name)
+            if tags is not None:
+                log.info(f"Getting tags is done, after {attempt} attempts.")
+                return tags
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                log.warning(
+                    f"No scan result for file {file_name} after {attempt} attempts."
+                )
+                return None
+            sleep(min(delay, remaining))
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+def notification_object_key(body: str) -> str | None:
+    """Get the S3 key of the file of a scanner notification
+
+    Args:
+        body (str): The body of the SQS message, the notification {"key": ...}
+            or the SNS envelope {"Message": <notification>}
+
+    Returns:
+        str: The key of the file, None if the message is not a notification
+    """
+    try:
+        notification = json.loads(body)
+        if isinstance(notification, dict) and "Message" in notification:
+            notification = json.loads(notification["Message"])
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(notification, dict):
+        return None
+    return notification.get("key")
+
+
+class NotificationWait:
+    """Wait for the completion notification of the scanner on an SQS queue
+    (directly or through an SNS subscription), then read the tags of the file.
+    Notifications of other files are left to the queue, they are received again
+    once their visibility timeout expires.
+    """
+
+    def __init__(self, queue_url: str, timeout: float = CLAMAV_SCAN_TIMEOUT):
+        self.queue_url = queue_url
+        self.timeout = timeout
+
+    def wait(self, clamav_client, bucket_name, s3_folder, file_name):
+        """Wait for the scan result of a file
+
+        Args:
+            clamav_client (ClamAVClient): The client used to read the tags
+            bucket_name (str): The name of the S3 bucket
+            s3_folder (str): The folder in the S3 bucket
+            file_name (str): The name of the file
+
+        Returns:
+            list: The tags of the file, None if the deadline is reached
+        """
+        client = get_boto_client("sqs")
+        object_key = clamav_client.object_key(s3_folder, file_name)
+        deadline = monotonic() + self.timeout
+        while (remaining := deadline - monotonic()) > 0:
+            response = client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=max(1, min(20, int(remaining))),
+            )
+            for message in response.get("Messages", []):
+                # Other notifications are not released, they would be received
+                # again at once, in a loop counting towards the maxReceiveCount
+                if notification_object_key(message["Body"]) != object_key:
+                    continue
+                client.delete_message(
+                    QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"]
+                )
+                log.info(f"Received scan notification for file {object_key}.")
+                return clamav_client.read_file_tags(bucket_name, s3_folder, file_name)
+        log.warning(f"No scan notification for file {object_key}, reading tags.")
+        return clamav_client.read_file_tags(bucket_name, s3_folder, file_name)
+
+
+def default_wait_strategy():
+    """Wait on the scanner notifications when a queue is configured, otherwise poll"""
+    if CLAMAV_NOTIFICATION_QUEUE_URL:
+        return NotificationWait(CLAMAV_NOTIFICATION_QUEUE_URL)
+    return BackoffWait()
+
+
 class ClamAVClient:
-    def __init__(self, file_name, data):
+    def __init__(self, file_name, data=None, wait_strategy=None):
         if not BUCKET_NAME:
             raise Exception("Bucket name is not set.")
         self.bucket_name = BUCKET_NAME
         self.s3_folder = PROJECT_ENV if PROJECT_ENV != "local" else "dev"
         self.file_name = file_name
         self.data = data
+        self.wait_strategy = wait_strategy or default_wait_strategy()
+
+    def upload(self):
+        """Upload the file to the scanned bucket, which starts the scan"""
+        self.upload_bstring_to_s3_as_file(
+            self.bucket_name, self.s3_folder, self.file_name, self.data
+        )
 
-    def scan(self):
-        """Initiate the scan process
+    def open(self):
+        """Open the uploaded file of the scanned bucket as a stream
 
         Returns:
-            Boolean: True if the file is clean, False otherwise
+            StreamingBody: The binary stream of the file
         """
-        res = self.scan_file(
-            self.bucket_name, self.s3_folder, self.file_name, self.data
+        return self.read_file_from_s3(self.bucket_name, self.s3_folder, self.file_name)
+
+    def delete(self):
+        """Delete the uploaded file from the scanned bucket"""
+        self.delete_file_from_s3(self.bucket_name, self.s3_folder, self.file_name)
+
+    def scan_status(self, delete=True):
+        """Wait for the scan status of the uploaded file, the errors of the
+        scanner or of S3 are raised
+
+        Args:
+            delete (bool): Whether to delete the file once scanned
+
+        Returns:
+            str: The av-status tag of the file, SCAN_CLEAN or SCAN_INFECTED,
+                None if the file was not scanned in time
+        """
+        return self.wait_for_scan_status(
+            self.bucket_name, self.s3_folder, self.file_name, delete
         )
-        return res
 
-    def scan_file(self, bucket_name, s3_folder, file_name, data):
-        result = False
-        """This function does the following:
-        - Uploads a file to S3 via upload_bstring_to_s3_as_file function
-        - Waits for the file to be scanned via added tags
-        - Checks the scan status
-        - Gets the scan result
-        - Deletes the file from S3
+    def wait_for_scan_status(self, bucket_name, s3_folder, file_name, delete=True):
+        """Wait for the file to be scanned, and delete it unless delete is False
 
         Args:
             bucket_name (str): The name of the S3 bucket
             s3_folder (str): The folder in the S3 bucket
             file_name (str): The name of the file
-            data (bytes): The file data
+            delete (bool): Whether to delete the file once scanned
 
         Returns:
-            Boolean: True if the file is clean, False otherwise
+            str: The av-status tag of the file, None if it was not scanned in time
         """
-        try:
-            self.upload_bstring_to_s3_as_file(bucket_name, s3_folder, file_name, data)
-            print(f"File {file_name} is uploaded to S3 bucket {bucket_name}.")
-            for i in range(1, 11):
-                sleep(15)
-                res = self.read_file_tags(bucket_name, s3_folder, file_name)
-                if res is not None:
-                    log.info(f"Getting tags is done, after {i} attempts.")
-                    self.delete_file_from_s3(bucket_name, s3_folder, file_name)
-                    log.info(f"File {file_name} is deleted from S3 bucket.")
-                    break
-                print(f"Attempt {i} to get tags is not successful.")
-            av_status = [item["Value"] for item in res if item["Key"] == "av-status"]
-            if len(av_status) > 0:
-                if av_status[0] == "clean":
-                    result = True
-
-        except Exception as e:
-            log.error(f"Errors: {e}")
-
-        finally:
-            return result
+        res = self.wait_strategy.wait(self, bucket_name, s3_folder, file_name)
+        if res is None:
+            return None
+        if delete:
+            self.delete_file_from_s3(bucket_name, s3_folder, file_name)
+            log.info(f"File {file_name} is deleted from S3 bucket.")
+        av_status = [item["Value"] for item in res if item["Key"] == "av-status"]
+        return av_status[0] if av_status else None
 
     def get_boto_client(self):
         """Get the boto3 client
@@ -104,10 +260,11 @@ class ClamAVClient:
         Returns:
             client: The boto3 client
         """
-        return boto3.client(
-            service_name="s3",
-            region_name=AWS_REGION,
-        )
+        return get_boto_client("s3")
+
+    def object_key(self, s3_folder, file_name):
+        """Get the key of the uploaded file in the S3 bucket"""
+        return f"{s3_folder}/{file_name}.csv"
 
     def upload_bstring_to_s3_as_file(
         self, bucket_name, s3_folder, file_name, binary_data
@@ -127,7 +284,7 @@ class ClamAVClient:
             client = self.get_boto_client()
 
             # Specify the bucket name and the key (including another filename)
-            object_key = f"{s3_folder}/{file_name}.csv"
+            object_key = self.object_key(s3_folder, file_name)
 
             # # Upload the binary data
             client.put_object(Body=binary_data, Bucket=bucket_name, Key=object_key)
@@ -153,7 +310,7 @@ class ClamAVClient:
             # Initialize the S3 client
             client = self.get_boto_client()
             # Get the object tagging
-            object_key = f"{s3_folder}/{file_name}.csv"
+            object_key = self.object_key(s3_folder, file_name)
             print(f"Reading tags for file {object_key}.")
             response = client.get_object_tagging(Bucket=bucket_name, Key=object_key)
 
@@ -166,6 +323,29 @@ class ClamAVClient:
             print(f"Errors: {e}")
             raise Exception("Errors: Could not read file tags from S3.")
 
+    def read_file_from_s3(self, bucket_name, s3_folder, file_name):
+        """Read a file from S3, without loading it in memory
+
+        Args:
+            bucket_name (str): The name of the S3 bucket
+            s3_folder (str): The folder in the S3 bucket
+            file_name (str): The name of the file
+
+        Raises:
+            Exception: If the file could not be read
+
+        Returns:
+            StreamingBody: The binary stream of the file
+        """
+        try:
+            client = self.get_boto_client()
+            object_key = self.object_key(s3_folder, file_name)
+            response = client.get_object(Bucket=bucket_name, Key=object_key)
+            return response["Body"]
+        except Exception as e:
+            print(f"Errors: {e}")
+            raise Exception("Errors: Could not read file from S3.")
+
     def delete_file_from_s3(self, bucket_name, s3_folder, file_name):
         """Delete a file from S3
 
@@ -181,7 +361,7 @@ class ClamAVClient:
             # Initialize the S3 client
             client = self.get_boto_client()
             # Delete the object
-            object_key = f"{s3_folder}/{file_name}.csv"
+            object_key = self.object_key(s3_folder, file_name)
             client.delete_object(Bucket=bucket_name, Key=object_key)
         except Exception as e:
             print(f"Errors: {e}")
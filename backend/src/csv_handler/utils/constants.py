@@ -20,3 +20,11 @@ ACTIVE_APPLICATION_TYPES = [
     ServiceType.Change.value,
     ServiceType.Variation.value,
 ]
+
+
+class StageStatus(Enum):
+    Queued = "queued"
+    Scanning = "scanning"
+    Validating = "validating"
+    Inserting = "inserting"
+    Completed = "completed"
@@ -0,0 +1,81 @@
+import codecs
+import csv
+import io
+from typing import Iterator
+
+# Size of the beginning of the file the encoding is detected on
+ENCODING_DETECTION_PREFIX_SIZE = 64 * 1024
+FALLBACK_ENCODING = "latin-1"
+
+
+def _latin_1_fallback(error: UnicodeDecodeError):
+    # Bytes which are not valid in the detected encoding are decoded as Latin-1,
+    # as the whole file would be if it had been detected on them
+    return error.object[error.start : error.end].decode(FALLBACK_ENCODING), error.end
+
+
+codecs.register_error("latin-1-fallback", _latin_1_fallback)
+
+
+class _PrefixedStream(io.RawIOBase):
+    """Binary stream replaying the already read prefix before the rest of the stream"""
+
+    def __init__(self, prefix: bytes, stream):
+        self._prefix = memoryview(prefix)
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._prefix:
+            size = min(len(buffer), len(self._prefix))
+            buffer[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        data = self._stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def detect_encoding(prefix: bytes, final: bool = False) -> str:
+    """Detect the encoding of a file from its beginning
+
+    Args:
+        prefix (bytes): The beginning of the file
+        final (bool): Whether the prefix is the whole file
+
+    Returns:
+        str: utf-8-sig if the prefix is valid UTF-8 (with or without BOM), Latin-1 otherwise
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    try:
+        # Unless it is the whole file, the prefix may end in the middle of a
+        # character, which is left buffered
+        decoder.decode(prefix, final=final)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
+def iter_csv_rows(stream) -> Iterator[dict]:
+    """Decode and parse a CSV file incrementally, only a buffer of the file
+    is held in memory at a time
+
+    Args:
+        stream: Binary file-like object of the CSV file, e.g. a S3 StreamingBody
+
+    Returns:
+        Iterator[dict]: The rows of the file, keyed by the header
+    """
+    prefix = stream.read(ENCODING_DETECTION_PREFIX_SIZE)
+    encoding = detect_encoding(
+        prefix, final=len(prefix) < ENCODING_DETECTION_PREFIX_SIZE
+    )
+    text = io.TextIOWrapper(
+        io.BufferedReader(_PrefixedStream(prefix, stream)),
+        encoding=encoding,
+        errors="latin-1-fallback",
+        newline="",
+    )
+    yield from csv.DictReader(text)
@@ -1,47 +1,115 @@
-from pydantic import ValidationError
+from collections import defaultdict
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+from pydantic import TypeAdapter, ValidationError
 
 from .logger import log
 from .pydant_model import Registration
 
 
-def csv_data_structure_check(csv_data: [dict]) -> dict:
+# Number of records validated by a single call of the model validator, and
+# validated and inserted at a time by CSVManager
+VALIDATION_BATCH_SIZE = 1000
+
+_registrations_adapter = TypeAdapter(List[Registration])
+
+
+def validate_registration_batch(rows: List[dict]) -> Tuple[dict, dict]:
+    """Validate a batch of records with a single call of the model validator.
+    If any record is invalid, the errors are split by record and the valid
+    records are validated again.
+
+    Args:
+        rows (List[dict]): The records
+
+    Returns:
+        Tuple[dict, dict]: The Registration of the valid records and the errors
+            of the invalid records, as extract_field_mgs_type_from_errors returns
+            them, keyed by the position of the record in the batch
     """
-    This function checks the structure of the CSV data structure and returns a dictionary of valid and invalid records.
-    It checks if a record adheres to the structure of the Registration model.
-    Functionalities:
-    1. Validate each record and deserialize it into a Python object.
-    2. Invalid records are stored in a validation_errors list along with the record number.
-    3. Valid records are stored in a pydantic_models list.
-    4. Returns a dictionary of valid and invalid records.
+    try:
+        return dict(enumerate(_registrations_adapter.validate_python(rows))), {}
+    except ValidationError as e:
+        errors = e.errors()
+    except Exception as e:
+        # A validator failed with an unexpected error, the records are validated one by one
+        log.error(f"Error: {e}")
+        return validate_registrations(rows)
+
+    record_errors = defaultdict(list)
+    for error in errors:
+        position, *loc = error["loc"]
+        record_errors[position].append({**error, "loc": tuple(loc)})
+    valid_positions = [
+        position for position in range(len(rows)) if position not in record_errors
+    ]
+    invalid_records = {
+        position: extract_field_mgs_type_from_errors(position_errors)
+        for position, position_errors in record_errors.items()
+    }
+    valid_records, revalidated_errors = validate_registration_batch(
+        [rows[position] for position in valid_positions]
+    )
+    for position, position_errors in revalidated_errors.items():
+        invalid_records[valid_positions[position]] = position_errors
+    return (
+        {
+            valid_positions[position]: record
+            for position, record in valid_records.items()
+        },
+        invalid_records,
+    )
+
+
+def validate_registrations(rows: List[dict]) -> Tuple[dict, dict]:
+    """Validate the records one by one, the records failing with an unexpected
+    error are left out of both the valid and invalid records
+
+    Args:
+        rows (List[dict]): The records
+
+    Returns:
+        Tuple[dict, dict]: The Registration of the valid records and the errors
+            of the invalid records, keyed by the position of the record in the batch
     """
-    # Convert the CSV data into a list of dictionaries
-    # csv_data = list(csv.DictReader(file))
     valid_records = {}
-    validation_errors = {}
-
-    for idx, data_dict in enumerate(csv_data):
+    invalid_records = {}
+    for position, data_dict in enumerate(rows):
         try:
             # Validate each record and deserialize it into a Python object.
-            pydantic_model = Registration(**data_dict)
-            valid_records.update(
-                {f"{idx + 2}": pydantic_model}
-            )  # .model_dump(exclude=["serviceCode"])
+            valid_records[position] = Registration(**data_dict)
         except ValidationError as e:
-            # Get json schema errors
-            errors = e.errors()
             # Extract the field, message and type from the errors of a ValidationError object.
-            modified_errors = extract_field_mgs_type_from_errors(errors)
-            validation_errors.update({f"{idx + 2}": modified_errors})
+            invalid_records[position] = extract_field_mgs_type_from_errors(e.errors())
         except Exception as e:
             log.error(f"Error: {e}")
+    return valid_records, invalid_records
 
-    validation_description = "CSV data structure check"
-    return {
-        "invalid_records": [
-            {"records": validation_errors, "description": validation_description}
-        ],
-        "valid_records": valid_records,
-    }
+
+def iter_validated_records(
+    csv_data: Iterable[dict], batch_size: int = VALIDATION_BATCH_SIZE
+) -> Iterator[tuple]:
+    """Validate the records lazily, a batch of records at a time.
+
+    Args:
+        csv_data (Iterable[dict]): The records, e.g. the rows of a CSV reader
+        batch_size (int): The number of records validated at a time
+
+    Returns:
+        Iterator[tuple]: (record number, Registration, None) for a valid record,
+            (record number, None, errors) for an invalid one
+    """
+    rows = iter(csv_data)
+    offset = 0
+    while batch := list(islice(rows, batch_size)):
+        valid_records, invalid_records = validate_registration_batch(batch)
+        for position in range(len(batch)):
+            idx = f"{offset + position + 2}"
+            if position in valid_records:
+                yield idx, valid_records[position], None
+            elif position in invalid_records:
+                yield idx, None, invalid_records[position]
+        offset += len(batch)
 
 
 def extract_field_mgs_type_from_errors(errors: [dict]) -> dict:
@@ -1,26 +1,61 @@
+import base64
 import boto3
+import json
+import threading
 import urllib.parse
-from datetime import date
+from datetime import date, datetime, timedelta, timezone
 from os import getenv
-from sqlalchemy import create_engine, func, select, Table, case, desc, or_, and_
+from time import monotonic
+from sqlalchemy import (
+    create_engine,
+    event,
+    func,
+    select,
+    Table,
+    case,
+    desc,
+    insert,
+    or_,
+    and_,
+    tuple_,
+    literal,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import Session, Query
-from typing import List
+from sqlalchemy.orm import Session, Query, sessionmaker
+from typing import Iterator, List, Tuple
 from .csv_validator import Registration
 from .logger import log
 from .pydant_model import AuthenticatedEntity, DBCreds, SearchQuery
 from .exceptions import (
-    RecordIsAlreadyExist,
     LimitExceeded,
     LimitIsNotSet,
     GroupIsNotFound,
-    RecordBelongsToAnotherUser,
     StagingProcessInProgress,
     NoStagedProcess,
     PreviousProcessNotCompleted,
+    InvalidPageToken,
 )
-from central_config.env import AWS_REGION, PROJECT_ENV
-from utils.constants import ACTIVE_APPLICATION_TYPES
+from central_config.env import AWS_REGION, PROJECT_ENV, REPORT_TTL, STAGE_TIMEOUT
+from utils.constants import ACTIVE_APPLICATION_TYPES, StageStatus
+
+# RDS IAM auth tokens are valid for 15 minutes, rebuild the engine slightly before
+RDS_IAM_TOKEN_TTL_SECONDS = 14 * 60
+
+# Number of keys sent in a single IN (...) lookup
+BULK_LOOKUP_CHUNK_SIZE = 1000
+
+# Number of records fetched at a time by the exports
+EXPORT_BATCH_SIZE = 1000
+
+# Errors of the records of an upload already in the database
+ALREADY_EXISTS_ERRORS = [{"Duplicated Record": "Record already exists in the database"}]
+
+# Number of report entries inserted or deleted by a single statement
+REPORT_ENTRY_CHUNK_SIZE = 1000
+# Number of invalid records of a report page when a page is given without a
+# limit, and of the entries read at a time when the whole report is read
+REPORT_PAGE_SIZE = 1000
 
 
 class CreateEngine:
@@ -144,40 +179,11 @@ class CreateEngine:
         return engine
 
 
-def add_or_get_record(column_name: str, value: str, session: Session, Model, record):
-    """
-    Add a new record to the table if it doesn't exist, or get the id of the existing record.
-
-    Returns:
-        int: ID of the record
-    """
-    try:
-        stmt = select(Model).where(getattr(Model, column_name) == value)
-        if not session.query(stmt.exists()).scalar():
-            new_record = record
-            session.add(new_record)
-            session.flush()
-            log.debug(f"New added record id: {new_record.id}, to table: {Model}")
-            session.commit()
-            return new_record.id
-        else:
-            existing_record = (
-                session.query(Model)
-                .filter(getattr(Model, column_name) == value)
-                .first()
-            )
-            return existing_record.id
-    except Exception as e:
-        log.error(f"Error: {e}")
-        session.rollback()
-        return None
-
-
 class AutoMappingModels:
     """Automap the database tables to the sqlalchemy models"""
 
-    def __init__(self):
-        self.engine = CreateEngine.get_engine()
+    def __init__(self, engine=None):
+        self.engine = engine or CreateEngine.get_engine()
         self.Base = automap_base()
         self.Base.prepare(autoload_with=self.engine)
         self.PDBRDRegistration = self.Base.classes.pdbrd_registration
@@ -186,8 +192,13 @@ class AutoMappingModels:
         self.BODSDataCatalogue = self.Base.classes.bods_data_catalogue
         self.PDBRDGroup = self.Base.classes.pdbrd_group
         self.PDBRDReport = self.Base.classes.pdbrd_report
+        self.PDBRDReportEntry = self.Base.classes.pdbrd_report_entry
         self.PDBRDStage = self.Base.classes.pdbrd_stage
         self.PDBRDUser = self.Base.classes.pdbrd_user
+        self.PDBRDLicenceStatusSummary = (
+            self.Base.classes.pdbrd_licence_status_summary
+        )
+        self.OTCLicenceCache = self.Base.classes.otc_licence_cache
         self.OTCLicence.__repr__ = (
             lambda self: f"<OTCLicence(licence_number='{self.licence_number}', licence_status='{self.licence_status}')>"
         )
@@ -220,9 +231,12 @@ class AutoMappingModels:
             "OTCLicence": self.OTCLicence,
             "PDBRDGroup": self.PDBRDGroup,
             "PDBRDReport": self.PDBRDReport,
+            "PDBRDReportEntry": self.PDBRDReportEntry,
             "BODSDataCatalogue": self.BODSDataCatalogue,
             "PDBRDStage": self.PDBRDStage,
             "PDBRDUser": self.PDBRDUser,
+            "PDBRDLicenceStatusSummary": self.PDBRDLicenceStatusSummary,
+            "OTCLicenceCache": self.OTCLicenceCache,
         }
 
 
@@ -234,10 +248,173 @@ def add_filter_to_query(query: Query, column, value, strict_mode: bool = False):
     return query.filter(column.like(f"%{value}%"))
 
 
+def latest_variation_query(query: Query, PDBRDRegistration) -> Query:
+    """Keep the latest variation of each registration route among the records
+    of the query, ranked with a window function so the records are not joined
+    back to the registrations. The query must select the registration number
+    and route number as registrationNumber and routeNumber.
+
+    Args:
+        query (Query): The query of the records
+        PDBRDRegistration: The mapped registration model
+
+    Returns:
+        Query: The latest records, ordered by registration number and route number
+    """
+    variation_rank = (
+        func.row_number()
+        .over(
+            partition_by=(
+                PDBRDRegistration.registration_number,
+                PDBRDRegistration.route_number,
+            ),
+            order_by=(desc(PDBRDRegistration.variation_number), PDBRDRegistration.id),
+        )
+        .label("variation_rank")
+    )
+    ranked = query.add_columns(variation_rank).subquery()
+    columns = [column for column in ranked.c if column.name != "variation_rank"]
+    return (
+        query.session.query(*columns)
+        .filter(ranked.c.variation_rank == 1)
+        .order_by(
+            func.coalesce(ranked.c.registrationNumber, ""),
+            func.coalesce(ranked.c.routeNumber, ""),
+        )
+    )
+
+
+def registration_key_columns(PDBRDRegistration) -> tuple:
+    """Columns of the unique key of the registrations of a group"""
+    return (
+        PDBRDRegistration.otc_licence_id,
+        PDBRDRegistration.registration_number,
+        PDBRDRegistration.variation_number,
+        PDBRDRegistration.route_number,
+    )
+
+
+def encode_page_token(last_key: list) -> str:
+    """Encode the sort key of the last record of a page as an opaque token"""
+    token = base64.urlsafe_b64encode(json.dumps(last_key).encode())
+    return token.decode().rstrip("=")
+
+
+def decode_page_token(token: str, key_length: int) -> list:
+    """Decode a token encoded by encode_page_token
+
+    Raises:
+        InvalidPageToken: If the token is not the key of a record of this search
+    """
+    try:
+        padding = "=" * (-len(token) % 4)
+        last_key = json.loads(base64.urlsafe_b64decode(token + padding))
+    except ValueError:
+        raise InvalidPageToken("Invalid page token")
+    if not isinstance(last_key, list) or len(last_key) != key_length:
+        raise InvalidPageToken("Invalid page token")
+    return last_key
+
+
+class ModelsRegistry:
+    """Process-wide registry of the engine, automapped models and sessionmaker.
+
+    Lambda containers are reused between invocations, so the engine and the
+    reflected schema are built once, on first use, and shared by every request
+    handled by the container. The engine is rebuilt when the RDS IAM token used
+    to open its connections is about to expire, or after the pool reports a
+    disconnect. The reflected models are kept across engine rebuilds.
+    """
+
+    _lock = threading.Lock()
+    _models: AutoMappingModels = None
+    _session_factory: sessionmaker = None
+    _expires_at: float = None
+    _stale: bool = False
+
+    @classmethod
+    def get_models(cls) -> AutoMappingModels:
+        """Get the shared models, building or refreshing them when required
+
+        Returns:
+            AutoMappingModels: Automapped models bound to the current engine
+        """
+        if cls._models is None or cls._needs_new_engine():
+            with cls._lock:
+                if cls._models is None:
+                    cls._build()
+                elif cls._needs_new_engine():
+                    cls._replace_engine()
+        return cls._models
+
+    @classmethod
+    def get_session(cls) -> Session:
+        """Get a new session from the shared sessionmaker
+
+        Returns:
+            Session: Database session
+        """
+        cls.get_models()
+        return cls._session_factory()
+
+    @classmethod
+    def invalidate(cls):
+        """Flag the engine to be rebuilt on the next access"""
+        cls._stale = True
+
+    @classmethod
+    def reset(cls):
+        """Drop the engine and models, the next access rebuilds everything"""
+        with cls._lock:
+            if cls._models is not None:
+                cls._models.engine.dispose()
+            cls._models = None
+            cls._session_factory = None
+            cls._expires_at = None
+            cls._stale = False
+
+    @classmethod
+    def _needs_new_engine(cls) -> bool:
+        if cls._stale:
+            return True
+        return cls._expires_at is not None and monotonic() >= cls._expires_at
+
+    @classmethod
+    def _new_engine(cls):
+        engine = CreateEngine.get_engine()
+        event.listen(engine, "handle_error", cls._on_engine_error)
+        cls._expires_at = (
+            monotonic() + RDS_IAM_TOKEN_TTL_SECONDS if PROJECT_ENV != "local" else None
+        )
+        cls._stale = False
+        return engine
+
+    @classmethod
+    def _build(cls):
+        log.debug("Building the database engine and automapped models")
+        models = AutoMappingModels(cls._new_engine())
+        cls._session_factory = sessionmaker(bind=models.engine)
+        cls._models = models
+
+    @classmethod
+    def _replace_engine(cls):
+        log.debug("Replacing the database engine")
+        old_engine = cls._models.engine
+        engine = cls._new_engine()
+        cls._models.engine = engine
+        cls._session_factory = sessionmaker(bind=engine)
+        old_engine.dispose()
+
+    @classmethod
+    def _on_engine_error(cls, context):
+        if context.is_disconnect:
+            log.warning("Database connection lost, the engine will be rebuilt")
+            cls.invalidate()
+
+
 def initiate_db_variables():
-    models = AutoMappingModels()
-    engine = models.engine
-    session = Session(engine)
+    models = ModelsRegistry.get_models()
+    session = ModelsRegistry.get_session()
     return models, session
 
 
@@ -344,117 +521,117 @@ class DBGroup:
 
 class DBManager:
     @classmethod
-    def fetch_operator_record(
-        cls, operator_name: str, session: Session, OTCOperator, operator_record
-    ):
-        """Fetch the operator record from the database
+    def upsert_operator_records(
+        cls, operator_names: set, session: Session, OTCOperator: Table
+    ) -> dict:
+        """Insert the missing operators in a single statement
 
         Args:
-            operator_name (str): Operator name
+            operator_names (set): Distinct operator names of the upload
             session (Session): Database session
             OTCOperator (Table): Operator table
-            operator_record (Record): Operator record
 
         Returns:
-            int: ID of the operator record
+            dict: ID of each operator keyed by the operator name
         """
-        operator_record_id = add_or_get_record(
-            "operator_name", operator_name, session, OTCOperator, operator_record
+        if not operator_names:
+            return {}
+        stmt = pg_insert(OTCOperator).values(
+            [{"operator_name": name} for name in sorted(operator_names)]
         )
-        return operator_record_id
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["operator_name"],
+            set_={"operator_name": stmt.excluded.operator_name},
+        ).returning(OTCOperator.id, OTCOperator.operator_name)
+        return {name: record_id for record_id, name in session.execute(stmt)}
 
     @classmethod
-    def fetch_licence_record(
-        cls, licence_number: str, session: Session, OTCLicence, licence_record
-    ):
-        """Fetch the licence record from the database
+    def upsert_licence_records(
+        cls, licences: dict, session: Session, OTCLicence: Table
+    ) -> dict:
+        """Insert the missing licences in a single statement, the status of
+        licences already in the database is left unchanged
 
         Args:
-            licence_number (str): Licence number
+            licences (dict): Licence status keyed by the licence number
             session (Session): Database session
             OTCLicence (Table): Licence table
-            licence_record (Record): Licence record
 
         Returns:
-            int: ID of the licence record
+            dict: ID of each licence keyed by the licence number
         """
-
-        licence_record_id = add_or_get_record(
-            "licence_number", licence_number, session, OTCLicence, licence_record
+        if not licences:
+            return {}
+        stmt = pg_insert(OTCLicence).values(
+            [
+                {"licence_number": number, "licence_status": licences[number]}
+                for number in sorted(licences)
+            ]
         )
-        return licence_record_id
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["licence_number"],
+            set_={"licence_number": stmt.excluded.licence_number},
+        ).returning(OTCLicence.id, OTCLicence.licence_number)
+        return {number: record_id for record_id, number in session.execute(stmt)}
 
     @classmethod
-    def upsert_record_to_pdbrd_registration_table(
-        cls,
-        record: Registration,
-        operator_record_id: int,
-        licence_record_id: int,
-        session: Session,
-        PDBRDRegistration: Table,
-        group_id: int,
-        PDBRDStage_id: int,
-    ):
-        """Add or update the record to the PDBRDRegistration table
+    def fetch_existing_registration_keys(
+        cls, keys: set, group_id: int, session: Session, PDBRDRegistration: Table
+    ) -> set:
+        """Get which of the given registrations are already in the database
 
         Args:
-            record (Registration):
-            operator_record_id (int):
-            licence_record_id (int):
-            session (Session):
-            PDBRDRegistration (Table): Target table
+            keys (set): (otc_licence_id, registration_number, variation_number,
+                route_number) of the registrations to check, the unique key of
+                the registrations of a group
+            group_id (int): Group the registrations belong to
+            session (Session): Database session
+            PDBRDRegistration (Table): Registration table
 
-        Raises:
-            RecordIsAlreadyExist: If the record already exists in the database
+        Returns:
+            set: The keys found in the database
         """
-        # Add or update the record to the PDBRDRegistration table
-        # case 1: Record already exists in the database
-        existing_record = (
-            session.query(PDBRDRegistration)
-            .filter(
-                PDBRDRegistration.registration_number == record.registration_number,
-                PDBRDRegistration.otc_operator_id == operator_record_id,
-                PDBRDRegistration.variation_number == record.variation_number,
-                PDBRDRegistration.group_id == group_id,
-                PDBRDRegistration.route_number == record.route_number,
+        key_columns = registration_key_columns(PDBRDRegistration)
+        keys = list(keys)
+        existing_keys = set()
+        for start in range(0, len(keys), BULK_LOOKUP_CHUNK_SIZE):
+            chunk = keys[start : start + BULK_LOOKUP_CHUNK_SIZE]
+            existing = (
+                session.query(*key_columns)
+                .filter(PDBRDRegistration.group_id == group_id)
+                .filter(tuple_(*key_columns).in_(chunk))
             )
-            .one_or_none()
-        )
+            existing_keys.update(tuple(row) for row in existing)
+        return existing_keys
 
-        if existing_record:
-            raise RecordIsAlreadyExist("Record already exists with the same fields")
+    @classmethod
+    def insert_registration_records(
+        cls, registrations: List[dict], session: Session, PDBRDRegistration: Table
+    ) -> set:
+        """Insert the registrations with multi-row INSERT statements, the
+        registrations conflicting with a registration of the database, e.g.
+        inserted by a concurrent upload, are skipped
 
-        else:
-            # case 2: Record does not exist, create a new record
-            pdbrd_registration_record = PDBRDRegistration(
-                route_number=record.route_number,
-                route_description=record.route_description,
-                variation_number=record.variation_number,
-                start_point=record.start_point,
-                finish_point=record.finish_point,
-                via=record.via,
-                subsidised=record.subsidised,
-                subsidy_detail=record.subsidy_detail,
-                is_short_notice=record.is_short_notice,
-                received_date=record.received_date,
-                granted_date=record.granted_date,
-                effective_date=record.effective_date,
-                end_date=record.end_date,
-                bus_service_type_id=record.bus_service_type_id,
-                bus_service_type_description=record.bus_service_type_description,
-                registration_number=record.registration_number,
-                traffic_area_id=record.traffic_area_id,
-                application_type=record.application_type,
-                publication_text=record.publication_text,
-                other_details=record.other_details,
-                otc_operator_id=operator_record_id,
-                otc_licence_id=licence_record_id,
-                group_id=group_id,
-                pdbrd_stage_id=PDBRDStage_id,
-            )
-            session.add(pdbrd_registration_record)
-            session.commit()
-            log.debug(f"New PDBRD registration record: {pdbrd_registration_record.id}")
+        Args:
+            registrations (List[dict]): Column values of each registration
+            session (Session): Database session
+            PDBRDRegistration (Table): Target table
+
+        Returns:
+            set: The (otc_licence_id, registration_number, variation_number,
+                route_number) of the inserted registrations
+        """
+        if not registrations:
+            return set()
+        inserted = session.execute(
+            pg_insert(PDBRDRegistration)
+            .on_conflict_do_nothing()
+            .returning(*registration_key_columns(PDBRDRegistration)),
+            registrations,
+        )
+        inserted_keys = {tuple(row) for row in inserted}
+        log.debug(f"New PDBRD registration records: {len(inserted_keys)}")
+        return inserted_keys
 
     @classmethod
     def get_records(
@@ -468,8 +645,11 @@ class DBManager:
         page: int | None = None,
         strict_mode: bool = False,
         active_only: bool = False,
-    ) -> List[dict]:
-        """Get records from the database based on the search query
+        cursor: str | None = None,
+    ) -> Tuple[List[dict], str | None]:
+        """Get records from the database based on the search query. The records
+        are ordered by registration number, route number and variation number,
+        and paged from the cursor of the previous page, or by page number.
 
         Args:
             exclude_variations (bool, optional): Defaults to False.
@@ -480,160 +660,181 @@ class DBManager:
             limit (int | None, optional): Defaults to None.
             page (int | None, optional): Defaults to None.
             strict_mode (bool, optional): Defaults to False.
+            active_only (bool, optional): Defaults to False.
+            cursor (str | None, optional): Token of the page, from the previous page. Defaults to None.
 
         Raises:
             LimitIsNotSet: If the limit is not set when the page is provided
             LimitExceeded: If the page number exceeds the total number of records
+            InvalidPageToken: If the cursor is not a token of this search
 
         Returns:
-            [dict]: List of records each as a dictionary
+            ([dict], str): List of records each as a dictionary, and the cursor
+                of the next page, None on the last page
         """
         models, session = initiate_db_variables()
-        PDBRDRegistration = models.PDBRDRegistration
-        OTCOperator = models.OTCOperator
-        OTCLicence = models.OTCLicence
-        # PDBRDGroup = None
-        records = (
-            session.query(
-                PDBRDRegistration.variation_number.label("variationNumber"),
-                PDBRDRegistration.registration_number.label("registrationNumber"),
-                OTCOperator.operator_name.label("operatorName"),
-                OTCLicence.licence_number.label("licenceNumber"),
-                OTCLicence.licence_status.label("licenceStatus"),
-                PDBRDRegistration.route_number.label("routeNumber"),
-                PDBRDRegistration.start_point.label("startPoint"),
-                PDBRDRegistration.finish_point.label("finishPoint"),
-                PDBRDRegistration.via.label("via"),
-                PDBRDRegistration.subsidised.label("subsidised"),
-                PDBRDRegistration.subsidy_detail.label("subsidyDetail"),
-                PDBRDRegistration.is_short_notice.label("isShortNotice"),
-                PDBRDRegistration.received_date.label("receivedDate"),
-                PDBRDRegistration.granted_date.label("grantedDate"),
-                PDBRDRegistration.effective_date.label("effectiveDate"),
-                PDBRDRegistration.end_date.label("endDate"),
-                PDBRDRegistration.bus_service_type_id.label("busServiceTypeId"),
-                PDBRDRegistration.bus_service_type_description.label(
-                    "busServiceTypeDescription"
-                ),
-                PDBRDRegistration.traffic_area_id.label("trafficAreaId"),
-                PDBRDRegistration.application_type.label("applicationType"),
-                PDBRDRegistration.publication_text.label("publicationText"),
-            )
-            .join(OTCOperator, PDBRDRegistration.otc_operator_id == OTCOperator.id)
-            .join(OTCLicence, PDBRDRegistration.otc_licence_id == OTCLicence.id)
-        )
-
-        if exclude_variations:
-            subquery = records.subquery()
+        try:
+            PDBRDRegistration = models.PDBRDRegistration
+            OTCOperator = models.OTCOperator
+            OTCLicence = models.OTCLicence
+            # PDBRDGroup = None
             records = (
-                session.query(subquery)
-                .join(
-                    PDBRDRegistration,
-                    and_(
-                        subquery.c.registrationNumber == PDBRDRegistration.registration_number,
-                        subquery.c.routeNumber == PDBRDRegistration.route_number,
-                        subquery.c.variationNumber == PDBRDRegistration.variation_number,
-                    )
-                )
-                .distinct(
-                    PDBRDRegistration.registration_number,
-                    PDBRDRegistration.route_number,
-                )
-                .order_by(
-                    PDBRDRegistration.registration_number,
-                    PDBRDRegistration.route_number,
-                    desc(PDBRDRegistration.variation_number),
+                session.query(
+                    PDBRDRegistration.variation_number.label("variationNumber"),
+                    PDBRDRegistration.registration_number.label("registrationNumber"),
+                    OTCOperator.operator_name.label("operatorName"),
+                    OTCLicence.licence_number.label("licenceNumber"),
+                    OTCLicence.licence_status.label("licenceStatus"),
+                    PDBRDRegistration.route_number.label("routeNumber"),
+                    PDBRDRegistration.start_point.label("startPoint"),
+                    PDBRDRegistration.finish_point.label("finishPoint"),
+                    PDBRDRegistration.via.label("via"),
+                    PDBRDRegistration.subsidised.label("subsidised"),
+                    PDBRDRegistration.subsidy_detail.label("subsidyDetail"),
+                    PDBRDRegistration.is_short_notice.label("isShortNotice"),
+                    PDBRDRegistration.received_date.label("receivedDate"),
+                    PDBRDRegistration.granted_date.label("grantedDate"),
+                    PDBRDRegistration.effective_date.label("effectiveDate"),
+                    PDBRDRegistration.end_date.label("endDate"),
+                    PDBRDRegistration.bus_service_type_id.label("busServiceTypeId"),
+                    PDBRDRegistration.bus_service_type_description.label(
+                        "busServiceTypeDescription"
+                    ),
+                    PDBRDRegistration.traffic_area_id.label("trafficAreaId"),
+                    PDBRDRegistration.application_type.label("applicationType"),
+                    PDBRDRegistration.publication_text.label("publicationText"),
+                    PDBRDRegistration.id.label("id"),
                 )
+                .join(OTCOperator, PDBRDRegistration.otc_operator_id == OTCOperator.id)
+                .join(OTCLicence, PDBRDRegistration.otc_licence_id == OTCLicence.id)
             )
 
-        if license_number:
-            records = add_filter_to_query(
-                records, OTCLicence.licence_number, license_number, strict_mode
-            )
-
-        if registration_number:
-            if len(registration_number.split("/")) > 2:
-                registration_list = [
-                    f"{registration_number.split('/')[0]}/{item}"
-                    for item in registration_number.split("/")[1:]
-                    if item != ""
-                ]
-                records = records.filter(
-                    PDBRDRegistration.registration_number.in_(registration_list)
+            if license_number:
+                records = add_filter_to_query(
+                    records, OTCLicence.licence_number, license_number, strict_mode
                 )
-            else:
+
+            if registration_number:
+                if len(registration_number.split("/")) > 2:
+                    registration_list = [
+                        f"{registration_number.split('/')[0]}/{item}"
+                        for item in registration_number.split("/")[1:]
+                        if item != ""
+                    ]
+                    records = records.filter(
+                        PDBRDRegistration.registration_number.in_(registration_list)
+                    )
+                else:
+                    records = add_filter_to_query(
+                        records,
+                        PDBRDRegistration.registration_number,
+                        registration_number,
+                        strict_mode,
+                    )
+
+            if operator_name:
                 records = add_filter_to_query(
-                    records,
-                    PDBRDRegistration.registration_number,
-                    registration_number,
-                    strict_mode,
+                    records, OTCOperator.operator_name, operator_name, strict_mode
                 )
 
-        if operator_name:
-            records = add_filter_to_query(
-                records, OTCOperator.operator_name, operator_name, strict_mode
-            )
+            if route_number:
+                records = add_filter_to_query(
+                    records, PDBRDRegistration.route_number, route_number, strict_mode
+                )
+            if active_only:
+                records = records.filter(
+                    and_(
+                        PDBRDRegistration.application_type.in_(
+                            ACTIVE_APPLICATION_TYPES
+                        ),
+                        PDBRDRegistration.effective_date <= func.current_date(),
+                        or_(
+                            PDBRDRegistration.end_date > func.current_date(),
+                            PDBRDRegistration.end_date == None,
+                        ),
+                    )
+                )
 
-        if route_number:
-            records = add_filter_to_query(
-                records, PDBRDRegistration.route_number, route_number, strict_mode
+            # A NULL key would drop out of the cursor comparison, the keys are
+            # compared and ordered as the empty string or variation -1 instead
+            key_columns = (
+                func.coalesce(PDBRDRegistration.registration_number, ""),
+                func.coalesce(PDBRDRegistration.route_number, ""),
             )
-        if active_only:
-            records = records.filter(
-                and_(
-                    PDBRDRegistration.application_type.in_(
-                        ACTIVE_APPLICATION_TYPES
-                    ),
-                    PDBRDRegistration.effective_date <= func.current_date(),
-                    or_(
-                        PDBRDRegistration.end_date > func.current_date(),
-                        PDBRDRegistration.end_date == None,
-                    ),
+            if not exclude_variations:
+                key_columns += (
+                    func.coalesce(PDBRDRegistration.variation_number, -1),
+                    PDBRDRegistration.id,
                 )
-            )
 
-        if page:
-            cls.record_count = records.count()
-            if limit is None:
-                raise LimitIsNotSet("Limit must be provided when page is provided")
-            offset = (page - 1) * limit
-            if offset < records.count():
-                records = records.offset(offset)
+            if cursor:
+                # The routes of the previous pages are skipped before ranking
+                # their variations, all the variations of a route are on one side
+                last_key = decode_page_token(cursor, len(key_columns))
+                records = records.filter(tuple_(*key_columns) > tuple_(*last_key))
+
+            if exclude_variations:
+                records = latest_variation_query(records, PDBRDRegistration)
             else:
-                raise LimitExceeded("Page number exceeds the total number of records")
+                records = records.order_by(*key_columns)
 
-        if limit:
-            records = records.limit(limit)
+            if page and not cursor:
+                if limit is None:
+                    raise LimitIsNotSet("Limit must be provided when page is provided")
+                records = records.offset((page - 1) * limit)
 
+            if limit:
+                # One more record tells whether there is a next page, without counting
+                records = records.limit(limit + 1)
 
-        return [rec._asdict() for rec in records.all()]
+            rows = records.all()
+        finally:
+            session.close()
+        if page and not cursor and not rows:
+            raise LimitExceeded("Page number exceeds the total number of records")
+
+        next_page_token = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            last_row = rows[-1]
+            next_page_token = encode_page_token(
+                [
+                    last_row.registrationNumber or "",
+                    last_row.routeNumber or "",
+                    -1 if last_row.variationNumber is None else last_row.variationNumber,
+                    last_row.id,
+                ][: len(key_columns)]
+            )
+        results = [rec._asdict() for rec in rows]
+        for result in results:
+            del result["id"]
+        return results, next_page_token
 
     @classmethod
     def construct_next_page_url(
-        cls, search_query: SearchQuery, host: str, path: str
+        cls,
+        search_query: SearchQuery,
+        next_page_token: str | None,
+        host: str,
+        path: str,
     ) -> str:
         """Construct the next page url
         Args:
             search_query (SearchQuery): Search query object from the request
+            next_page_token (str | None): Cursor of the next page
             host (str): Host
             path (str): Path
 
         Returns:
            NextPage (str) : URL for the next page
         """
-        if search_query.page is None:
-            return
-        if search_query.limit is None:
+        if next_page_token is None:
             return
-        if cls.record_count is None:
-            return
-        # Calculate the next page
-        search_query.page += 1
-        if search_query.page * search_query.limit > cls.record_count:
-            return
-        search_params = search_query.model_dump(exclude_none=True, by_alias=True)
-        params_str = "&".join([f"{k}={v}" for k, v in search_params.items()])
-        return f"{host}{path}?{params_str}"
+        search_params = search_query.model_dump(
+            exclude_none=True, by_alias=True, exclude={"page", "cursor"}
+        )
+        search_params["cursor"] = next_page_token
+        return f"{host}{path}?{urllib.parse.urlencode(search_params)}"
 
     @classmethod
     def get_all_records(
@@ -650,9 +851,58 @@ class DBManager:
             active_only (bool, optional):  Defaults to True.
 
         Returns:
-            _type_: _description_
+            List[dict]: The records
+        """
+        _, records = cls.stream_all_records(
+            authenticated_entity, latest_only=latest_only, active_only=active_only
+        )
+        return list(records)
+
+    @classmethod
+    def stream_all_records(
+        cls,
+        authenticated_entity: AuthenticatedEntity,
+        latest_only=False,
+        active_only=True,
+        batch_size: int = EXPORT_BATCH_SIZE,
+    ) -> Tuple[List[str], Iterator[dict]]:
+        """Get all the records from the database, fetched batch by batch
+        through a server side cursor as they are consumed
+
+        Args:
+            authenticated_entity (AuthenticatedEntity)
+            latest_only (bool, optional):  Defaults to False.
+            active_only (bool, optional):  Defaults to True.
+            batch_size (int, optional): Number of records fetched at a time
+
+        Raises:
+            GroupIsNotFound
+
+        Returns:
+            Tuple[List[str], Iterator[dict]]: The names of the fields, and the
+                records. The session is closed once the records are consumed.
         """
         models, session = initiate_db_variables()
+        try:
+            records = cls._all_records_query(
+                session, models, authenticated_entity, latest_only, active_only
+            )
+        except Exception:
+            session.close()
+            raise
+        fieldnames = [column["name"] for column in records.column_descriptions]
+        return fieldnames, iter_query_records(session, records, batch_size)
+
+    @classmethod
+    def _all_records_query(
+        cls,
+        session: Session,
+        models,
+        authenticated_entity: AuthenticatedEntity,
+        latest_only: bool,
+        active_only: bool,
+    ) -> Query:
+        """Build the query of the records exported by get_all_records"""
         PDBRDRegistration = models.PDBRDRegistration
         OTCOperator = models.OTCOperator
         OTCLicence = models.OTCLicence
@@ -715,255 +965,289 @@ class DBManager:
                     ),
                 )
             )
-            
-        if latest_only:
-            subquery = records.subquery()
-            records = (
-                session.query(subquery)
-                .join(
-                    PDBRDRegistration,
-                    and_(
-                        subquery.c.registrationNumber == PDBRDRegistration.registration_number,
-                        subquery.c.routeNumber == PDBRDRegistration.route_number,
-                        subquery.c.variationNumber == PDBRDRegistration.variation_number,
-                    )
-                )
-                .distinct(
-                    PDBRDRegistration.registration_number,
-                    PDBRDRegistration.route_number,
-                )
-                .order_by(
-                    PDBRDRegistration.registration_number,
-                    PDBRDRegistration.route_number,
-                    desc(PDBRDRegistration.variation_number),
-                )
-            )
-        
 
         if PDBRDGroup:
             records = records.filter(PDBRDRegistration.group_id == PDBRDGroup.id)
 
-   
+        if latest_only:
+            records = latest_variation_query(records, PDBRDRegistration)
 
-        return [rec._asdict() for rec in records.all()]
+        return records
 
     @classmethod
     def get_record_required_attention_percentage(
-        cls, authenticated_entity: AuthenticatedEntity = None, active_only=True
-    ):
-        models, session = initiate_db_variables()
-        PDBRDRegistration = models.PDBRDRegistration
-        OTCOperator = models.OTCOperator
-        OTCLicence = models.OTCLicence
-        BODSDataCatalogue = models.BODSDataCatalogue
-        if authenticated_entity.type == "user":
-            PDBRDGroup = DBGroup(models, session).get_group(
-                authenticated_entity.group, raise_exception=True
-            )
-        else:
-            PDBRDGroup = None
-        subquery_q1 = (
-            session.query(
-                PDBRDRegistration.registration_number,
-                PDBRDRegistration.route_number,
-                func.max(PDBRDRegistration.variation_number).label(
-                    "max_variation_number"
-                ),
-            )
-            .filter(PDBRDRegistration.pdbrd_stage_id.is_(None))
-            .group_by(
-                PDBRDRegistration.registration_number, PDBRDRegistration.route_number
-            )
-            .subquery()
-        )
-        subquery_q2 = (
-            session.query(PDBRDRegistration.id).join(
-                subquery_q1,
-                and_(
-                    PDBRDRegistration.registration_number
-                    == subquery_q1.c.registration_number,
-                    PDBRDRegistration.variation_number
-                    == subquery_q1.c.max_variation_number,
-                    PDBRDRegistration.route_number == subquery_q1.c.route_number,
-                ),
-            )
-        ).subquery()
+        cls, authenticated_entity: AuthenticatedEntity = None
+    ) -> Tuple[List[dict], datetime]:
+        """Get the active registrations of the group of the user summarised
+        by licence, refreshing the summary first when it is stale
+
+        The summary is recomputed on the write paths which only change the
+        group: the commit of its staged records. The writes which change the
+        summaries of other groups (the data catalogue refresh, WECA ingestion,
+        commits of registrations of the same services) only invalidate them,
+        and the summaries expire every day as registrations become active or
+        end, so a stale summary is recomputed here, with the group locked.
 
-        subquery_q3 = (
-            session.query(
-                func.count(PDBRDRegistration.registration_number).label("count"),
-                OTCLicence.licence_number,
-                BODSDataCatalogue.requires_attention,
-                OTCOperator.operator_name,
-                OTCLicence.licence_status,
+        Args:
+            authenticated_entity (AuthenticatedEntity): Authenticated entity
+
+        Raises:
+            GroupIsNotFound
+
+        Returns:
+            Tuple[List[dict], datetime]: The summary of each licence, and when
+                the summary was computed
+        """
+        models, session = initiate_db_variables()
+        PDBRDGroup = models.PDBRDGroup
+        PDBRDLicenceStatusSummary = models.PDBRDLicenceStatusSummary
+        try:
+            if authenticated_entity.type != "user":
+                raise GroupIsNotFound("Only users belong to a group")
+            group_id = (
+                DBGroup(models, session)
+                .get_group(authenticated_entity.group, raise_exception=True)
+                .id
             )
-            .join(OTCLicence, OTCLicence.id == PDBRDRegistration.otc_licence_id)
-            .outerjoin(
-                BODSDataCatalogue,
-                PDBRDRegistration.registration_number
-                == BODSDataCatalogue.xml_service_code,
+            if licence_status_summary_is_stale(session, models, group_id):
+                refresh_licence_status_summary(session, models, group_id)
+                session.commit()
+
+            refreshed_at = (
+                session.query(PDBRDGroup.licence_status_refreshed_at)
+                .filter(PDBRDGroup.id == group_id)
+                .scalar()
             )
-            .join(OTCOperator, OTCOperator.id == PDBRDRegistration.otc_operator_id)
-            .filter(PDBRDRegistration.group_id == PDBRDGroup.id)
-            .filter(PDBRDRegistration.id.in_(select(subquery_q2)))
-            .filter(PDBRDRegistration.application_type.in_(ACTIVE_APPLICATION_TYPES))
-            .filter(PDBRDRegistration.effective_date <= func.current_date())
-            .filter(
-                or_(
-                    PDBRDRegistration.end_date > func.current_date(),
-                    PDBRDRegistration.end_date == None,
+            query = (
+                session.query(
+                    PDBRDLicenceStatusSummary.licence_number,
+                    PDBRDLicenceStatusSummary.operator_name,
+                    PDBRDLicenceStatusSummary.licence_status,
+                    PDBRDLicenceStatusSummary.requires_attention,
+                    PDBRDLicenceStatusSummary.total_services,
+                    PDBRDLicenceStatusSummary.registrations_not_in_bods.label(
+                        "Registrations_not_in_BODS"
+                    ),
                 )
+                .filter(PDBRDLicenceStatusSummary.group_id == group_id)
+                .order_by(desc(PDBRDLicenceStatusSummary.total_services))
             )
-            .group_by(
-                OTCLicence.licence_number,
-                OTCOperator.operator_name,
-                BODSDataCatalogue.requires_attention,
-                OTCLicence.licence_status,
-            )
-        )
-        if PDBRDGroup:
-            subquery_q3 = subquery_q3.filter(
-                PDBRDRegistration.group_id == PDBRDGroup.id
-            ).subquery()
-        else:
-            subquery_q3 = subquery_q3.subquery()
-
-        query = (
-            session.query(
-                subquery_q3.c.licence_number,
-                subquery_q3.c.operator_name,
-                subquery_q3.c.licence_status,
-                func.round(
-                    (
-                        100.0
-                        * func.sum(
-                            case(
-                                (
-                                    (
-                                        or_(
-                                            subquery_q3.c.requires_attention.is_(True),
-                                            subquery_q3.c.requires_attention.is_(None),
-                                        ),
-                                        subquery_q3.c.count,
-                                    )
-                                ),
-                                else_=0,
-                            )
-                        )
-                        / func.sum(subquery_q3.c.count)
-                    ),
-                    2,
-                ).label("requires_attention"),
-                func.sum(subquery_q3.c.count).label("total_services"),
-                func.sum(
-                    case(
-                        (
-                            (
-                                subquery_q3.c.requires_attention.is_(None),
-                                subquery_q3.c.count,
-                            )
-                        ),
-                        else_=0,
-                    )
-                ).label("Registrations_not_in_BODS"),
-            )
-            .group_by(
-                subquery_q3.c.licence_number,
-                subquery_q3.c.operator_name,
-                subquery_q3.c.licence_status,
-            )
-            .order_by(desc("total_services"))
-        )
-        return [rec._asdict() for rec in query.all()]
+            results = [rec._asdict() for rec in query.all()]
+            return results, refreshed_at
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     @classmethod
-    def get_report_then_delete_it_from_db(
-        cls, authenticated_entity: AuthenticatedEntity, report_id: str
-    ) -> dict:
-        """Get the report from the database and delete it
+    def get_report(
+        cls,
+        authenticated_entity: AuthenticatedEntity,
+        report_id: str,
+        category: str = None,
+        limit: int = None,
+        page: int = None,
+    ) -> Tuple[dict, bool]:
+        """Get the report, or a page of it, from the database, the report is
+        deleted once its last page is read without a category. Reports which
+        are only read by category or in part are deleted by send_report_to_db
+        once they are older than REPORT_TTL.
+
+        The invalid records of each category are returned under their
+        description with the number of records of the category, in the order
+        of their row numbers. The pages go through the categories in turn.
+        Without limit and page, every record is returned, the entries are
+        read REPORT_PAGE_SIZE at a time.
 
         Args:
             authenticated_entity (AuthenticatedEntity): Authenticated entity
             report_id (str): Report ID
+            category (str, optional): Only the records of this category. Defaults to None.
+            limit (int, optional): The maximum number of records per page.
+                Defaults to REPORT_PAGE_SIZE if the page is given, to every record otherwise.
+            page (int, optional): The page of records to retrieve. Defaults to None.
+
+        Raises:
+            LimitExceeded: If the page number exceeds the total number of records
 
         Returns:
-            json: Report
+            Tuple[dict, bool]: The report, and whether there is a next page.
+                None if the report is not found.
         """
+        if page and limit is None:
+            limit = REPORT_PAGE_SIZE
         models, session = initiate_db_variables()
         User = None
         PDBRDReport = models.PDBRDReport
-        if authenticated_entity.type == "user":
-            User = DBGroup(models, session).get_user(
-                authenticated_entity.name, authenticated_entity.group
+        PDBRDReportEntry = models.PDBRDReportEntry
+        try:
+            if authenticated_entity.type == "user":
+                User = DBGroup(models, session).get_user(
+                    authenticated_entity.name, authenticated_entity.group
+                )
+            if not User:
+                return None
+            report = (
+                session.query(PDBRDReport)
+                .filter(PDBRDReport.report_id == report_id)
+                .filter(PDBRDReport.user_id == User.id)
+                .one_or_none()
             )
-        if not User:
-            return None
-        report = (
-            session.query(PDBRDReport)
-            .filter(PDBRDReport.report_id == report_id)
-            .filter(PDBRDReport.user_id == User.id)
-            .one_or_none()
-        )
-        if report:
-            # Delete report from db:
-            session.delete(report)
-            session.commit()
-            return report.report
-        return None
+            if not report:
+                return None
+
+            report_content = report.report
+            has_next_page = False
+            if is_paged_report(report_content):
+                categories = [
+                    invalid_records
+                    for invalid_records in report_content["invalid_records"]
+                    if category is None or invalid_records["description"] == category
+                ]
+                total = sum(invalid_records["count"] for invalid_records in categories)
+                offset = (page - 1) * limit if page else 0
+                if page and page > 1 and offset >= total:
+                    raise LimitExceeded("Page number exceeds the total number of records")
+                remaining = limit
+                pages = []
+                for invalid_records in categories:
+                    count = invalid_records["count"]
+                    records = {}
+                    if offset >= count:
+                        offset -= count
+                    elif remaining is None:
+                        records = {
+                            str(entry.row_number): entry.errors
+                            for entry in iter_report_entries(
+                                session,
+                                PDBRDReportEntry,
+                                report_id,
+                                invalid_records["description"],
+                            )
+                        }
+                    elif remaining > 0:
+                        entries = (
+                            session.query(
+                                PDBRDReportEntry.row_number, PDBRDReportEntry.errors
+                            )
+                            .filter(PDBRDReportEntry.report_id == report_id)
+                            .filter(
+                                PDBRDReportEntry.category
+                                == invalid_records["description"]
+                            )
+                            .order_by(PDBRDReportEntry.row_number)
+                            .offset(offset)
+                            .limit(remaining)
+                        )
+                        records = {
+                            str(entry.row_number): entry.errors for entry in entries
+                        }
+                        offset = 0
+                        remaining -= len(records)
+                    pages.append({**invalid_records, "records": records})
+                report_content = {**report_content, "invalid_records": pages}
+                has_next_page = bool(limit) and (page or 1) * limit < total
+
+            if category is None and not has_next_page:
+                # The whole report has been read
+                session.query(PDBRDReportEntry).filter(
+                    PDBRDReportEntry.report_id == report_id
+                ).delete()
+                session.delete(report)
+                session.commit()
+            return report_content, has_next_page
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     @classmethod
     def get_staged_records(
-        cls, authenticated_entity: AuthenticatedEntity, stage_id: str = None
+        cls,
+        authenticated_entity: AuthenticatedEntity,
+        stage_id: str = None,
+        limit: int = None,
+        page: int = None,
     ):
-        """Get the staged records from the database
+        """Get the staged records from the database, grouped by licence
 
         Args:
             authenticated_entity (AuthenticatedEntity): Authenticated entity
             stage_id (str, optional): Stage ID. Defaults to None.
+            limit (int, optional): The maximum number of licences per page. Defaults to None.
+            page (int, optional): The page of licences to retrieve. Defaults to None.
 
         Raises:
             NoStagedProcess
             StagingProcessInProgress
+            LimitIsNotSet: If the limit is not set when the page is provided
+            LimitExceeded: If the page number exceeds the total number of licences
 
         Returns:
-            List[dict]: List of records
+            Tuple[List[dict], bool]: The licences with their registration numbers,
+                and whether there is a next page
         """
         models, session = initiate_db_variables()
         PDBRDStage = models.PDBRDStage
         PDBRDLicence = models.OTCLicence
         PDBRDOperator = models.OTCOperator
         PDBRDRegistration = models.PDBRDRegistration
-        PDBRDUser = None
-        if authenticated_entity.type == "user":
-            PDBRDUser = DBGroup(models, session).get_user(
-                authenticated_entity.name, authenticated_entity.group
-            )
-        if not PDBRDUser:
-            return None
-        staged_process = session.query(PDBRDStage).filter(
-            PDBRDStage.stage_id == stage_id
-        )
         try:
-            staged_record = staged_process.one()
-        except Exception as e:
-            log.error(f"Error: {e}")
-            raise NoStagedProcess("No staged process found.")
+            PDBRDUser = None
+            if authenticated_entity.type == "user":
+                PDBRDUser = DBGroup(models, session).get_user(
+                    authenticated_entity.name, authenticated_entity.group
+                )
+            if not PDBRDUser:
+                return None
+            staged_process = session.query(PDBRDStage).filter(
+                PDBRDStage.stage_id == stage_id
+            )
+            try:
+                staged_record = staged_process.one()
+            except Exception as e:
+                log.error(f"Error: {e}")
+                raise NoStagedProcess("No staged process found.")
+
+            if staged_record.stage_status != StageStatus.Completed.value:
+                raise StagingProcessInProgress("Staging process is not done yet")
+            if page and limit is None:
+                raise LimitIsNotSet("Limit must be provided when page is provided")
 
-        if staged_record.stage_status == "in_progress":
-            raise StagingProcessInProgress("Staging process is not done yet")
-        staged_process = staged_process.subquery()
-        staged_records = (
-            session.query(
-                PDBRDRegistration.registration_number,
-                PDBRDLicence.licence_number,
-                PDBRDOperator.operator_name,
+            # One row per licence
+            registration_numbers = func.array_agg(
+                PDBRDRegistration.registration_number
+            ).label("registration_numbers")
+            staged_records = (
+                session.query(
+                    PDBRDLicence.licence_number,
+                    PDBRDOperator.operator_name,
+                    registration_numbers,
+                )
+                .filter(PDBRDRegistration.pdbrd_stage_id == staged_record.id)
+                .filter(PDBRDRegistration.otc_licence_id == PDBRDLicence.id)
+                .filter(PDBRDRegistration.otc_operator_id == PDBRDOperator.id)
+                .group_by(PDBRDLicence.licence_number, PDBRDOperator.operator_name)
+                .order_by(PDBRDLicence.licence_number, PDBRDOperator.operator_name)
             )
-            .filter(PDBRDRegistration.pdbrd_stage_id == select(staged_process.c.id))
-            .filter(PDBRDRegistration.otc_licence_id == PDBRDLicence.id)
-            .filter(PDBRDRegistration.otc_operator_id == PDBRDOperator.id)
-        )
-        results = [rec._asdict() for rec in staged_records.all()]
-        return results
+            if page:
+                staged_records = staged_records.offset((page - 1) * limit)
+            if limit:
+                # One more licence tells whether there is a next page, without counting
+                staged_records = staged_records.limit(limit + 1)
+
+            results = [rec._asdict() for rec in staged_records.all()]
+        finally:
+            session.close()
+        if page and not results:
+            raise LimitExceeded("Page number exceeds the total number of licences")
+
+        has_next_page = bool(limit) and len(results) > limit
+        if has_next_page:
+            results = results[:limit]
+        return results, has_next_page
 
     @classmethod
     def commit_staged_records(
@@ -972,78 +1256,109 @@ class DBManager:
         stage_id: str,
         commit: bool = True,
     ):
+        """Commit or discard the records of a staged upload, each in a single
+        statement on the pdbrd_stage_id index, then delete the staged process
+
+        Args:
+            authenticated_entity (AuthenticatedEntity): The user of the staged upload
+            stage_id (str): ID of the staged upload
+            commit (bool): Commit the staged records if True, discard them otherwise
+
+        Returns:
+            dict: The number of records committed or discarded and the run time
+                in milliseconds, False if the staged upload is not found,
+                None if the user is not found or on error
+        """
+        started_at = monotonic()
         models, session = initiate_db_variables()
         PDBRDStage = models.PDBRDStage
         PDBRDRegistration = models.PDBRDRegistration
-        PDBRDUser = None
-        if authenticated_entity.type == "user":
-            PDBRDUser = DBGroup(models, session).get_user(
-                authenticated_entity.name, authenticated_entity.group
-            )
-        if not PDBRDUser:
-            return None
-
         try:
-            if not commit:
-                # Get the staged process id
-                staged_process_id = (
-                    session.query(PDBRDStage.id)
-                    .filter(PDBRDStage.stage_id == stage_id)
-                    .filter(PDBRDStage.stage_user == PDBRDUser.id)
-                )
-                staged_process_subquery = staged_process_id.subquery()
-                staged_records = session.query(PDBRDRegistration).filter(
-                    PDBRDRegistration.pdbrd_stage_id
-                    == select(staged_process_subquery).scalar_subquery()
+            PDBRDUser = None
+            if authenticated_entity.type == "user":
+                PDBRDUser = DBGroup(models, session).get_user(
+                    authenticated_entity.name, authenticated_entity.group
                 )
-                staged_records.delete(synchronize_session=False)
+            if not PDBRDUser:
+                return None
 
-            # Get the staged process
-            staged_process = (
-                session.query(PDBRDStage)
+            # Lock the staged process, so it is committed or discarded once
+            staged_process_id = (
+                session.query(PDBRDStage.id)
                 .filter(PDBRDStage.stage_id == stage_id)
                 .filter(PDBRDStage.stage_user == PDBRDUser.id)
+                .with_for_update()
+                .scalar()
             )
-            # Delete the staged process
-            deleted_count = staged_process.delete(synchronize_session=False)
+            if staged_process_id is None:
+                session.rollback()
+                return False
+
+            staged_records = session.query(PDBRDRegistration).filter(
+                PDBRDRegistration.pdbrd_stage_id == staged_process_id
+            )
+            if commit:
+                # The latest variation of a service is over the registrations of
+                # every group, the other groups with the services are recomputed too
+                invalidate_licence_status_summaries(
+                    session,
+                    models,
+                    select(
+                        PDBRDRegistration.registration_number,
+                        PDBRDRegistration.route_number,
+                    ).where(PDBRDRegistration.pdbrd_stage_id == staged_process_id),
+                    exclude_group_id=PDBRDUser.group_id,
+                )
+                records_count = staged_records.update(
+                    {"pdbrd_stage_id": None}, synchronize_session=False
+                )
+            else:
+                records_count = staged_records.delete(synchronize_session=False)
+            # No registration references the staged process any more
+            session.query(PDBRDStage).filter(PDBRDStage.id == staged_process_id).delete(
+                synchronize_session=False
+            )
+            if commit:
+                refresh_licence_status_summary(session, models, PDBRDUser.group_id)
             session.commit()
-            session.close()
-            if deleted_count > 0:
-                return True
-            return False
+            elapsed_ms = round((monotonic() - started_at) * 1000, 1)
+            log.info(
+                f"{'Committed' if commit else 'Discarded'} {records_count} staged records "
+                f"of {stage_id} in {elapsed_ms}ms"
+            )
+            return {"count": records_count, "elapsed_ms": elapsed_ms}
         except Exception as e:
             log.error(f"Error: {e}")
             session.rollback()
+        finally:
             session.close()
 
-    @classmethod
-    def commit_discard_changes(cls, session: Session, commit: bool = False):
-        if commit:
-            session.commit()
-        else:
-            session.rollback()
-        session.close()
-
     @classmethod
     def get_staged_process(cls, authenticated_entity: AuthenticatedEntity):
         models, session = initiate_db_variables()
         PDBRDStage = models.PDBRDStage
-        if authenticated_entity.type == "user":
-            PDBRDUser = DBGroup(models, session).get_user(
-                authenticated_entity.name, authenticated_entity.group
-            )
-        if not PDBRDUser:
-            return None
-        staged_process = session.query(
-            PDBRDStage.id,
-            PDBRDStage.stage_id,
-            PDBRDStage.created_at,
-            PDBRDStage.stage_status,
-        ).filter(PDBRDStage.stage_user == PDBRDUser.id)
-        result = [rec._asdict() for rec in staged_process.all()]
+        try:
+            PDBRDUser = None
+            if authenticated_entity.type == "user":
+                PDBRDUser = DBGroup(models, session).get_user(
+                    authenticated_entity.name, authenticated_entity.group
+                )
+            if not PDBRDUser:
+                return None
+            if discard_stale_stage_processes(session, models, PDBRDUser.id):
+                session.commit()
+            staged_process = session.query(
+                PDBRDStage.id,
+                PDBRDStage.stage_id,
+                PDBRDStage.created_at,
+                PDBRDStage.stage_status,
+            ).filter(PDBRDStage.stage_user == PDBRDUser.id)
+            result = [rec._asdict() for rec in staged_process.all()]
+        finally:
+            session.close()
         if len(result) > 0:
             for record in result:
-                if record.get("stage_status") == "in_progress":
+                if record.get("stage_status") != StageStatus.Completed.value:
                     raise StagingProcessInProgress("Staging process is not done yet")
 
         if len(result) == 0:
@@ -1052,162 +1367,809 @@ class DBManager:
         return result
 
 
-def initiate_stage_process(user_name: str, group_name: str, report_id: str):
-    # Add or create the group
-    models = AutoMappingModels()
-    engine = models.engine
-    tables = models.get_tables()
-    PDBRDStage = tables["PDBRDStage"]
-    session = Session(engine)
-    PDBRDUser = DBGroup(models, session).get_or_create_user(user_name, group_name)
-    # check if user has staged process
-    staged_process = session.query(PDBRDStage).filter(
-        PDBRDStage.stage_user == PDBRDUser.id
+def iter_query_records(session: Session, query: Query, batch_size: int) -> Iterator[dict]:
+    """Fetch the records of a query batch by batch, closing the session once
+    they are consumed or the iteration is stopped
+
+    Args:
+        session (Session): Database session of the query
+        query (Query): The query
+        batch_size (int): Number of records fetched at a time
+
+    Returns:
+        Iterator[dict]: The records
+    """
+    try:
+        for record in query.yield_per(batch_size):
+            yield record._asdict()
+    finally:
+        session.close()
+
+
+def licence_status_summary_query(session: Session, models, group_id: int) -> Query:
+    """Summarise the active registrations of a group by licence
+
+    Args:
+        session (Session): Database session
+        models (AutoMappingModels): Mapped models
+        group_id (int): Group ID
+
+    Returns:
+        Query: The group ID, licence number, operator name, licence status,
+            percentage of services requiring attention, number of services and
+            number of services not in BODS of each licence
+    """
+    PDBRDRegistration = models.PDBRDRegistration
+    OTCOperator = models.OTCOperator
+    OTCLicence = models.OTCLicence
+    BODSDataCatalogue = models.BODSDataCatalogue
+    subquery_q1 = (
+        session.query(
+            PDBRDRegistration.registration_number,
+            PDBRDRegistration.route_number,
+            func.max(PDBRDRegistration.variation_number).label("max_variation_number"),
+        )
+        .filter(PDBRDRegistration.pdbrd_stage_id.is_(None))
+        .group_by(PDBRDRegistration.registration_number, PDBRDRegistration.route_number)
+        .subquery()
     )
-    if staged_process.count() > 0:
-        raise PreviousProcessNotCompleted(
-            "There is a previous process not completed yet."
+    subquery_q2 = (
+        session.query(PDBRDRegistration.id).join(
+            subquery_q1,
+            and_(
+                PDBRDRegistration.registration_number
+                == subquery_q1.c.registration_number,
+                PDBRDRegistration.variation_number
+                == subquery_q1.c.max_variation_number,
+                PDBRDRegistration.route_number == subquery_q1.c.route_number,
+            ),
+        )
+    ).subquery()
+    subquery_q3 = (
+        session.query(
+            func.count(PDBRDRegistration.registration_number).label("count"),
+            OTCLicence.licence_number,
+            BODSDataCatalogue.requires_attention,
+            OTCOperator.operator_name,
+            OTCLicence.licence_status,
+        )
+        .join(OTCLicence, OTCLicence.id == PDBRDRegistration.otc_licence_id)
+        .outerjoin(
+            BODSDataCatalogue,
+            PDBRDRegistration.registration_number == BODSDataCatalogue.xml_service_code,
         )
+        .join(OTCOperator, OTCOperator.id == PDBRDRegistration.otc_operator_id)
+        .filter(PDBRDRegistration.group_id == group_id)
+        .filter(PDBRDRegistration.id.in_(select(subquery_q2)))
+        .filter(PDBRDRegistration.application_type.in_(ACTIVE_APPLICATION_TYPES))
+        .filter(PDBRDRegistration.effective_date <= func.current_date())
+        .filter(
+            or_(
+                PDBRDRegistration.end_date > func.current_date(),
+                PDBRDRegistration.end_date == None,
+            )
+        )
+        .group_by(
+            OTCLicence.licence_number,
+            OTCOperator.operator_name,
+            BODSDataCatalogue.requires_attention,
+            OTCLicence.licence_status,
+        )
+        .subquery()
+    )
+    return session.query(
+        literal(group_id).label("group_id"),
+        subquery_q3.c.licence_number,
+        subquery_q3.c.operator_name,
+        subquery_q3.c.licence_status,
+        func.round(
+            (
+                100.0
+                * func.sum(
+                    case(
+                        (
+                            or_(
+                                subquery_q3.c.requires_attention.is_(True),
+                                subquery_q3.c.requires_attention.is_(None),
+                            ),
+                            subquery_q3.c.count,
+                        ),
+                        else_=0,
+                    )
+                )
+                / func.sum(subquery_q3.c.count)
+            ),
+            2,
+        ).label("requires_attention"),
+        func.sum(subquery_q3.c.count).label("total_services"),
+        func.sum(
+            case(
+                (subquery_q3.c.requires_attention.is_(None), subquery_q3.c.count),
+                else_=0,
+            )
+        ).label("registrations_not_in_bods"),
+    ).group_by(
+        subquery_q3.c.licence_number,
+        subquery_q3.c.operator_name,
+        subquery_q3.c.licence_status,
+    )
+
 
-    # add record to the stage table
-    PDBRDStage_record = PDBRDStage(
-        stage_user=PDBRDUser.id, stage_id=report_id, stage_status="in_progress"
+def licence_status_summary_is_stale(session: Session, models, group_id: int) -> bool:
+    """Whether the licence status summary of a group has to be recomputed.
+    The summary is invalidated by the data catalogue refresh, and expires every
+    day as registrations become active or end.
+
+    Args:
+        session (Session): Database session
+        models (AutoMappingModels): Mapped models
+        group_id (int): Group ID
+
+    Returns:
+        bool: True if the summary is missing, invalidated or computed before today
+    """
+    PDBRDGroup = models.PDBRDGroup
+    fresh = (
+        session.query(PDBRDGroup.id)
+        .filter(PDBRDGroup.id == group_id)
+        .filter(PDBRDGroup.licence_status_refreshed_at >= func.current_date())
     )
-    session.add(PDBRDStage_record)
-    session.commit()
-    PDBRDStage_id = PDBRDStage_record.id
-    session.close()
-    return PDBRDStage_id
+    return not session.query(fresh.exists()).scalar()
 
 
-def complete_stage_process(stage_id: str):
-    models = AutoMappingModels()
-    engine = models.engine
+def invalidate_licence_status_summaries(
+    session: Session, models, services, exclude_group_id: int = None
+):
+    """Invalidate the licence status summaries of the groups with registrations
+    of the services, they are recomputed on their next read. The changes are
+    left to be committed with the rest of the transaction.
+
+    Args:
+        session (Session): Database session
+        models (AutoMappingModels): Mapped models
+        services (Select): The (registration_number, route_number) of the services
+        exclude_group_id (int, optional): A group whose summary is refreshed by the caller
+    """
+    PDBRDGroup = models.PDBRDGroup
+    PDBRDRegistration = models.PDBRDRegistration
+    groups = select(PDBRDRegistration.group_id).where(
+        tuple_(
+            PDBRDRegistration.registration_number, PDBRDRegistration.route_number
+        ).in_(services)
+    )
+    query = session.query(PDBRDGroup).filter(PDBRDGroup.id.in_(groups))
+    if exclude_group_id is not None:
+        query = query.filter(PDBRDGroup.id != exclude_group_id)
+    query.update({"licence_status_refreshed_at": None}, synchronize_session=False)
+
+
+def refresh_licence_status_summary(session: Session, models, group_id: int):
+    """Recompute the licence status summary of a group. The changes are left
+    to be committed with the rest of the transaction.
+
+    Args:
+        session (Session): Database session
+        models (AutoMappingModels): Mapped models
+        group_id (int): Group ID
+    """
+    PDBRDGroup = models.PDBRDGroup
+    PDBRDLicenceStatusSummary = models.PDBRDLicenceStatusSummary
+    # Lock the group so concurrent refreshes of its summary are serialised
+    session.query(PDBRDGroup).filter(PDBRDGroup.id == group_id).with_for_update().one()
+    session.query(PDBRDLicenceStatusSummary).filter(
+        PDBRDLicenceStatusSummary.group_id == group_id
+    ).delete(synchronize_session=False)
+    session.execute(
+        insert(PDBRDLicenceStatusSummary).from_select(
+            [
+                "group_id",
+                "licence_number",
+                "operator_name",
+                "licence_status",
+                "requires_attention",
+                "total_services",
+                "registrations_not_in_bods",
+            ],
+            licence_status_summary_query(session, models, group_id).statement,
+        )
+    )
+    session.query(PDBRDGroup).filter(PDBRDGroup.id == group_id).update(
+        {"licence_status_refreshed_at": func.current_timestamp()},
+        synchronize_session=False,
+    )
+
+
+def discard_stale_stage_processes(session: Session, models, user_id: int) -> int:
+    """Discard the staged processes of the user which are not completed and
+    were not updated for STAGE_TIMEOUT, with their registrations. Their upload
+    job timed out, crashed or was moved to the dead-letter queue, they would
+    block the uploads of the user otherwise.
+
+    Args:
+        session (Session): Database session, committed by the caller
+        models (AutoMappingModels): Mapped models
+        user_id (int): User ID
+
+    Returns:
+        int: The number of discarded staged processes
+    """
+    PDBRDStage = models.PDBRDStage
+    PDBRDRegistration = models.PDBRDRegistration
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+        seconds=STAGE_TIMEOUT
+    )
+    stale_ids = [
+        stage.id
+        for stage in session.query(PDBRDStage.id, PDBRDStage.stage_id)
+        .filter(PDBRDStage.stage_user == user_id)
+        .filter(PDBRDStage.stage_status != StageStatus.Completed.value)
+        .filter(func.coalesce(PDBRDStage.updated_at, PDBRDStage.created_at) < cutoff)
+    ]
+    if not stale_ids:
+        return 0
+    log.warning(f"Discarding {len(stale_ids)} stale staged processes of user {user_id}")
+    session.query(PDBRDRegistration).filter(
+        PDBRDRegistration.pdbrd_stage_id.in_(stale_ids)
+    ).delete(synchronize_session=False)
+    return session.query(PDBRDStage).filter(PDBRDStage.id.in_(stale_ids)).delete(
+        synchronize_session=False
+    )
+
+
+def restart_stage_process(stage_id: int) -> bool:
+    """Start the upload job of a staged process, the registrations of an
+    earlier attempt of the job are discarded
+
+    Args:
+        stage_id (int): ID of the staged process
+
+    Returns:
+        bool: False if the staged process was discarded
+    """
+    models, session = initiate_db_variables()
+    PDBRDStage = models.PDBRDStage
+    PDBRDRegistration = models.PDBRDRegistration
+    try:
+        staged_process = (
+            session.query(PDBRDStage)
+            .filter(PDBRDStage.id == stage_id)
+            .with_for_update()
+            .one_or_none()
+        )
+        if staged_process is None:
+            return False
+        session.query(PDBRDRegistration).filter(
+            PDBRDRegistration.pdbrd_stage_id == stage_id
+        ).delete(synchronize_session=False)
+        staged_process.stage_status = StageStatus.Scanning.value
+        staged_process.updated_at = func.current_timestamp()
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def initiate_stage_process(user_name: str, group_name: str, report_id: str):
+    # Add or create the group
+    models, session = initiate_db_variables()
     tables = models.get_tables()
     PDBRDStage = tables["PDBRDStage"]
-    session = Session(engine)
-    staged_process = session.query(PDBRDStage).filter(PDBRDStage.id == stage_id)
-    staged_process.update({"stage_status": "completed"})
-    session.commit()
-    session.close()
+    try:
+        PDBRDUser = DBGroup(models, session).get_or_create_user(user_name, group_name)
+        discard_stale_stage_processes(session, models, PDBRDUser.id)
+        # check if user has staged process
+        staged_process = session.query(PDBRDStage).filter(
+            PDBRDStage.stage_user == PDBRDUser.id
+        )
+        if staged_process.count() > 0:
+            raise PreviousProcessNotCompleted(
+                "There is a previous process not completed yet."
+            )
+
+        # add record to the stage table
+        PDBRDStage_record = PDBRDStage(
+            stage_user=PDBRDUser.id,
+            stage_id=report_id,
+            stage_status=StageStatus.Queued.value,
+        )
+        session.add(PDBRDStage_record)
+        session.commit()
+        return PDBRDStage_record.id
+    finally:
+        session.close()
 
 
-def send_to_db(
-    records: List[Registration], group_name=None, user_name=None, stage_id=None
-):
-    # validated_records: List[Registration] = MockData.mock_user_csv_record()
-    models = AutoMappingModels()
-    engine = models.engine
+def update_stage_process(stage_id: str, stage_status: StageStatus):
+    models, session = initiate_db_variables()
     tables = models.get_tables()
-    OTCOperator = tables["OTCOperator"]
-    OTCLicence = tables["OTCLicence"]
-    PDBRDRegistration = tables["PDBRDRegistration"]
     PDBRDStage = tables["PDBRDStage"]
-    PDBRDUser = tables["PDBRDUser"]
-    # Check if the licence number exists in the OTC database
-    # validated_records = validate_licence_number_existence(validated_records)
-    db_invalid_insertion = []
-    already_exists_records = {}
-    belongs_to_another_user = {}
+    try:
+        staged_process = session.query(PDBRDStage).filter(PDBRDStage.id == stage_id)
+        staged_process.update(
+            {"stage_status": stage_status.value, "updated_at": func.current_timestamp()}
+        )
+        session.commit()
+    finally:
+        session.close()
 
-    # Add or create the group
-    session = Session(engine)
-    PDBRDUser = DBGroup(models, session).get_or_create_user(user_name, group_name)
-    group_id = PDBRDUser.group_id
-    # # add record to the stage table
 
-    for idx, record_and_licence in records["valid_records"].items():
+def complete_stage_process(stage_id: str):
+    update_stage_process(stage_id, StageStatus.Completed)
+
+
+def registration_values(
+    record: Registration,
+    operator_record_id: int,
+    licence_record_id: int,
+    group_id: int,
+    PDBRDStage_id: int,
+) -> dict:
+    """Column values of the PDBRDRegistration row for a validated record"""
+    return {
+        "route_number": record.route_number,
+        "route_description": record.route_description,
+        "variation_number": record.variation_number,
+        "start_point": record.start_point,
+        "finish_point": record.finish_point,
+        "via": record.via,
+        "subsidised": record.subsidised,
+        "subsidy_detail": record.subsidy_detail,
+        "is_short_notice": record.is_short_notice,
+        "received_date": record.received_date,
+        "granted_date": record.granted_date,
+        "effective_date": record.effective_date,
+        "end_date": record.end_date,
+        "bus_service_type_id": record.bus_service_type_id,
+        "bus_service_type_description": record.bus_service_type_description,
+        "registration_number": record.registration_number,
+        "traffic_area_id": record.traffic_area_id,
+        "application_type": record.application_type,
+        "publication_text": record.publication_text,
+        "other_details": record.other_details,
+        "otc_operator_id": operator_record_id,
+        "otc_licence_id": licence_record_id,
+        "group_id": group_id,
+        "pdbrd_stage_id": PDBRDStage_id,
+    }
+
+
+class RegistrationWriter:
+    """Insert the validated records of an upload batch by batch, in a single
+    transaction committed when the upload is done
+
+    Operators and licences are upserted once per distinct value, existing
+    registrations are looked up for the whole batch at once and the new
+    registrations are inserted with multi-row statements. The registrations
+    inserted by earlier batches are found by the lookup of the later ones.
+    """
+
+    def __init__(self, group_name: str, user_name: str, stage_id: int = None):
+        self.group_name = group_name
+        self.user_name = user_name
+        self.stage_id = stage_id
+        self.operator_ids = {}
+        self.licence_ids = {}
+
+    def __enter__(self):
+        self.models, self.session = initiate_db_variables()
+        tables = self.models.get_tables()
+        self.OTCOperator = tables["OTCOperator"]
+        self.OTCLicence = tables["OTCLicence"]
+        self.PDBRDRegistration = tables["PDBRDRegistration"]
+        self.PDBRDStage = tables["PDBRDStage"]
         try:
-            # Create a new session
-            session = Session(engine)
-            # Prepare operator object and added to the database
-            record, licence = record_and_licence
-            OTCOperator_record = OTCOperator(
-                operator_name=licence.operator_details.operator_name
+            # Add or create the group
+            PDBRDUser = DBGroup(self.models, self.session).get_or_create_user(
+                self.user_name, self.group_name
             )
+        except Exception:
+            self.session.close()
+            raise
+        self.group_id = PDBRDUser.group_id
+        return self
 
-            # Add or fetch the operator id from the database
-            operator_record_id = DBManager.fetch_operator_record(
-                licence.operator_details.operator_name,
-                session,
-                OTCOperator,
-                OTCOperator_record,
-            )
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                # Update the staged process status
+                self.session.query(self.PDBRDStage).filter(
+                    self.PDBRDStage.id == self.stage_id
+                ).update(
+                    {
+                        "stage_status": StageStatus.Completed.value,
+                        "updated_at": func.current_timestamp(),
+                    }
+                )
+                self.session.commit()
+            else:
+                log.error(f"Error: {exc_value}")
+                self.session.rollback()
+        finally:
+            self.session.close()
 
-            # Prepare licence object and added to the database
-            OTCLicence_record = OTCLicence(
-                licence_number=licence.licence_details.licence_number,
-                licence_status=licence.licence_details.licence_status,
-            )
+    def write(self, valid_records: dict) -> dict:
+        """Insert a batch of validated records
+
+        Args:
+            valid_records (dict): [Registration, LicenceRecord] keyed by the row index
 
-            # Add or fetch the licence id from the database
-            licence_record_id = DBManager.fetch_licence_record(
-                licence.licence_details.licence_number,
-                session,
-                OTCLicence,
-                OTCLicence_record,
+        Returns:
+            dict: The errors of the records already in the database, keyed by the row index
+        """
+        already_exists_records = {}
+        self.operator_ids.update(
+            DBManager.upsert_operator_records(
+                {
+                    licence.operator_details.operator_name
+                    for _, licence in valid_records.values()
+                }
+                - self.operator_ids.keys(),
+                self.session,
+                self.OTCOperator,
+            )
+        )
+        self.licence_ids.update(
+            DBManager.upsert_licence_records(
+                {
+                    licence.licence_details.licence_number: licence.licence_details.licence_status
+                    for _, licence in valid_records.values()
+                    if licence.licence_details.licence_number not in self.licence_ids
+                },
+                self.session,
+                self.OTCLicence,
+            )
+        )
+        registration_keys = {
+            idx: (
+                self.licence_ids[licence.licence_details.licence_number],
+                record.registration_number,
+                record.variation_number,
+                record.route_number,
             )
+            for idx, (record, licence) in valid_records.items()
+        }
+        existing_keys = DBManager.fetch_existing_registration_keys(
+            set(registration_keys.values()),
+            self.group_id,
+            self.session,
+            self.PDBRDRegistration,
+        )
 
-            # Add the record to the PDBRDRegistration table
-            DBManager.upsert_record_to_pdbrd_registration_table(
+        new_registrations = {}
+        for idx, (record, licence) in valid_records.items():
+            key = registration_keys[idx]
+            if key in existing_keys:
+                already_exists_records[idx] = ALREADY_EXISTS_ERRORS
+                continue
+            # Later rows of the upload with the same key are reported as existing
+            existing_keys.add(key)
+            new_registrations[idx] = registration_values(
                 record,
-                operator_record_id,
-                licence_record_id,
-                session,
-                PDBRDRegistration,
-                group_id,
-                stage_id,
-            )
-        except RecordIsAlreadyExist:
-            already_exists_records.update(
-                {idx: [{"Duplicated Record": "Record already exists in the database"}]}
+                self.operator_ids[licence.operator_details.operator_name],
+                self.licence_ids[licence.licence_details.licence_number],
+                self.group_id,
+                self.stage_id,
             )
-            db_invalid_insertion.append(idx)
-        except RecordBelongsToAnotherUser:
-            belongs_to_another_user.update(
-                {
-                    idx: [
-                        {"RecordBelongsToAnotherUser": "Record belongs to another user"}
-                    ]
-                }
+        inserted_keys = DBManager.insert_registration_records(
+            list(new_registrations.values()), self.session, self.PDBRDRegistration
+        )
+        for idx in new_registrations:
+            if registration_keys[idx] not in inserted_keys:
+                already_exists_records[idx] = ALREADY_EXISTS_ERRORS
+        return already_exists_records
+
+    def delete(self, record_keys: set) -> int:
+        """Delete registrations inserted by the earlier batches
+
+        Args:
+            record_keys (set): (licence_number, variation_number, registration_number,
+                route_number) of the registrations to delete
+
+        Returns:
+            int: The number of deleted registrations
+        """
+        PDBRDRegistration = self.PDBRDRegistration
+        key_columns = (
+            PDBRDRegistration.otc_licence_id,
+            PDBRDRegistration.variation_number,
+            PDBRDRegistration.registration_number,
+            PDBRDRegistration.route_number,
+        )
+        keys = [
+            (self.licence_ids[licence_number], *key)
+            for licence_number, *key in record_keys
+            if licence_number in self.licence_ids
+        ]
+        deleted_count = 0
+        for start in range(0, len(keys), BULK_LOOKUP_CHUNK_SIZE):
+            chunk = keys[start : start + BULK_LOOKUP_CHUNK_SIZE]
+            query = (
+                self.session.query(PDBRDRegistration)
+                .filter(PDBRDRegistration.group_id == self.group_id)
+                .filter(tuple_(*key_columns).in_(chunk))
             )
-            db_invalid_insertion.append(idx)
-            session.commit()
-        except Exception as e:
-            log.error(f"Error: {e}")
-            session.rollback()
+            if self.stage_id is not None:
+                query = query.filter(PDBRDRegistration.pdbrd_stage_id == self.stage_id)
+            deleted_count += query.delete(synchronize_session=False)
+        return deleted_count
+
+
+def iter_report_entries(
+    session: Session, PDBRDReportEntry: Table, report_id: str, category: str
+) -> Iterator:
+    """Read the entries of a category of the report REPORT_PAGE_SIZE at a
+    time, in the order of their row numbers
+
+    Args:
+        session (Session): The session
+        PDBRDReportEntry (Table): The report entries table
+        report_id (str): Report ID
+        category (str): The description of the category
+
+    Returns:
+        Iterator: The (row_number, errors) of the entries
+    """
+    last_row_number = None
+    while True:
+        query = (
+            session.query(PDBRDReportEntry.row_number, PDBRDReportEntry.errors)
+            .filter(PDBRDReportEntry.report_id == report_id)
+            .filter(PDBRDReportEntry.category == category)
+        )
+        if last_row_number is not None:
+            query = query.filter(PDBRDReportEntry.row_number > last_row_number)
+        entries = query.order_by(PDBRDReportEntry.row_number).limit(REPORT_PAGE_SIZE).all()
+        yield from entries
+        if len(entries) < REPORT_PAGE_SIZE:
+            return
+        last_row_number = entries[-1].row_number
+
+
+def is_paged_report(report: dict) -> bool:
+    """Whether the invalid records of the report are stored as report entries,
+    the report then holds the number of records of each category
+    """
+    invalid_records = report.get("invalid_records")
+    return invalid_records is not None and all(
+        "count" in records and "records" not in records for records in invalid_records
+    )
+
+
+class ReportWriter:
+    """Store the invalid records of an upload report as they are found, one
+    entry per record, so the whole report is never held in memory
+
+    Each batch of entries is committed on its own. The entries are removed
+    if the upload fails, the report is then sent without them.
+    """
+
+    def __init__(self, report_id: str):
+        self.report_id = report_id
+        # Number of entries of each category
+        self.counts = {}
+
+    def __enter__(self):
+        self.models, self.session = initiate_db_variables()
+        self.PDBRDReportEntry = self.models.PDBRDReportEntry
+        try:
+            # Entries left by an earlier attempt of the same upload
+            self._entries().delete()
+            self.session.commit()
+        except Exception:
+            self.session.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is not None:
+                log.error(f"Error: {exc_value}")
+                self.session.rollback()
+                self._entries().delete()
+                self.session.commit()
         finally:
-            session.close()
-    # Remove records from the valid_records dictionary that were not added to the database
-    for idx in db_invalid_insertion:
-        del records["valid_records"][f"{idx}"]
-    if len(already_exists_records) > 0:
-        records["invalid_records"].append(
-            {"records": already_exists_records, "description": "Record already exists"}
+            self.session.close()
+
+    def _entries(self):
+        return self.session.query(self.PDBRDReportEntry).filter(
+            self.PDBRDReportEntry.report_id == self.report_id
         )
-    if len(belongs_to_another_user) > 0:
-        records["invalid_records"].append(
+
+    def write(self, category: str, records: dict):
+        """Store the invalid records of a category
+
+        Args:
+            category (str): The description of the category
+            records (dict): The errors of the records keyed by their row number
+        """
+        self.counts.setdefault(category, 0)
+        if not records:
+            return
+        entries = [
             {
-                "records": belongs_to_another_user,
-                "description": "Record belongs to another user",
+                "report_id": self.report_id,
+                "category": category,
+                "row_number": int(idx),
+                "errors": errors,
             }
-        )
-    # Update the staged process status
-    session = Session(engine)
-    staged_process = session.query(PDBRDStage).filter(PDBRDStage.id == stage_id)
-    staged_process.update({"stage_status": "completed"})
-    session.commit()
-    session.close()
+            for idx, errors in records.items()
+        ]
+        try:
+            for start in range(0, len(entries), REPORT_ENTRY_CHUNK_SIZE):
+                self.session.execute(
+                    insert(self.PDBRDReportEntry),
+                    entries[start : start + REPORT_ENTRY_CHUNK_SIZE],
+                )
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self.counts[category] += len(entries)
+
+    def remove(self, category: str, row_numbers: set) -> set:
+        """Remove the records of a category
+
+        Args:
+            category (str): The description of the category
+            row_numbers (set): The row numbers of the records
+
+        Returns:
+            set: The row numbers of the records which were in the category
+        """
+        removed = set()
+        sorted_numbers = sorted(int(idx) for idx in row_numbers)
+        try:
+            for start in range(0, len(sorted_numbers), REPORT_ENTRY_CHUNK_SIZE):
+                chunk = sorted_numbers[start : start + REPORT_ENTRY_CHUNK_SIZE]
+                result = self.session.execute(
+                    self.PDBRDReportEntry.__table__.delete()
+                    .where(self.PDBRDReportEntry.report_id == self.report_id)
+                    .where(self.PDBRDReportEntry.category == category)
+                    .where(self.PDBRDReportEntry.row_number.in_(chunk))
+                    .returning(self.PDBRDReportEntry.row_number)
+                )
+                removed.update(str(row_number) for row_number in result.scalars())
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if category in self.counts:
+            self.counts[category] -= len(removed)
+        return removed
 
 
 def send_report_to_db(report: dict, user_name: str, group_name: str, report_id: str):
     models, session = initiate_db_variables()
+    try:
+        PDBRDUser = DBGroup(models, session).get_or_create_user(user_name, group_name)
+        PDBRDReport = models.PDBRDReport
+        report_record = PDBRDReport(
+            report_id=report_id, user_id=PDBRDUser.id, report=report
+        )
+        session.add(report_record)
+        session.commit()
+        try:
+            delete_expired_reports(session, models)
+            session.commit()
+        except Exception as e:
+            log.error(f"Error: {e}")
+            session.rollback()
+    finally:
+        session.close()
+
+
+def delete_expired_reports(session: Session, models) -> int:
+    """Delete the reports older than REPORT_TTL and their entries, get_report
+    only deletes the reports read to their last page without a category
 
-    PDBRDUser = DBGroup(models, session).get_or_create_user(user_name, group_name)
+    Args:
+        session (Session): The session, committed by the caller
+        models (AutoMappingModels): The models of the tables
+
+    Returns:
+        int: The number of deleted reports
+    """
     PDBRDReport = models.PDBRDReport
-    report_record = PDBRDReport(
-        report_id=report_id, user_id=PDBRDUser.id, report=report
+    PDBRDReportEntry = models.PDBRDReportEntry
+    expired = PDBRDReport.created_at < datetime.now(timezone.utc) - timedelta(
+        seconds=REPORT_TTL
+    )
+    session.query(PDBRDReportEntry).filter(
+        PDBRDReportEntry.report_id.in_(
+            select(PDBRDReport.report_id).where(expired)
+        )
+    ).delete(synchronize_session=False)
+    return session.query(PDBRDReport).filter(expired).delete(
+        synchronize_session=False
     )
-    session.add(report_record)
-    session.commit()
-    session.close()
+
+
+def report_exists(report_id: str) -> bool:
+    """Whether the report of an upload was sent to the database, i.e. its
+    upload job was processed
+    """
+    models, session = initiate_db_variables()
+    PDBRDReport = models.PDBRDReport
+    try:
+        return (
+            session.query(PDBRDReport.id)
+            .filter(PDBRDReport.report_id == report_id)
+            .first()
+            is not None
+        )
+    finally:
+        session.close()
+
+
+def fetch_cached_licences(licence_numbers: set) -> dict:
+    """Get the cached OTC API lookups of the licences
+
+    Args:
+        licence_numbers (set): The licence numbers
+
+    Returns:
+        dict: The cache entry of each cached licence keyed by the licence number,
+            with otc_licence_number, licence_status, operator_name, found and fetched_at
+    """
+    if not licence_numbers:
+        return {}
+    models, session = initiate_db_variables()
+    OTCLicenceCache = models.OTCLicenceCache
+    entries = {}
+    try:
+        sorted_numbers = sorted(licence_numbers)
+        for start in range(0, len(sorted_numbers), BULK_LOOKUP_CHUNK_SIZE):
+            chunk = sorted_numbers[start : start + BULK_LOOKUP_CHUNK_SIZE]
+            query = session.query(
+                OTCLicenceCache.licence_number,
+                OTCLicenceCache.otc_licence_number,
+                OTCLicenceCache.licence_status,
+                OTCLicenceCache.operator_name,
+                OTCLicenceCache.found,
+                OTCLicenceCache.fetched_at,
+            ).filter(OTCLicenceCache.licence_number.in_(chunk))
+            for entry in query:
+                entries[entry.licence_number] = entry._asdict()
+    finally:
+        session.close()
+    return entries
+
+
+def store_cached_licences(entries: List[dict]):
+    """Insert or replace the cache entries of the licences in a single statement
+
+    Args:
+        entries (List[dict]): The cache entries, with licence_number,
+            otc_licence_number, licence_status, operator_name, found and fetched_at
+    """
+    if not entries:
+        return
+    models, session = initiate_db_variables()
+    OTCLicenceCache = models.OTCLicenceCache
+    try:
+        stmt = pg_insert(OTCLicenceCache).values(
+            sorted(entries, key=lambda entry: entry["licence_number"])
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["licence_number"],
+            set_={
+                column: stmt.excluded[column]
+                for column in (
+                    "otc_licence_number",
+                    "licence_status",
+                    "operator_name",
+                    "found",
+                    "fetched_at",
+                )
+            },
+        )
+        session.execute(stmt)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -52,3 +52,7 @@ class NoStagedProcess(Exception):
 
 class PreviousProcessNotCompleted(Exception):
     pass
+
+
+class InvalidPageToken(Exception):
+    pass
@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date
+from typing import Iterable, Iterator, List, Optional
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+EXPORT_MEDIA_TYPES = {
+    NDJSON_MEDIA_TYPE: NDJSON_MEDIA_TYPE,
+    "application/ndjson": NDJSON_MEDIA_TYPE,
+    CSV_MEDIA_TYPE: CSV_MEDIA_TYPE,
+}
+
+# Size of the chunks of the response body sent to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def negotiate_export_media_type(accept: Optional[str]) -> Optional[str]:
+    """Pick the streaming export format from the Accept header
+
+    Args:
+        accept (str): The Accept header of the request
+
+    Returns:
+        str: NDJSON or CSV media type, None if the client did not ask for either
+    """
+    candidates = []
+    for position, media_range in enumerate((accept or "").split(",")):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type.lower() in EXPORT_MEDIA_TYPES and quality > 0:
+            candidates.append((-quality, position, media_type.lower()))
+    if not candidates:
+        return None
+    return EXPORT_MEDIA_TYPES[min(candidates)[2]]
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Whether the Accept-Encoding header allows a gzip response"""
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def iter_ndjson(records: Iterable[dict]) -> Iterator[str]:
+    """Serialise the records as newline delimited JSON, one line per record"""
+    for record in records:
+        yield json.dumps(record, default=_json_default) + "\n"
+
+
+def iter_csv(fieldnames: List[str], records: Iterable[dict]) -> Iterator[str]:
+    """Serialise the records as CSV, the header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_chunks(
+    lines: Iterable[str], chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Group the serialised lines into chunks of about chunk_size bytes
+
+    Args:
+        lines (Iterable[str]): The serialised records
+        chunk_size (int): The minimum size of a chunk, but the last one
+
+    Returns:
+        Iterator[bytes]: The UTF-8 encoded chunks
+    """
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compress a stream of chunks as a single gzip member"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,58 @@
+from collections import deque
+
+from central_config import UPLOAD_QUEUE_URL
+
+from .aws import get_boto_client
+from .logger import log
+from .pydant_model import UploadJob
+
+
+class SQSJobQueue:
+    """Send the upload jobs to the SQS queue consumed by the worker Lambda"""
+
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+
+    def send(self, job: UploadJob) -> None:
+        """Enqueue an upload job
+
+        Args:
+            job (UploadJob): The job to enqueue
+        """
+        client = get_boto_client("sqs")
+        client.send_message(QueueUrl=self.queue_url, MessageBody=job.model_dump_json())
+        log.info(f"Upload job {job.report_id} is queued.")
+
+
+class LocalJobQueue:
+    """In-process stand-in of the SQS queue, used locally and in the tests"""
+
+    def __init__(self):
+        self.jobs = deque()
+
+    def send(self, job: UploadJob) -> None:
+        """Enqueue an upload job
+
+        Args:
+            job (UploadJob): The job to enqueue
+        """
+        self.jobs.append(job)
+
+    def process(self, handler) -> None:
+        """Run the handler on every queued job, in order
+
+        Args:
+            handler (callable): The function processing a job
+        """
+        while self.jobs:
+            handler(self.jobs.popleft())
+
+
+_local_job_queue = LocalJobQueue()
+
+
+def get_job_queue():
+    """Get the upload job queue, SQS when a queue URL is configured"""
+    if UPLOAD_QUEUE_URL:
+        return SQSJobQueue(UPLOAD_QUEUE_URL)
+    return _local_job_queue
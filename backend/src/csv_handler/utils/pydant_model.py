@@ -1,5 +1,6 @@
 import re
 from datetime import datetime, date
+from functools import lru_cache
 from typing import Any, Dict, Literal, List, Optional
 from os import getenv
 from pydantic import BaseModel, Field, field_validator, model_validator
@@ -7,6 +8,15 @@ from pydantic import ValidationError
 from pydantic_core import ErrorDetails
 from utils.constants import ACCEPTED_APPLICATION_TYPES
 
+REGISTRATION_NUMBER_PATTERN = re.compile(r"[a-zA-Z0-9]+/[a-zA-Z0-9]+")
+ROUTE_NUMBER_INVALID_CHARACTERS = re.compile(r"[_\-/.,]")
+
+
+@lru_cache(maxsize=4096)
+def parse_csv_date(value: str) -> date:
+    """Parse a dd/mm/yyyy date, uploads repeat the same few dates on many rows"""
+    return datetime.strptime(value, "%d/%m/%Y").date()
+
 
 class Registration(BaseModel):
     licence_number: str = Field(
@@ -94,28 +104,26 @@ class Registration(BaseModel):
 
     @field_validator("received_date", "granted_date", "effective_date", mode="before")
     def parse_date(cls, v):
-        return datetime.strptime(v, "%d/%m/%Y")
-    
+        return parse_csv_date(v)
+
     @field_validator("end_date", mode="before")
     def parse_end_date(cls, v):
         if v != "":
-            return datetime.strptime(v, "%d/%m/%Y")
+            return parse_csv_date(v)
         return None
 
     @field_validator("registration_number")
     def validate_registration_number(cls, v):
         """Validate the registration number format"""
-        if not re.match(r"[a-zA-Z0-9]+/[a-zA-Z0-9]+", v):
+        if not REGISTRATION_NUMBER_PATTERN.match(v):
             raise ValueError("Invalid registration number format")
         return v
 
     @field_validator("route_number", mode="before")
     def validate_route_number(cls, v):
         # Prevent route number to have _ - / . , characters
-        print("Route number")
-        print(v)
         if v is not None:
-            if re.search(r"[_\-/.,]", v):
+            if ROUTE_NUMBER_INVALID_CHARACTERS.search(v):
                 raise ValueError("invalid characters found in route number, please avoid using any of (_ - / . ,)")
             return v
 
@@ -135,6 +143,7 @@ class LicenceRecord(BaseModel):
     licence_number: str
     licence_details: LicenceDetails | None
     operator_details: OperatorDetails | None
+    error: str | None = None
 
 
 class DBCreds(BaseModel):
@@ -191,8 +200,8 @@ def convert_errors(
 
 
 class SearchQuery(BaseModel):
-    license_number: Optional[str] = (
-        Field(default=None, alias="licenseNumber", pattern=r"^[a-zA-Z0-9]+$"),
+    license_number: Optional[str] = Field(
+        default=None, alias="licenseNumber", pattern=r"^[a-zA-Z0-9]+$"
     )
     registration_number: Optional[str] = Field(
         default=None, alias="registrationNumber", pattern=r"^[a-zA-Z0-9//]+$"
@@ -209,6 +218,7 @@ class SearchQuery(BaseModel):
     )
     page: Optional[int] = Field(default=None)
     active_only: Optional[bool] = Field(default=False, alias="activeOnly")
+    cursor: Optional[str] = Field(default=None)
 
     @field_validator("exclude_variations", "active_only", "strict_mode", mode="before")
     def validate_latest_only(cls, v):
@@ -256,10 +266,11 @@ class AuthenticatedEntity(BaseModel):
     group: str = None
 
 
-class StagedRecord(BaseModel):
-    registration_number: str
-    licence_number: str
-    operator_name: str
+class UploadJob(BaseModel):
+    report_id: str
+    stage_id: int
+    user_name: str
+    group_name: str
 
 
 class GroupedStagedRecords(BaseModel):
@@ -1,50 +1,203 @@
+from collections import Counter
+from datetime import datetime, timezone
+from central_config import OTC_LICENCE_CACHE_TTL, OTC_LICENCE_NEGATIVE_CACHE_TTL
 from .custom_exception import LicenceDetailsError
 from .pydant_model import LicenceRecord
 
 from .logger import log
 from .api import verify_otc_api
+from .db import fetch_cached_licences, store_cached_licences
 
+# Lookups of the licence cache since the container started
+licence_cache_metrics = Counter()
 
-# get licenceRecord that has licence_number x001
-def licence_detail(licence_number, licence_details):
-    return next(
-        (
-            record
-            for record in licence_details
-            if record.licence_number == licence_number
-        ),
-        None,
+# Error of the licences missing from the response of the OTC API
+LOOKUP_FAILED_ERROR = "lookup_failed"
+
+
+def index_licence_details(otc_api_response: dict) -> dict:
+    """Parse the licences returned by the OTC API once and index them by licence number
+
+    Args:
+        otc_api_response (dict): Response of the OTC API
+
+    Returns:
+        dict: LicenceRecord keyed by licence number, the licences the OTC API
+            could not fetch have their error set
+    """
+    licence_index = {}
+    for record in (otc_api_response or {}).get("licences", []):
+        # A malformed licence is skipped, the others are still indexed
+        try:
+            licence = LicenceRecord(**record)
+        except Exception as e:
+            log.error(f"Error: {e}")
+            continue
+        if licence.error is not None:
+            log.warning(
+                f"Licence {licence.licence_number} could not be fetched from OTC: {licence.error}"
+            )
+        licence_index.setdefault(licence.licence_number, licence)
+    return licence_index
+
+
+def _lookup_failed(licence_number: str) -> LicenceRecord:
+    return LicenceRecord(
+        licence_number=licence_number,
+        licence_details=None,
+        operator_details=None,
+        error=LOOKUP_FAILED_ERROR,
     )
 
 
-def validate_licence_number_existence(uploaded_records: dict):
+def _is_found(licence: LicenceRecord | None) -> bool:
+    return (
+        licence is not None
+        and licence.licence_details is not None
+        and licence.operator_details is not None
+    )
+
+
+def _cached_licence_record(entry: dict) -> LicenceRecord | None:
+    if not entry["found"]:
+        return None
+    return LicenceRecord(
+        licence_number=entry["licence_number"],
+        licence_details={
+            "licence_number": entry["otc_licence_number"],
+            "licence_status": entry["licence_status"],
+        },
+        operator_details={"operator_name": entry["operator_name"]},
+    )
+
+
+def _licence_cache_entry(
+    licence_number: str, licence: LicenceRecord | None, fetched_at: datetime
+) -> dict:
+    found = _is_found(licence)
+    return {
+        "licence_number": licence_number,
+        "otc_licence_number": licence.licence_details.licence_number if found else None,
+        "licence_status": licence.licence_details.licence_status if found else None,
+        "operator_name": licence.operator_details.operator_name if found else None,
+        "found": found,
+        "fetched_at": fetched_at,
+    }
+
+
+def lookup_licences(licence_numbers: set) -> dict:
+    """Get the licences from the licence cache, only the licences which are not
+    cached or whose entry is older than its TTL are requested from the OTC API,
+    and written back to the cache. Licences not found on the OTC API are cached
+    too, for OTC_LICENCE_NEGATIVE_CACHE_TTL.
+
+    Args:
+        licence_numbers (set): The licence numbers
+
+    Returns:
+        dict: The LicenceRecord of each licence number, None if it is not found.
+            The LicenceRecord of a licence the OTC API could not fetch, e.g.
+            when it was rate limited or unavailable, has its error set.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    try:
+        cached_licences = fetch_cached_licences(licence_numbers)
+    except Exception as e:
+        log.error(f"Error: {e}")
+        cached_licences = {}
+
+    metrics = Counter()
+    licences = {}
+    for licence_number, entry in cached_licences.items():
+        ttl = OTC_LICENCE_CACHE_TTL if entry["found"] else OTC_LICENCE_NEGATIVE_CACHE_TTL
+        if (now - entry["fetched_at"]).total_seconds() >= ttl:
+            metrics["stale"] += 1
+            continue
+        metrics["hits" if entry["found"] else "negative_hits"] += 1
+        licences[licence_number] = _cached_licence_record(entry)
+
+    requested_licence_numbers = licence_numbers - licences.keys()
+    metrics["misses"] = len(requested_licence_numbers) - metrics["stale"]
+    if requested_licence_numbers:
+        returned_licences = index_licence_details(
+            verify_otc_api(requested_licence_numbers)
+        )
+        for licence_number in requested_licence_numbers:
+            # Missing from the response, e.g. when the API failed
+            if licence_number not in returned_licences:
+                returned_licences[licence_number] = _lookup_failed(licence_number)
+            licences[licence_number] = returned_licences[licence_number]
+        # The licences which could not be fetched are not cached
+        entries = [
+            _licence_cache_entry(licence_number, returned_licences[licence_number], now)
+            for licence_number in requested_licence_numbers
+            if returned_licences[licence_number].error is None
+        ]
+        try:
+            store_cached_licences(entries)
+        except Exception as e:
+            log.error(f"Error: {e}")
+
+    licence_cache_metrics.update(metrics)
+    log.info(
+        f"OTC licence cache: {metrics['hits']} hits, {metrics['negative_hits']} negative hits, "
+        f"{metrics['misses']} misses, {metrics['stale']} stale"
+    )
+    return licences
+
+
+# Get the LicenceRecord of a licence number, e.g. x001
+def licence_detail(licence_number, licence_index):
+    return licence_index.get(licence_number)
+
+
+def validate_licence_number_existence(uploaded_records: dict, licence_index=None):
     """
     This function takes a list of licence numbers and checks if they exist in the database.
+    The records whose licence could not be looked up on the OTC API are reported
+    apart, as they may be valid.
 
     Args:
         uploaded_records (dict): A dictionary containing the records to be validated.
+        licence_index (dict, optional): The licences of the earlier batches of the upload,
+            only the other licences are looked up and the index is updated with them.
 
     Returns:
         [list]: A list of dictionaries containing the details of the licences.
     """
-    # Collect all the licence numbers from the records
+    # Collect the licence numbers of the records which are not known yet
     validated_records = uploaded_records["valid_records"]
-    otc_api_response = verify_otc_api(validated_records)
-
-    try:
-        licence_details = [
-            LicenceRecord(**record) for record in otc_api_response["licences"]
-        ]
-
-    except Exception as e:
-        log.error(f"Error: {e}")
+    if licence_index is None:
+        licence_index = {}
+    unknown_licence_numbers = {
+        record.licence_number
+        for record in validated_records.values()
+        if record.licence_number not in licence_index
+    }
+    failed_licences = {}
+    if unknown_licence_numbers:
+        for licence_number, licence in lookup_licences(unknown_licence_numbers).items():
+            if licence is not None and licence.error is not None:
+                # Looked up again by the next batches
+                failed_licences[licence_number] = licence
+            else:
+                # Licences not found are kept as None, not to be looked up again
+                licence_index[licence_number] = licence
 
     valid_records = {}
     invalid_records = {}
+    lookup_failed_records = {}
     for idx, record in uploaded_records["valid_records"].items():
         try:
+            if record.licence_number in failed_licences:
+                lookup_failed_records[idx] = [
+                    {
+                        "LicenceNumber": "Licence number could not be checked in the OTC DB, please retry"
+                    }
+                ]
+                continue
             # Get licence details
-            licence = licence_detail(record.licence_number, licence_details)
+            licence = licence_detail(record.licence_number, licence_index)
             if (
                 licence is None
                 or licence.licence_details is None
@@ -69,3 +222,10 @@ def validate_licence_number_existence(uploaded_records: dict):
                 "description": "Warning - Record failed due to OTC validation",
             }
         )
+    if len(lookup_failed_records) > 0:
+        uploaded_records["invalid_records"].append(
+            {
+                "records": lookup_failed_records,
+                "description": "OTC lookup failed, retry",
+            }
+        )
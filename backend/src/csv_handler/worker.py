@@ -0,0 +1,25 @@
+from managers import process_upload_job
+from utils.logger import log
+from utils.pydant_model import UploadJob
+
+
+def lambda_handler(event, context):
+    """Process the upload jobs delivered by the SQS queue.
+
+    Args:
+        event (dict): The SQS event
+        context (LambdaContext): The Lambda context
+
+    Returns:
+        dict: The message IDs of the jobs to retry
+    """
+    failures = []
+    for record in event.get("Records", []):
+        try:
+            job = UploadJob.model_validate_json(record["body"])
+            log.info(f"Processing upload job {job.report_id}.")
+            process_upload_job(job)
+        except Exception as e:
+            log.error(f"Error: {e}")
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}
@@ -1,14 +1,21 @@
+import json
+import logging
+import urllib.parse
+from collections import Counter
 from csv import DictReader
-from io import BytesIO, TextIOWrapper
+from hashlib import sha256
+from http import HTTPStatus
+from io import TextIOWrapper
 from os import getenv
-from pydantic import BaseModel, Field, field_validator, AliasChoices
-from requests import get, Response
-from sqlalchemy import create_engine, Column, String, Boolean, Integer, text
-from sqlalchemy.orm import declarative_base, Session
+from tempfile import TemporaryFile
+from typing import Iterable, Iterator, Tuple
 from zipfile import ZipFile
+
 import boto3
-import logging
-import urllib.parse
+from pydantic import AliasChoices, BaseModel, Field, field_validator
+from requests import get
+from sqlalchemy import Boolean, Column, Integer, String, create_engine, text
+from sqlalchemy.orm import Session, declarative_base
 
 logging.basicConfig(format="%(levelname)s,%(message)s")
 logger = logging.getLogger(__name__)
@@ -18,6 +25,26 @@ ENVIRONMENT = getenv("PROJECT_ENV", "local")
 DATA_CATALOGUE_URL = getenv(
     "DATA_CATALOGUE_URL", "https://data.bus-data.dft.gov.uk/catalogue/"
 )
+# The catalogue is downloaded to a temporary file in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Timeout of the connection to BODS and between two chunks, in seconds
+DOWNLOAD_TIMEOUT = 60
+# "incremental" applies only the changed rows, "full" reloads the whole catalogue
+FULL_REFRESH = "full"
+INCREMENTAL_REFRESH = "incremental"
+DATA_CATALOGUE_REFRESH_MODE = getenv("DATA_CATALOGUE_REFRESH_MODE", INCREMENTAL_REFRESH)
+
+CATALOGUE_TABLE = "bods_data_catalogue"
+# The catalogue is loaded in this table, then swapped with the catalogue table
+STAGING_TABLE = f"{CATALOGUE_TABLE}_staging"
+CATALOGUE_COLUMNS = [
+    "xml_service_code",
+    "variation_number",
+    "service_type_description",
+    "published_status",
+    "timeliness_status",
+    "requires_attention",
+]
 
 Base = declarative_base()
 
@@ -31,6 +58,7 @@ class DBCatalogueEntry(Base):
     published_status = Column(String)
     timeliness_status = Column(String)
     requires_attention = Column(Boolean)
+    row_hash = Column(String)
 
 
 class CatalogueEntry(BaseModel):
@@ -91,6 +119,84 @@ class CatalogueEntry(BaseModel):
                 )
 
 
+def iter_catalogue_entries(csv_file) -> Iterator[CatalogueEntry]:
+    """Validate the rows of the catalogue CSV one at a time
+
+    Args:
+        csv_file: Text file-like object of the catalogue CSV
+
+    Raises:
+        ValueError: If a row is invalid, with its line number
+
+    Returns:
+        Iterator[CatalogueEntry]: The validated rows
+    """
+    for line_number, row in enumerate(DictReader(csv_file), start=2):
+        try:
+            yield CatalogueEntry(**row)
+        except ValueError as e:
+            raise ValueError(f"Invalid catalogue row at line {line_number}: {e}")
+
+
+def iter_hashed_entries(
+    entries: Iterable[CatalogueEntry],
+) -> Iterator[Tuple[CatalogueEntry, str]]:
+    """Hash the catalogue rows, identical rows are told apart by their occurrence
+    so every row of the catalogue has a distinct hash
+
+    Returns:
+        Iterator[Tuple[CatalogueEntry, str]]: The rows and their hash
+    """
+    occurrences = Counter()
+    for entry in entries:
+        values = json.dumps([getattr(entry, column) for column in CATALOGUE_COLUMNS])
+        occurrences[values] += 1
+        yield (
+            entry,
+            sha256(f"{values}{occurrences[values]}".encode("utf-8")).hexdigest(),
+        )
+
+
+def copy_field(value) -> str:
+    """Serialise a value as a field of COPY ... (format csv)
+
+    An unquoted empty field is loaded as NULL and a quoted one as an empty
+    string, so None is left empty and the strings are always quoted.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+class CopyStream:
+    """File-like object serialising the catalogue entries and their hash as CSV
+    for COPY FROM STDIN as it is read, so the catalogue is never held in memory
+    """
+
+    def __init__(self, entries: Iterable[Tuple[CatalogueEntry, str]]):
+        self._entries = iter(entries)
+        self._pending = ""
+        self.count = 0
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._pending) < size:
+            hashed_entry = next(self._entries, None)
+            if hashed_entry is None:
+                break
+            entry, row_hash = hashed_entry
+            values = [getattr(entry, column) for column in CATALOGUE_COLUMNS]
+            self._pending += (
+                ",".join(copy_field(value) for value in values + [row_hash]) + "\n"
+            )
+            self.count += 1
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
 class TimetableData:
     def __init__(self):
         self.engine = None
@@ -205,54 +311,323 @@ class TimetableData:
             logger.error(f"An error occurred while generating the IAM auth token: {e}")
             return None
 
-    def refresh(self):
+    def refresh(self, mode: str = None) -> dict:
+        """Refresh the catalogue from BODS
+
+        Args:
+            mode (str): FULL_REFRESH or INCREMENTAL_REFRESH, DATA_CATALOGUE_REFRESH_MODE by default
+
+        Returns:
+            dict: Summary of the changes
+        """
         url: str = DATA_CATALOGUE_URL
+        mode = mode or DATA_CATALOGUE_REFRESH_MODE
+        # A full reload downloads the catalogue even if it has not changed
+        validators = {} if mode == FULL_REFRESH else self._get_validators(url)
 
-        try:
-            logger.info(f"Attempting to connect to BODS Data Catalogue at {url}")
-            req: Response = get(url)
+        with TemporaryFile() as zip_file:
+            try:
+                logger.info(f"Attempting to connect to BODS Data Catalogue at {url}")
+                validators = self._download(url, validators, zip_file)
+            except Exception as error:
+                logger.error(f"An error occured: {error}")
+                raise error
+            if validators is None:
+                logger.info(
+                    "BODS Data Catalogue has not changed since the last refresh"
+                )
+                return {"mode": mode, "not_modified": True}
+
+            try:
+                logger.info("Attempting to consume BODS Data Catalogue from zip files")
+                with ZipFile(zip_file) as zipfile:
+                    with zipfile.open("timetables_data_catalogue.csv") as myfile:
+                        entries = iter_hashed_entries(
+                            iter_catalogue_entries(TextIOWrapper(myfile))
+                        )
+                        summary = self._write(url, mode, validators, entries)
+                logger.info(
+                    "Refreshed BODS Data Catalogue successfully. Summary: "
+                    + json.dumps(
+                        {k: v for k, v in summary.items() if k != "service_codes"}
+                    )
+                )
+                return summary
+
+            except Exception as error:
+                logger.error(f"An error occured: {error}")
+                raise error
+
+    def _get_validators(self, url: str) -> dict:
+        """ETag and Last-Modified of the catalogue at its last refresh"""
+        with Session(self.engine) as session:
+            row = (
+                session.execute(
+                    text(
+                        "select etag, last_modified from bods_data_catalogue_source "
+                        "where url = :url"
+                    ),
+                    {"url": url},
+                )
+                .mappings()
+                .first()
+            )
+            return dict(row) if row else {}
+
+    def _download(self, url: str, validators: dict, zip_file) -> dict | None:
+        """Download the catalogue to a file in chunks, unless it has not been
+        modified since it was downloaded with these validators
+
+        Args:
+            url (str): URL of the catalogue
+            validators (dict): ETag and Last-Modified of the last download
+            zip_file: Binary file the catalogue is written to
+
+        Returns:
+            dict: ETag and Last-Modified of the catalogue, None if it was not modified
+        """
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        with get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as req:
             req.raise_for_status()
             logger.debug(f"Received reponse: {req.status_code}")
-        except Exception as error:
-            logger.error(f"An error occured: {error}")
-            raise error
+            if req.status_code == HTTPStatus.NOT_MODIFIED:
+                return None
+            for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                zip_file.write(chunk)
+            zip_file.seek(0)
+            return {
+                "etag": req.headers.get("ETag"),
+                "last_modified": req.headers.get("Last-Modified"),
+            }
+
+    def _write(
+        self,
+        url: str,
+        mode: str,
+        validators: dict,
+        entries: Iterable[Tuple[CatalogueEntry, str]],
+    ) -> dict:
+        """Write the catalogue and its validators in a single transaction"""
+        with Session(self.engine) as session:
+            try:
+                if mode == FULL_REFRESH:
+                    summary = self._load(session, entries)
+                else:
+                    summary = self._apply_changes(session, entries)
+                self._invalidate_licence_status_summaries(
+                    session, summary.get("service_codes")
+                )
+                session.execute(
+                    text(
+                        "insert into bods_data_catalogue_source "
+                        "(url, etag, last_modified, refreshed_at) "
+                        "values (:url, :etag, :last_modified, current_timestamp) "
+                        "on conflict (url) do update set etag = excluded.etag, "
+                        "last_modified = excluded.last_modified, "
+                        "refreshed_at = excluded.refreshed_at"
+                    ),
+                    {"url": url, **validators},
+                )
+                logger.info("Attempting to write new data to the database")
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise e
+        return summary
+
+    def _invalidate_licence_status_summaries(
+        self, session: Session, service_codes: list = None
+    ):
+        """The licence status summaries count the registrations requiring
+        attention, they are recomputed on their next read. Only the groups with
+        registrations of the changed services are invalidated, all of them if
+        the changed services are not known.
+        """
+        if service_codes is None:
+            logger.info("Invalidating the licence status summaries")
+            session.execute(
+                text("update pdbrd_group set licence_status_refreshed_at = null")
+            )
+        elif service_codes:
+            logger.info(
+                "Invalidating the licence status summaries of the changed services"
+            )
+            session.execute(
+                text(
+                    "update pdbrd_group set licence_status_refreshed_at = null "
+                    "where id in (select group_id from pdbrd_registration "
+                    "where registration_number = any(:service_codes))"
+                ),
+                {"service_codes": service_codes},
+            )
 
-        try:
-            logger.info("Attempting to consume BODS Data Catalogue from zip files")
-            with ZipFile(BytesIO(req.content)) as zipfile:
-                with zipfile.open("timetables_data_catalogue.csv") as myfile:
-                    csv_reader: DictReader = DictReader(TextIOWrapper(myfile))
-                    csv_data: list = [row for row in csv_reader]
-                    logger.debug(f"Rows in CSV: {len(csv_data)}")
-                    validated_data: list = [CatalogueEntry(**row) for row in csv_data]
-                    # logger.debug(f"Validated data: {validated_data}")
-                    logger.info(
-                        f"Validated data successfully. Count: {len(validated_data)}"
-                    )
-                    with Session(self.engine) as session:
-                        logger.info("Deleting existing data in database")
-                        session.execute(
-                            text("alter sequence bods_data_catalogue_id_seq restart")
-                        )
-                        session.query(DBCatalogueEntry).delete()
-                        for row in validated_data:
-                            session.add(DBCatalogueEntry(**row.model_dump()))
-                        try:
-                            logger.info("Attempting to write new data to the database")
-                            session.commit()
-                        except Exception as e:
-                            session.rollback()
-                            raise e
+    def _apply_changes(
+        self, session: Session, entries: Iterable[Tuple[CatalogueEntry, str]]
+    ) -> dict:
+        """Apply only the rows added to and removed from the catalogue since the
+        last refresh, compared by their hash: the new rows are copied into the
+        catalogue table and the rows missing from the catalogue are deleted. A
+        service whose rows were both added and removed is updated.
+
+        Args:
+            session (Session): The session of the refresh transaction
+            entries (Iterable[Tuple[CatalogueEntry, str]]): The validated rows and their hash
+
+        Returns:
+            dict: The number of services inserted, updated, deleted and unchanged,
+                and the service codes changed
+        """
+        # Concurrent refreshes are serialised, readers are not blocked
+        session.execute(
+            text(f"lock table {CATALOGUE_TABLE} in share row exclusive mode")
+        )
+        stored_rows = {}
+        for id, row_hash, service_code, variation_number in session.execute(
+            text(
+                "select id, row_hash, xml_service_code, variation_number "
+                f"from {CATALOGUE_TABLE}"
+            )
+        ).all():
+            # Rows loaded before the rows were hashed are keyed by their id,
+            # which no new row matches, so they are replaced
+            stored_rows[row_hash or id] = (id, (service_code, variation_number))
+
+        seen_hashes = set()
+        services = set()
+        inserted_services = set()
+
+        def new_entries():
+            for entry, row_hash in entries:
+                key = (entry.xml_service_code, entry.variation_number)
+                seen_hashes.add(row_hash)
+                services.add(key)
+                if row_hash not in stored_rows:
+                    inserted_services.add(key)
+                    yield entry, row_hash
+
+        logger.info("Copying the new rows into the BODS Data Catalogue")
+        stream = CopyStream(new_entries())
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"copy {CATALOGUE_TABLE} ({', '.join(CATALOGUE_COLUMNS)}, row_hash) "
+            "from stdin with (format csv)",
+            stream,
+        )
+
+        deleted_ids = []
+        deleted_services = set()
+        for row_hash, (id, key) in stored_rows.items():
+            if row_hash not in seen_hashes:
+                deleted_ids.append(id)
+                deleted_services.add(key)
+        if deleted_ids:
+            logger.info("Deleting the removed rows from the BODS Data Catalogue")
+            session.execute(
+                text(f"delete from {CATALOGUE_TABLE} where id = any(:ids)"),
+                {"ids": deleted_ids},
+            )
 
-            return csv_data
+        changed_services = inserted_services | deleted_services
+        return {
+            "mode": INCREMENTAL_REFRESH,
+            "rows": len(seen_hashes),
+            "rows_inserted": stream.count,
+            "rows_deleted": len(deleted_ids),
+            "inserted": len(inserted_services - deleted_services),
+            "updated": len(inserted_services & deleted_services),
+            "deleted": len(deleted_services - inserted_services),
+            "unchanged": len(services - changed_services),
+            "service_codes": sorted({code for code, _ in changed_services}),
+        }
+
+    def _load(
+        self, session: Session, entries: Iterable[Tuple[CatalogueEntry, str]]
+    ) -> dict:
+        """Load the catalogue into a staging table with COPY, then swap it with
+        the catalogue table. Readers keep reading the previous catalogue until
+        the transaction is committed, the catalogue table is only locked by the
+        swap.
+
+        Args:
+            session (Session): The session of the refresh transaction
+            entries (Iterable[Tuple[CatalogueEntry, str]]): The validated rows and their hash
 
-        except Exception as error:
-            logger.error(f"An error occured: {error}")
-            raise error
+        Returns:
+            dict: The number of rows loaded
+        """
+        logger.info("Loading the BODS Data Catalogue into the staging table")
+        session.execute(text(f"drop table if exists {STAGING_TABLE}"))
+        session.execute(
+            text(
+                f"create table {STAGING_TABLE} "
+                f"(like {CATALOGUE_TABLE} including defaults including constraints)"
+            )
+        )
+        session.execute(text(f"alter sequence {CATALOGUE_TABLE}_id_seq restart"))
+        stream = CopyStream(entries)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"copy {STAGING_TABLE} ({', '.join(CATALOGUE_COLUMNS)}, row_hash) "
+            "from stdin with (format csv)",
+            stream,
+        )
+
+        # The indexes are built once the rows are loaded, named after the
+        # indexes of the catalogue table they replace
+        indexes = session.execute(
+            text(
+                "select indexname, indexdef from pg_indexes "
+                "where schemaname = current_schema() "
+                "and tablename = :table and indexname <> :pkey"
+            ),
+            {"table": CATALOGUE_TABLE, "pkey": f"{CATALOGUE_TABLE}_pkey"},
+        ).all()
+        session.execute(
+            text(
+                f"alter table {STAGING_TABLE} "
+                f"add constraint {STAGING_TABLE}_pkey primary key (id)"
+            )
+        )
+        for name, definition in indexes:
+            session.execute(
+                text(
+                    definition.replace(
+                        f" INDEX {name} ON ", f" INDEX {name}_staging ON ", 1
+                    ).replace(f".{CATALOGUE_TABLE} ", f".{STAGING_TABLE} ", 1)
+                )
+            )
+
+        logger.info("Swapping the staging table with the BODS Data Catalogue")
+        session.execute(text(f"lock table {CATALOGUE_TABLE} in access exclusive mode"))
+        session.execute(
+            text(f"alter table {CATALOGUE_TABLE} rename to {CATALOGUE_TABLE}_previous")
+        )
+        session.execute(
+            text(f"alter table {STAGING_TABLE} rename to {CATALOGUE_TABLE}")
+        )
+        session.execute(
+            text(
+                f"alter sequence {CATALOGUE_TABLE}_id_seq owned by {CATALOGUE_TABLE}.id"
+            )
+        )
+        session.execute(text(f"drop table {CATALOGUE_TABLE}_previous"))
+        session.execute(
+            text(f"alter index {STAGING_TABLE}_pkey rename to {CATALOGUE_TABLE}_pkey")
+        )
+        for name, _ in indexes:
+            session.execute(text(f"alter index {name}_staging rename to {name}"))
+        return {"mode": FULL_REFRESH, "rows": stream.count}
 
 
 def lambda_handler(event, context):
     logger.info("Starting BODS Data Catalogue refresh")
     data = TimetableData()
-    data.refresh()
+    # A full reload can be requested with {"mode": "full"}
+    mode = event.get("mode") if isinstance(event, dict) else None
+    summary = data.refresh(mode)
     logger.info("BODS Data Catalogue refresh successfully completed")
+    return summary
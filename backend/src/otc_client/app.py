@@ -1,9 +1,13 @@
+import random
 import requests
+import threading
+import time
 from cachetools import TTLCache
 from os import getenv
 from http import HTTPStatus
 from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field, AliasChoices
+from requests.adapters import HTTPAdapter
 import logging
 from utils.aws import get_secret
 from fastapi import FastAPI, HTTPException
@@ -37,6 +41,35 @@ if ENVIRONMENT != "local":
     OTC_API_KEY = get_secret(OTC_API_KEY)
 
 API_RETURN_LIMIT = 100
+# Number of licences requested from the OTC API at the same time,
+# the connection pool of the client holds as many connections
+MAX_WORKERS = int(getenv("OTC_MAX_WORKERS", "20"))
+# Requests per second sent to the OTC API, and how many may be sent at once
+RATE_LIMIT = float(getenv("OTC_RATE_LIMIT", "10"))
+RATE_BURST = int(getenv("OTC_RATE_BURST", str(MAX_WORKERS)))
+# Retries of a licence on throttling, server errors and connection errors
+MAX_RETRIES = int(getenv("OTC_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY = float(getenv("OTC_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(getenv("OTC_RETRY_MAX_DELAY", "8"))
+# Timeout of a request, and of a licence including its retries, in seconds
+REQUEST_TIMEOUT = float(getenv("OTC_REQUEST_TIMEOUT", "10"))
+LICENCE_TIMEOUT = float(getenv("OTC_LICENCE_TIMEOUT", "30"))
+RETRYABLE_STATUS_CODES = {
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
+
+# Error states of the licences which could not be fetched
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_TIMEOUT = "timeout"
+ERROR_UNAVAILABLE = "unavailable"
+ERROR_HTTP = "http_error"
+ERROR_MALFORMED_RESPONSE = "malformed_response"
+# The token is refreshed this long before it expires, in seconds
+TOKEN_REFRESH_MARGIN = 60 * 5
 
 logging.basicConfig(format="%(levelname)s,%(message)s")
 logger = logging.getLogger(__name__)
@@ -70,21 +103,26 @@ class OTCAuthenticator:
     }
     """
 
-    def __init__(self):
-        logger.debug("Initialising authenticator and getting initial token")
+    def __init__(self, session: requests.Session = None):
+        logger.debug("Initialising authenticator")
+        self.session = session or requests.Session()
         self.cache = TTLCache(maxsize=1, ttl=3600)
-        self.get_token()
+        self._lock = threading.Lock()
 
     @property
     def token(self) -> str:
         """
-        Fetch bearer token from Cache (Redis) or send request to generate new token.
+        Fetch bearer token from Cache or send request to generate new token.
+        The token is fetched once for the threads requesting it at the same time.
         """
         cache_hit = self.cache.get("otc-auth-bearer", None)
-        if cache_hit is None:
-            logger.debug("API Token cache has expired")
-            return self.get_token()
-        else:
+        if cache_hit is not None:
+            return cache_hit
+        with self._lock:
+            cache_hit = self.cache.get("otc-auth-bearer", None)
+            if cache_hit is None:
+                logger.debug("API Token cache has expired")
+                return self.get_token()
             return cache_hit
 
     def get_token(self) -> str:
@@ -107,7 +145,7 @@ class OTCAuthenticator:
         }
         response = None
         try:
-            response = requests.post(url=url, headers=headers, data=body)
+            response = self.session.post(url=url, headers=headers, data=body)
             response.raise_for_status()
         except requests.exceptions.HTTPError as err:
             msg = f"Couldn't fetch Authorization token. {err}"
@@ -119,18 +157,80 @@ class OTCAuthenticator:
 
         auth_response = response.json()
 
-        token_cache_timeout = auth_response["expires_in"] - 60 * 5
+        token_cache_timeout = max(auth_response["expires_in"] - TOKEN_REFRESH_MARGIN, 0)
         self.cache = TTLCache(maxsize=1, ttl=token_cache_timeout)
         self.cache["otc-auth-bearer"] = auth_response["access_token"]
         logger.debug(f"Token cache set with timeout {token_cache_timeout}")
         return auth_response["access_token"]
 
 
+class TokenBucket:
+    """Rate limiter shared by the workers, a request takes a token and the
+    tokens are refilled at a constant rate up to the capacity
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float = None) -> bool:
+        """Wait for a token
+
+        Args:
+            deadline (float): time.monotonic() after which to give up waiting
+
+        Returns:
+            bool: Whether a token was taken before the deadline
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    """Delay before retrying a request, the Retry-After header of the response
+    if any, otherwise an exponential backoff with full jitter
+    """
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+def create_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    """Create a HTTP session keeping a connection per worker open to the OTC API
+    and Microsoft login
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 class OTCAPIClient:
-    def __init__(self):
-        self.otc_auth = OTCAuthenticator()
+    def __init__(self, session: requests.Session = None):
+        self.session = session or create_session()
+        self.otc_auth = OTCAuthenticator(self.session)
+        self.rate_limiter = TokenBucket(RATE_LIMIT, RATE_BURST)
 
-    def _request(self, timeout: int = 30, **kwargs) -> str:
+    def _request(self, timeout: float = REQUEST_TIMEOUT, **kwargs) -> str:
         headers = {
             "x-api-key": OTC_API_KEY,
             "Authorization": f"{self.otc_auth.token}",
@@ -138,7 +238,7 @@ class OTCAPIClient:
         defaults = {"limit": API_RETURN_LIMIT, "page": 1}
         params = {**defaults, **kwargs}
         try:
-            response = requests.get(
+            response = self.session.get(
                 url=OTC_API_URL,
                 headers=headers,
                 params=params,
@@ -163,17 +263,58 @@ class OTCAPIClient:
         return response.json()
 
     def _get_licence(self, licence_number):
+        """Get a licence from the OTC API, retrying throttled and failed requests
+        until MAX_RETRIES or LICENCE_TIMEOUT is reached
+
+        Returns:
+            tuple: The licence number, the OTC API response (None if the licence
+                is not found or could not be fetched) and the error state
+        """
         logger.debug(f"Attempting to get licence {licence_number} from OTC")
-        try:
-            return licence_number, self._request(
-                identifier=licence_number, limit=1, page=1, latestVariation="true"
-            )
-        except OTCLicenceNotFound:
-            return licence_number, None
-        except Exception as e:
-            msg = f"Could not get license {licence_number}: {e}"
-            logger.error(msg)
-            raise
+        deadline = time.monotonic() + LICENCE_TIMEOUT
+        error = ERROR_TIMEOUT
+        for attempt in range(MAX_RETRIES + 1):
+            if not self.rate_limiter.acquire(deadline):
+                error = ERROR_TIMEOUT
+                break
+            retry_after = None
+            try:
+                returned_licence = self._request(
+                    timeout=min(REQUEST_TIMEOUT, max(deadline - time.monotonic(), 0.1)),
+                    identifier=licence_number,
+                    limit=1,
+                    page=1,
+                    latestVariation="true",
+                )
+                return licence_number, returned_licence, None
+            except OTCLicenceNotFound:
+                return licence_number, None, None
+            except requests.HTTPError as e:
+                status_code = e.response.status_code if e.response is not None else None
+                if status_code not in RETRYABLE_STATUS_CODES:
+                    logger.error(f"Could not get license {licence_number}: {e}")
+                    return licence_number, None, ERROR_HTTP
+                error = (
+                    ERROR_RATE_LIMITED
+                    if status_code == HTTPStatus.TOO_MANY_REQUESTS
+                    else ERROR_UNAVAILABLE
+                )
+                retry_after = e.response.headers.get("Retry-After")
+            except requests.Timeout:
+                error = ERROR_TIMEOUT
+            except requests.RequestException as e:
+                logger.error(f"Could not get license {licence_number}: {e}")
+                error = ERROR_UNAVAILABLE
+            if attempt == MAX_RETRIES:
+                break
+            delay = retry_delay(attempt, retry_after)
+            if time.monotonic() + delay >= deadline:
+                error = ERROR_TIMEOUT
+                break
+            logger.debug(f"Retrying licence {licence_number} in {delay:.2f}s")
+            time.sleep(delay)
+        logger.error(f"Could not get license {licence_number}: {error}")
+        return licence_number, None, error
 
     def _parse_licence(self, licence_number, returned_licence):
         logger.debug(f"Attempting to parse licence {licence_number} received from OTC")
@@ -216,34 +357,60 @@ class OTCAPIClient:
         )
         # Remove duplicates
         unique_licence_numbers = list(set(licence_numbers))
+        if unique_licence_numbers:
+            # Fail fast, before the fan-out, when no token can be fetched
+            self.otc_auth.token
 
-        # Get licences from OTC API in batches of 20
-        with ThreadPoolExecutor(max_workers=20) as executor:
+        # Get licences from OTC API, MAX_WORKERS at a time within the rate limit
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             returned_licences = list(
                 executor.map(self._get_licence, unique_licence_numbers)
             )
 
-        # Construct response
+        # Construct response, a licence which could not be fetched has an error
         response = {}
         response["licences"] = []
-        for licence_number, returned_licence in returned_licences:
+        for licence_number, returned_licence, error in returned_licences:
             per_licence_response = {}
             per_licence_response["licence_number"] = licence_number
-            if returned_licence is None:
-                per_licence_response["licence_details"] = None
-                per_licence_response["operator_details"] = None
-            else:
-                licence_details, operator_details = self._parse_licence(
-                    licence_number, returned_licence
-                )
-                per_licence_response["licence_details"] = licence_details
-                per_licence_response["operator_details"] = operator_details
+            per_licence_response["licence_details"] = None
+            per_licence_response["operator_details"] = None
+            if returned_licence is not None:
+                try:
+                    licence_details, operator_details = self._parse_licence(
+                        licence_number, returned_licence
+                    )
+                    per_licence_response["licence_details"] = licence_details
+                    per_licence_response["operator_details"] = operator_details
+                except Exception as e:
+                    logger.error(f"Could not parse license {licence_number}: {e}")
+                    error = ERROR_MALFORMED_RESPONSE
+            per_licence_response["error"] = error
             response["licences"].append(per_licence_response)
 
+        failed = sum(1 for licence in response["licences"] if licence["error"])
+        if failed:
+            logger.warning(
+                f"{failed} of {len(unique_licence_numbers)} licences could not be fetched from OTC"
+            )
+
         return response
 
 
-# {licence_number:.....,licence_details:{licence_number:.....,Licence_status:.....},operator_details:{operator_name:.....}}
+# {licence_number:.....,licence_details:{licence_number:.....,Licence_status:.....},operator_details:{operator_name:.....},error:.....}
+
+
+_otc_client = None
+
+
+def get_otc_client() -> OTCAPIClient:
+    """Get the client shared by the invocations of the Lambda container, so its
+    connections and token are reused
+    """
+    global _otc_client
+    if _otc_client is None:
+        _otc_client = OTCAPIClient()
+    return _otc_client
 
 
 app = FastAPI(
@@ -256,12 +423,12 @@ app = FastAPI(
 @app.post("/api/v1/otc/licences")
 async def query_licences(licences: List[str]):
     try:
-        print(licences)
-        client = OTCAPIClient()
+        logger.debug(f"Querying {len(licences)} licences")
+        client = get_otc_client()
         output = client.get_licences(licences)
         return output
     except Exception as e:
-        print(e)
+        logger.error(f"Error: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
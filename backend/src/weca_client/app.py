@@ -1,22 +1,52 @@
-from managers.records_manager import RecordsManager
+from managers.change_capture import ChangeCapture
+from managers.records_manager import RecordsManager, report_duplicate_records
+from utils.db import RecordFingerprints
 from utils.pydant_model import AuthenticatedEntity
-from utils.settings import USER_TYPE, USER_NAME, USER_GROUP
+from utils.settings import USER_TYPE, USER_NAME, USER_GROUP, WECA_CHANGE_CAPTURE
 from utils.weca_api import WecaClient
 
 
-class WecaManager:
-    def __init__(self):
-        api_client = WecaClient()
-        self.api_response = api_client.fetch_weca_services()
-
-
 def lambda_handler(event, context):
     print("WECA API ingestion is running")
     authenticated_entity = AuthenticatedEntity(
         type=USER_TYPE, name=USER_NAME, group=USER_GROUP
     )
-    weca = WecaManager()
-    received_data = weca.api_response.data
-    print("Received data: ", received_data[0])
-    RecordsManager(received_data, authenticated_entity).validation_and_insertion_steps()
-    print("Weca API ingestion has finished running")
+    change_capture = ChangeCapture(
+        RecordFingerprints(USER_GROUP), enabled=WECA_CHANGE_CAPTURE
+    )
+    # The report is validated and inserted batch by batch as it is received,
+    # only the keys of the records and the licences are kept across batches
+    seen_records = {}
+    licence_index = {}
+    received_count = 0
+    for batch in WecaClient().iter_weca_service_batches():
+        print(f"Received records {received_count + 1} to {received_count + len(batch)}")
+        # Unchanged records are dropped before any OTC or database work,
+        # the records keep their number in the report
+        changed_records, pending = change_capture.filter_changed(
+            batch, received_count, seen_records
+        )
+        received_count += len(batch)
+        if not changed_records:
+            continue
+        records_manager = RecordsManager(
+            changed_records,
+            authenticated_entity,
+            seen_records=seen_records,
+            licence_index=licence_index,
+            record_numbers=[record_number for record_number, _, _ in pending],
+        )
+        records_manager.validation_and_insertion_steps()
+        change_capture.store_ingested(pending, records_manager.ingested_records)
+    # Duplicates across batches are only known once the whole report is read
+    duplicated_records = report_duplicate_records(seen_records, USER_GROUP)
+    for idx, errors in duplicated_records["records"].items():
+        print(f"Record {idx}: {errors[0]['']}")
+    summary = change_capture.summary()
+    summary["duplicated"] = len(duplicated_records["records"])
+    print(
+        f"Weca API ingestion has finished running: {summary['new']} new, "
+        f"{summary['changed']} changed, {summary['unchanged']} unchanged records, "
+        f"{summary['ingested']} ingested, {summary['duplicated']} duplicated"
+    )
+    return summary
@@ -0,0 +1,105 @@
+from collections import Counter
+from typing import List, Tuple
+
+from utils.data import record_fingerprint, record_key
+from utils.db import RecordFingerprints
+from utils.logger import log
+
+
+class ChangeCapture:
+    """Drop the WECA records whose content has not changed since they were last
+    ingested, before they are validated, looked up on OTC and inserted
+    """
+
+    def __init__(self, fingerprints: RecordFingerprints, enabled: bool = True):
+        """
+        Args:
+            fingerprints (RecordFingerprints): The fingerprints of the ingested records
+            enabled (bool): Whether unchanged records are dropped, they are only counted otherwise
+        """
+        self.fingerprints = fingerprints
+        self.enabled = enabled
+        self.counts = Counter()
+
+    def filter_changed(
+        self, records: List[dict], start_index: int = 0, seen_records: dict = None
+    ) -> Tuple[List[dict], List]:
+        """Classify the records of a batch as new, changed or unchanged
+
+        Args:
+            records (List[dict]): The records of the batch, as received from the API
+            start_index (int): Number of records received in the earlier batches
+            seen_records (dict): The seen_records of RecordsManager, the unchanged
+                records are added to it so that their duplicates are still reported
+
+        Returns:
+            Tuple[List[dict], List]: The new and changed records, and the
+                (record_number, key, fingerprint) of each of them, the key is None
+                if the record has no valid key
+        """
+        seen_records = {} if seen_records is None else seen_records
+        keyed_records = [(record, record_key(record)) for record in records]
+        try:
+            stored = self.fingerprints.fetch(
+                {key for _, key in keyed_records if key is not None}
+            )
+        except Exception as e:
+            log.error(f"Error: {e}")
+            stored = {}
+
+        changed_records, pending = [], []
+        for position, (record, key) in enumerate(keyed_records):
+            record_number = f"{start_index + position + 2}"
+            fingerprint = record_fingerprint(record)
+            if key is None or key not in stored:
+                # Records without a valid key cannot be compared, they are new
+                self.counts["new"] += 1
+            elif stored[key] != fingerprint:
+                self.counts["changed"] += 1
+            else:
+                self.counts["unchanged"] += 1
+                (
+                    licence_number,
+                    registration_number,
+                    route_number,
+                    variation_number,
+                ) = key
+                duplicate_key = (
+                    licence_number,
+                    variation_number,
+                    registration_number,
+                    route_number,
+                )
+                # A duplicate of an earlier record is validated to be reported
+                if self.enabled and duplicate_key not in seen_records:
+                    seen_records[duplicate_key] = [record_number]
+                    continue
+            changed_records.append(record)
+            pending.append((record_number, key, fingerprint))
+        return changed_records, pending
+
+    def store_ingested(self, pending: List, ingested_records: set):
+        """Store the fingerprints of the records which were ingested, the others
+        are compared again on the next run
+
+        Args:
+            pending (List): The (record_number, key, fingerprint) returned by filter_changed
+            ingested_records (set): The record numbers of the RecordsManager ingested records
+        """
+        fingerprints = {}
+        for record_number, key, fingerprint in pending:
+            if key is not None and record_number in ingested_records:
+                fingerprints[key] = fingerprint
+        self.counts["ingested"] += len(fingerprints)
+        try:
+            self.fingerprints.store(fingerprints)
+        except Exception as e:
+            log.error(f"Error: {e}")
+
+    def summary(self) -> dict:
+        return {
+            "new": self.counts["new"],
+            "changed": self.counts["changed"],
+            "unchanged": self.counts["unchanged"],
+            "ingested": self.counts["ingested"],
+        }
@@ -1,6 +1,5 @@
-from copy import deepcopy
 from pydantic import ValidationError
-from utils.db import send_to_db
+from utils.db import delete_registrations, send_to_db
 from utils.logger import log
 from utils.pydant_model import Registration, AuthenticatedEntity
 from utils.validate import validate_licence_number_existence
@@ -30,7 +29,9 @@ def extract_field_mgs_type_from_errors(errors: [dict]) -> dict:
     return modified_errors
 
 
-def csv_data_structure_check(csv_data: [dict]) -> dict:
+def csv_data_structure_check(
+    csv_data: [dict], start_index: int = 0, record_numbers: [str] = None
+) -> dict:
     """
     This function checks the structure of the CSV data structure and returns a dictionary of valid and invalid records.
     It checks if a record adheres to the structure of the Registration model.
@@ -39,25 +40,31 @@ def csv_data_structure_check(csv_data: [dict]) -> dict:
     2. Invalid records are stored in a validation_errors list along with the record number.
     3. Valid records are stored in a pydantic_models list.
     4. Returns a dictionary of valid and invalid records.
+    The records are numbered from start_index, the number of records of the earlier batches,
+    unless their record_numbers are given.
     """
     # Convert the CSV data into a list of dictionaries
     # csv_data = list(csv.DictReader(file))
     valid_records = {}
     validation_errors = {}
 
-    for idx, data_dict in enumerate(csv_data):
+    if record_numbers is None:
+        record_numbers = [
+            f"{idx + 2}" for idx in range(start_index, start_index + len(csv_data))
+        ]
+    for record_number, data_dict in zip(record_numbers, csv_data):
         try:
             # Validate each record and deserialize it into a Python object.
             pydantic_model = Registration(**data_dict)
             valid_records.update(
-                {f"{idx + 2}": pydantic_model}
+                {record_number: pydantic_model}
             )  # .model_dump(exclude=["serviceCode"])
         except ValidationError as e:
             # Get json schema errors
             errors = e.errors()
             # Extract the field, message and type from the errors of a ValidationError object.
             modified_errors = extract_field_mgs_type_from_errors(errors)
-            validation_errors.update({f"{idx + 2}": modified_errors})
+            validation_errors.update({record_number: modified_errors})
         except Exception as e:
             log.error(f"Error: {e}")
 
@@ -72,17 +79,71 @@ def csv_data_structure_check(csv_data: [dict]) -> dict:
     }
 
 
+def report_duplicate_records(seen_records: dict, group_name: str) -> dict:
+    """Report all the records of the duplicated keys once the whole report is
+    read, the first record of each key is removed from the database
+
+    Args:
+        seen_records (dict): The seen_records of the RecordsManager of each batch
+        group_name (str): The group the records are inserted for
+
+    Returns:
+        dict: The duplicated records, and the description of their errors
+    """
+    duplicated_check_records = {}
+    first_records = set()
+    for key, record_numbers in seen_records.items():
+        if len(record_numbers) < 2:
+            continue
+        for idx in record_numbers:
+            duplicated_records = [idx2 for idx2 in record_numbers if idx2 != idx]
+            duplicated_check_records[idx] = [
+                {"": f"""Duplicate of record {(', ').join(duplicated_records)}"""}
+            ]
+        first_records.add(key)
+    if first_records:
+        delete_registrations(first_records, group_name)
+    return {
+        "records": {
+            idx: duplicated_check_records[idx]
+            for idx in sorted(duplicated_check_records, key=int)
+        },
+        "description": "CSV data structure check",
+    }
+
+
 class RecordsManager:
     def __init__(
         self,
         csv_data: str,
         authenticated_entity: AuthenticatedEntity = None,
         report_id: str = None,
+        start_index: int = 0,
+        seen_records: dict = None,
+        licence_index: dict = None,
+        record_numbers: list = None,
     ):
+        """
+        Args:
+            csv_data: The records, or a batch of the records
+            authenticated_entity (AuthenticatedEntity): The user the records are inserted for
+            report_id (str): ID of the report
+            start_index (int): Number of records of the earlier batches
+            seen_records (dict): Record numbers of the records of the earlier batches
+                keyed by (licence, variation, registration, route), updated with this batch
+            licence_index (dict): Licences of the earlier batches, updated with this batch
+            record_numbers (list): The numbers of the records, when some records
+                of the batch were left out, numbered from start_index otherwise
+        """
         self.csv_data = csv_data
         self.group_name = authenticated_entity.group
         self.user_name = authenticated_entity.name
         self.report_id = report_id
+        self.start_index = start_index
+        self.seen_records = {} if seen_records is None else seen_records
+        self.licence_index = {} if licence_index is None else licence_index
+        self.record_numbers = record_numbers
+        self.ingested_records = set()
 
     def validation_and_insertion_steps(self) -> dict:
         """This function performs the following steps:
@@ -109,64 +170,39 @@ class RecordsManager:
             validated_records["valid_records"]
         )
         log.info(validated_records["valid_records_count"])
+        # Records inserted, or already in the database with the same fields
+        self.ingested_records = set(validated_records["valid_records"])
+        for invalid_records in validated_records["invalid_records"]:
+            if invalid_records["description"] == "Record already exists":
+                self.ingested_records.update(invalid_records["records"])
         del validated_records["valid_records"]
 
         if validated_records["invalid_records"] == {}:
             del validated_records["invalid_records"]
 
     def _validate_csv_data(self):
-        return csv_data_structure_check(self.csv_data)
+        return csv_data_structure_check(
+            self.csv_data, self.start_index, self.record_numbers
+        )
 
     def _check_duplicate_records(self, records):
-        records_copy = deepcopy(records)
-        duplicated_check_records = {}
-        for idx, record in records_copy["valid_records"].items():
-            duplicated_records = []
-            for idx2, records2 in records_copy["valid_records"].items():
-                if (
-                    idx != idx2
-                    and record.licence_number == records2.licence_number
-                    and record.variation_number == records2.variation_number
-                    and record.registration_number == records2.registration_number
-                    and record.route_number == records2.route_number
-                ):
-                    duplicated_records.append(idx2)
-            if duplicated_records:
-                # if records["invalid_records"].get(idx):
-                #     records["invalid_records"][idx].appand(
-                #         {"CSV contains duplicated records": duplicated_records}
-                #     )
-                # else:
-                # records["invalid_records"]["duplicated_records"][idx] = [
-                duplicated_check_records[idx] = [
-                    {"": f"""Duplicate of record {(', ').join(duplicated_records)}"""}
-                ]
-                try:
-                    del records["valid_records"][idx]
-                except KeyError:
-                    pass
-                for i in duplicated_records:
-                    try:
-                        del records["valid_records"][i]
-                    except KeyError:
-                        pass
-        if len(duplicated_check_records) > 0:
-            if records.get("invalid_records") is None:
-                records["invalid_records"] = []
-                validation_description = "CSV data structure check"
-                records["invalid_records"].append(
-                    {
-                        "records": duplicated_check_records,
-                        "description": validation_description,
-                    }
-                )
-            else:
-                data_structure_invalid = records["invalid_records"][0]
-                data_structure_invalid["records"].update(duplicated_check_records)
-                records["invalid_records"][0] = data_structure_invalid
+        # Records with the same (licence, variation, registration, route) as an
+        # earlier record of the report are put aside, and reported once the whole
+        # report is read, by report_duplicate_records
+        for idx, record in list(records["valid_records"].items()):
+            key = (
+                record.licence_number,
+                record.variation_number,
+                record.registration_number,
+                record.route_number,
+            )
+            record_numbers = self.seen_records.setdefault(key, [])
+            record_numbers.append(idx)
+            if len(record_numbers) > 1:
+                del records["valid_records"][idx]
 
     def _check_licence_number_existence(self, records):
-        validate_licence_number_existence(records)
+        validate_licence_number_existence(records, self.licence_index)
 
     def _send_to_db(self, records, group_name, user_name):
         send_to_db(records, group_name=group_name, user_name=user_name)
@@ -1,6 +1,31 @@
+import hashlib
+import json
+
+
 def common_keys_comparsion(dict1, dict2):
     common_keys = dict1.keys() & dict2.keys()
     for key in common_keys:
         if dict1[key] != dict2[key]:
             return False
     return True
+
+
+def record_key(record: dict) -> tuple | None:
+    """Key of a WECA record: (licence_number, registration_number, route_number,
+    variation_number), None if the record has no valid key
+    """
+    try:
+        return (
+            str(record["operatorlicence_istervices"]),
+            str(record["serialnum_ervi"]),
+            str(record["servicenumbers_icespt7a"]),
+            int(record["variation_ervi"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def record_fingerprint(record: dict) -> str:
+    """Fingerprint of the content of a WECA record, as received from the API"""
+    content = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
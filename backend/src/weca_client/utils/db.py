@@ -3,7 +3,8 @@ import json
 import urllib.parse
 from os import getenv
 from typing import List
-from sqlalchemy import create_engine, select, Table
+from sqlalchemy import create_engine, func, select, Table, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session
 from .data import common_keys_comparsion
@@ -151,6 +152,7 @@ class AutoMappingModels:
         self.PDBRDReport = self.Base.classes.pdbrd_report
         self.PDBRDStage = self.Base.classes.pdbrd_stage
         self.PDBRDUser = self.Base.classes.pdbrd_user
+        self.WecaRecordFingerprint = self.Base.classes.weca_record_fingerprint
         self.OTCLicence.__repr__ = (
             lambda self: f"<OTCLicence(licence_number='{self.licence_number}', licence_status='{self.licence_status}')>"
         )
@@ -186,6 +188,7 @@ class AutoMappingModels:
             "BODSDataCatalogue": self.BODSDataCatalogue,
             "PDBRDStage": self.PDBRDStage,
             "PDBRDUser": self.PDBRDUser,
+            "WecaRecordFingerprint": self.WecaRecordFingerprint,
         }
 
 
@@ -412,6 +415,7 @@ def send_to_db(
     db_invalid_insertion = []
     already_exists_records = {}
     belongs_to_another_user = {}
+    insertion_errors = {}
 
     # Add or create the group
     session = Session(engine)
@@ -483,11 +487,27 @@ def send_to_db(
         except Exception as e:
             log.error(f"Error: {e}")
             session.rollback()
+            insertion_errors.update(
+                {idx: [{"InsertionError": "Record could not be inserted"}]}
+            )
+            db_invalid_insertion.append(idx)
         finally:
             session.close()
     # Remove records from the valid_records dictionary that were not added to the database
     for idx in db_invalid_insertion:
         del records["valid_records"][f"{idx}"]
+    # The registrations are committed, the licence status summaries are out of date
+    services = {
+        (record.registration_number, record.route_number)
+        for record, _ in records["valid_records"].values()
+    }
+    with Session(engine) as session:
+        try:
+            invalidate_licence_status_summaries(session, models, services, group_id)
+            session.commit()
+        except Exception as e:
+            log.error(f"Error: {e}")
+            session.rollback()
     if len(already_exists_records) > 0:
         records["invalid_records"].append(
             {"records": already_exists_records, "description": "Record already exists"}
@@ -499,3 +519,240 @@ def send_to_db(
                 "description": "Record belongs to another user",
             }
         )
+    if len(insertion_errors) > 0:
+        records["invalid_records"].append(
+            {"records": insertion_errors, "description": "Record could not be inserted"}
+        )
+
+
+# Number of record keys looked up per query
+KEY_LOOKUP_CHUNK_SIZE = 1000
+
+
+def invalidate_licence_status_summaries(
+    session: Session, models: AutoMappingModels, services: set, group_id: int
+):
+    """Invalidate the licence status summaries of the group and of the other
+    groups with registrations of the services, as the latest variation of a
+    service is over the registrations of every group. The summaries are
+    recomputed on their next read by the csv_handler API.
+
+    Args:
+        session (Session): Database session, committed by the caller
+        models (AutoMappingModels): Mapped models
+        services (set): The (registration_number, route_number) of the services
+        group_id (int): The group of the inserted or deleted registrations
+    """
+    PDBRDGroup = models.PDBRDGroup
+    PDBRDRegistration = models.PDBRDRegistration
+    group_ids = {group_id}
+    sorted_services = sorted(services)
+    for start in range(0, len(sorted_services), KEY_LOOKUP_CHUNK_SIZE):
+        chunk = sorted_services[start : start + KEY_LOOKUP_CHUNK_SIZE]
+        group_ids.update(
+            row.group_id
+            for row in session.query(PDBRDRegistration.group_id)
+            .filter(
+                tuple_(
+                    PDBRDRegistration.registration_number,
+                    PDBRDRegistration.route_number,
+                ).in_(chunk)
+            )
+            .distinct()
+        )
+    session.query(PDBRDGroup).filter(PDBRDGroup.id.in_(group_ids)).update(
+        {"licence_status_refreshed_at": None}, synchronize_session=False
+    )
+
+
+class RecordFingerprints:
+    """Content fingerprints of the WECA records ingested for a group, keyed by
+    (licence_number, registration_number, route_number, variation_number)
+    """
+
+    def __init__(self, group_name: str, models: AutoMappingModels = None):
+        self.models = models or AutoMappingModels()
+        with Session(self.models.engine) as session:
+            group = DBGroup(self.models, session).get_or_create_group(group_name)
+            self.group_id = group.id
+
+    def fetch(self, keys: set) -> dict:
+        """Get the stored fingerprints of the record keys whose registration is
+        still in the database, a record deleted since it was ingested is new again
+
+        Args:
+            keys (set): The record keys
+
+        Returns:
+            dict: The fingerprint of each stored key
+        """
+        WecaRecordFingerprint = self.models.WecaRecordFingerprint
+        PDBRDRegistration = self.models.PDBRDRegistration
+        OTCLicence = self.models.OTCLicence
+        key_columns = tuple_(
+            WecaRecordFingerprint.licence_number,
+            WecaRecordFingerprint.registration_number,
+            WecaRecordFingerprint.route_number,
+            WecaRecordFingerprint.variation_number,
+        )
+        fingerprints = {}
+        sorted_keys = sorted(keys)
+        with Session(self.models.engine) as session:
+            for start in range(0, len(sorted_keys), KEY_LOOKUP_CHUNK_SIZE):
+                chunk = sorted_keys[start : start + KEY_LOOKUP_CHUNK_SIZE]
+                query = (
+                    session.query(
+                        WecaRecordFingerprint.licence_number,
+                        WecaRecordFingerprint.registration_number,
+                        WecaRecordFingerprint.route_number,
+                        WecaRecordFingerprint.variation_number,
+                        WecaRecordFingerprint.fingerprint,
+                    )
+                    .join(
+                        OTCLicence,
+                        OTCLicence.licence_number
+                        == WecaRecordFingerprint.licence_number,
+                    )
+                    .join(
+                        PDBRDRegistration,
+                        (PDBRDRegistration.otc_licence_id == OTCLicence.id)
+                        & (PDBRDRegistration.group_id == WecaRecordFingerprint.group_id)
+                        & (
+                            PDBRDRegistration.registration_number
+                            == WecaRecordFingerprint.registration_number
+                        )
+                        & (
+                            PDBRDRegistration.route_number
+                            == WecaRecordFingerprint.route_number
+                        )
+                        & (
+                            PDBRDRegistration.variation_number
+                            == WecaRecordFingerprint.variation_number
+                        ),
+                    )
+                    .filter(
+                        WecaRecordFingerprint.group_id == self.group_id,
+                        key_columns.in_(chunk),
+                    )
+                )
+                for row in query:
+                    fingerprints[
+                        (
+                            row.licence_number,
+                            row.registration_number,
+                            row.route_number,
+                            row.variation_number,
+                        )
+                    ] = row.fingerprint
+        return fingerprints
+
+    def store(self, fingerprints: dict):
+        """Insert or replace the fingerprints of the records in a single statement
+
+        Args:
+            fingerprints (dict): The fingerprint of each record key
+        """
+        if not fingerprints:
+            return
+        WecaRecordFingerprint = self.models.WecaRecordFingerprint
+        stmt = pg_insert(WecaRecordFingerprint).values(
+            [
+                {
+                    "group_id": self.group_id,
+                    "licence_number": licence_number,
+                    "registration_number": registration_number,
+                    "route_number": route_number,
+                    "variation_number": variation_number,
+                    "fingerprint": fingerprint,
+                }
+                for (
+                    licence_number,
+                    registration_number,
+                    route_number,
+                    variation_number,
+                ), fingerprint in sorted(fingerprints.items())
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[
+                "group_id",
+                "licence_number",
+                "registration_number",
+                "route_number",
+                "variation_number",
+            ],
+            set_={
+                "fingerprint": stmt.excluded.fingerprint,
+                "updated_at": func.current_timestamp(),
+            },
+        )
+        with Session(self.models.engine) as session:
+            try:
+                session.execute(stmt)
+                session.commit()
+            except Exception as e:
+                log.error(f"Error: {e}")
+                session.rollback()
+
+
+def delete_registrations(record_keys: set, group_name: str) -> int:
+    """Delete the registrations of the group with the record keys
+
+    Args:
+        record_keys (set): (licence_number, variation_number, registration_number,
+            route_number) of the registrations to delete
+        group_name (str): The group of the registrations
+
+    Returns:
+        int: The number of deleted registrations
+    """
+    models = AutoMappingModels()
+    PDBRDRegistration = models.PDBRDRegistration
+    OTCLicence = models.OTCLicence
+    key_columns = tuple_(
+        PDBRDRegistration.otc_licence_id,
+        PDBRDRegistration.variation_number,
+        PDBRDRegistration.registration_number,
+        PDBRDRegistration.route_number,
+    )
+    deleted_count = 0
+    with Session(models.engine) as session:
+        try:
+            group = DBGroup(models, session).get_or_create_group(group_name)
+            licence_ids = dict(
+                session.query(OTCLicence.licence_number, OTCLicence.id).filter(
+                    OTCLicence.licence_number.in_(
+                        {licence_number for licence_number, *_ in record_keys}
+                    )
+                )
+            )
+            keys = sorted(
+                (licence_ids[licence_number], *key)
+                for licence_number, *key in record_keys
+                if licence_number in licence_ids
+            )
+            invalidate_licence_status_summaries(
+                session,
+                models,
+                {
+                    (registration_number, route_number)
+                    for _, _, registration_number, route_number in keys
+                },
+                group.id,
+            )
+            for start in range(0, len(keys), KEY_LOOKUP_CHUNK_SIZE):
+                chunk = keys[start : start + KEY_LOOKUP_CHUNK_SIZE]
+                deleted_count += (
+                    session.query(PDBRDRegistration)
+                    .filter(
+                        PDBRDRegistration.group_id == group.id,
+                        key_columns.in_(chunk),
+                    )
+                    .delete(synchronize_session=False)
+                )
+            session.commit()
+        except Exception as e:
+            log.error(f"Error: {e}")
+            session.rollback()
+            deleted_count = 0
+    return deleted_count
@@ -0,0 +1,131 @@
+import codecs
+import json
+from typing import Iterable, Iterator, List
+
+_WHITESPACE = " \t\n\r"
+# A value which is not parsed once this many characters are buffered is
+# malformed, the stream is not read to its end to find it out
+MAX_VALUE_SIZE = 1024 * 1024
+
+
+class _JSONStream:
+    """Text buffer over a stream of UTF-8 chunks, only the part of the stream
+    which is not parsed yet is held in memory
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        """Append the next chunk to the buffer, False at the end of the stream"""
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._decoder.decode(b"", final=True)
+        else:
+            text = self._decoder.decode(chunk)
+        self._buffer = self._buffer[self._pos :] + text
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next character which is not whitespace, empty at the end of the stream"""
+        while True:
+            while (
+                self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE
+            ):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, *characters: str) -> str:
+        """Consume the next character, which must be one of the characters"""
+        character = self.peek()
+        if character not in characters or character == "":
+            raise ValueError(
+                f"Expected {' or '.join(characters)} but found {character or 'end of stream'}"
+            )
+        self._pos += 1
+        return character
+
+    def value(self):
+        """Parse the next JSON value
+
+        Raises:
+            ValueError: If the value is not valid JSON, or not parsed within
+                MAX_VALUE_SIZE characters
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # A number or literal at the end of the buffer may go on in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # The value is parsed again from its start with each chunk
+            if len(self._buffer) - self._pos > MAX_VALUE_SIZE:
+                raise ValueError(f"JSON value longer than {MAX_VALUE_SIZE} characters")
+            self._fill()
+
+
+def iter_report_data(chunks: Iterable[bytes], fields: List = None) -> Iterator[dict]:
+    """Parse a WECA report {"fields": [...], "data": [...]} incrementally and
+    yield the records of its data array one at a time
+
+    Args:
+        chunks (Iterable[bytes]): The body of the response, e.g. Response.iter_content()
+        fields (List, optional): Filled with the fields of the report once they are parsed
+
+    Raises:
+        ValueError: If the body is not valid JSON or not a JSON object
+
+    Returns:
+        Iterator[dict]: The records of the report
+    """
+    stream = _JSONStream(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key == "data":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(",", "]") == "]":
+                        break
+        else:
+            value = stream.value()
+            if key == "fields" and fields is not None:
+                fields.extend(value)
+        if stream.expect(",", "}") == "}":
+            return
+
+
+def batched(records: Iterable, batch_size: int) -> Iterator[list]:
+    """Group the records into lists of batch_size records, but the last one"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -14,6 +14,10 @@ WECA_PARAM_C = getenv("WECA_PARAM_C")
 WECA_PARAM_T = getenv("WECA_PARAM_T")
 WECA_PARAM_R = getenv("WECA_PARAM_R")
 WECA_API_URL = getenv("WECA_API_URL")
+# Number of records of the WECA report validated and inserted at a time
+WECA_BATCH_SIZE = int(getenv("WECA_BATCH_SIZE", "500"))
+# Whether the records unchanged since the last run are skipped
+WECA_CHANGE_CAPTURE = getenv("WECA_CHANGE_CAPTURE", "true").lower() == "true"
 
 # OTC CLIENT API
 OTC_CLIENT_API_URL = getenv("OTC_CLIENT_API_URL", "OTC_API_URL is not set")
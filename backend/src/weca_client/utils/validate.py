@@ -4,48 +4,69 @@ from .otc_api import verify_otc_api
 from .pydant_model import LicenceRecord
 
 
-# Get licenceRecord that has licence_number x001
-def licence_detail(licence_number, licence_details):
-    return next(
-        (
-            record
-            for record in licence_details
-            if record.licence_number == licence_number
-        ),
-        None,
-    )
+def index_licence_details(otc_api_response: dict) -> dict:
+    """Parse the licences returned by the OTC API once and index them by licence number
 
+    Args:
+        otc_api_response (dict): Response of the OTC API
+
+    Returns:
+        dict: LicenceRecord keyed by licence number
+    """
+    licence_index = {}
+    for record in (otc_api_response or {}).get("licences", []):
+        # A malformed licence is skipped, the others are still indexed
+        try:
+            licence = LicenceRecord(**record)
+        except Exception as e:
+            log.error(f"Error: {e}")
+            continue
+        licence_index.setdefault(licence.licence_number, licence)
+    return licence_index
+
+
+# Get the LicenceRecord of a licence number, e.g. x001
+def licence_detail(licence_number, licence_index):
+    return licence_index.get(licence_number)
 
-def validate_licence_number_existence(uploaded_records: dict):
+
+def validate_licence_number_existence(uploaded_records: dict, licence_index=None):
     """
     This function takes a list of licence numbers and checks if they exist in the database.
 
     Args:
         uploaded_records (dict): A dictionary containing the records to be validated.
+        licence_index (dict, optional): The licences of the earlier batches of the report,
+            only the other licences are looked up and the index is updated with them.
 
     Returns:
         [list]: A list of dictionaries containing the details of the licences.
     """
-    # Collect all the licence numbers from the records
+    # Collect the records whose licence is not known yet
     validated_records = uploaded_records["valid_records"]
-    # otc_API_response = MockData.mock_otc_licence_and_operator_api(validated_records)
-    otc_api_response = verify_otc_api(validated_records)
-    # sys.exit()
-
-    try:
-        licence_details = [
-            LicenceRecord(**record) for record in otc_api_response["licences"]
-        ]
-
-    except Exception as e:
-        log.error(f"Error: {e}")
+    if licence_index is None:
+        licence_index = {}
+    unknown_licence_records = {
+        idx: record
+        for idx, record in validated_records.items()
+        if record.licence_number not in licence_index
+    }
+    if unknown_licence_records:
+        # otc_API_response = MockData.mock_otc_licence_and_operator_api(validated_records)
+        otc_api_response = verify_otc_api(unknown_licence_records)
+        returned_licences = index_licence_details(otc_api_response)
+        # Licences not found are kept as None, not to be looked up again
+        for record in unknown_licence_records.values():
+            licence_index[record.licence_number] = returned_licences.get(
+                record.licence_number
+            )
 
     valid_records = {}
     invalid_records = {}
     for idx, record in uploaded_records["valid_records"].items():
         try:
             # Get licence details
-            licence = licence_detail(record.licence_number, licence_details)
+            licence = licence_detail(record.licence_number, licence_index)
             if (
                 licence is None
                 or licence.licence_details is None
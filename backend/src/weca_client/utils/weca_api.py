@@ -1,14 +1,16 @@
-import logging
 import requests
 from http import HTTPStatus
 from os import getenv
+from typing import Iterator, List
 from pydantic import ValidationError
 from requests import HTTPError, RequestException, Timeout
 from .aws import get_secret
+from .json_stream import batched, iter_report_data
 from .logger import log
-from .pydant_model import APIResponse
+from .pydant_model import FieldModel
 from .settings import (
     ENVIRONMENT,
+    WECA_BATCH_SIZE,
     WECA_PARAM_C,
     WECA_PARAM_T,
     WECA_PARAM_R,
@@ -28,11 +30,16 @@ class EmptyResponseException(Exception):
 retry_exceptions = (RequestException, EmptyResponseException)
 
 
+# The report is read from the response in chunks of this size
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
 class WecaClient:
-    def _make_request(self, timeout: int = 30, **kwargs) -> APIResponse:
+    def _make_request(self, timeout: int = 30, **kwargs) -> requests.Response | None:
         """
         Send Request to WECA API Endpoint
-        Response will be returned in the JSON format
+        The response is streamed, its body is not read yet.
+        None is returned if the report is empty.
         """
         url = WECA_API_URL
 
@@ -54,6 +61,7 @@ class WecaClient:
                 params=params,
                 files=files,
                 timeout=timeout,
+                stream=True,
             )
             response.raise_for_status()
         except Timeout as e:
@@ -71,31 +79,47 @@ class WecaClient:
                 f"Empty Response, API return {HTTPStatus.NO_CONTENT}, "
                 f"for params {params}"
             )
-            return self.default_response()
+            response.close()
+            return None
+        return response
+
+    def iter_weca_services(self) -> Iterator[dict]:
+        """
+        Stream the records of the WECA report, the report is parsed as it is
+        received so it is never held in memory.
+        If the report is malformed, the error is raised once the records parsed
+        before it are returned, so a truncated report fails the run.
+        """
+        response = self._make_request()
+        if response is None:
+            return
+        fields = []
+        count = 0
         try:
-            return APIResponse(**response.json())
+            for record in iter_report_data(
+                response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE), fields
+            ):
+                if not isinstance(record, dict):
+                    raise ValueError(f"Record {count + 1} is not a JSON object")
+                count += 1
+                yield record
+            [FieldModel(**field) for field in fields]
         except ValidationError as exc:
-            log.error("Validation error in WECA API response")
-            log.error(f"Response JSON: {response.text}")
+            log.error("Validation error in WECA API response fields")
             log.error(f"Validation Error: {exc}")
+            raise
         except ValueError as exc:
-            log.error("Validation error in WECA API response")
-            log.error(f"Response JSON: {response.text}")
+            log.error(f"Validation error in WECA API response after {count} records")
             log.error(f"Validation Error: {exc}")
-        return self.default_response()
-
-    def default_response(self):
-        """
-        Create default return response for placeholder purpose
-        """
-        response = {"fields": [], "data": []}
-        # print(response)
-        return APIResponse(**response)
+            raise
+        finally:
+            response.close()
+        log.info(f"Received {count} records from WECA API")
 
-    def fetch_weca_services(self) -> APIResponse:
+    def iter_weca_service_batches(
+        self, batch_size: int = WECA_BATCH_SIZE
+    ) -> Iterator[List[dict]]:
         """
-        Fetch method for sending request to WECA
-        Return Pydentic model response
+        Stream the records of the WECA report in batches of batch_size records
         """
-        response = self._make_request()
-        return response
+        return batched(self.iter_weca_services(), batch_size)
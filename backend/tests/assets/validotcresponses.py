@@ -424,46 +424,55 @@ EXPECTED_OUTPUTS = {
             "licence_details": None,
             "licence_number": "NOTAVALIDLICENCE",
             "operator_details": None,
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH1020951", "licence_status": "Valid"},
             "licence_number": "PH1020951",
             "operator_details": {"operator_name": "STAGECOACH DEVON LTD"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH1089686", "licence_status": "Valid"},
             "licence_number": "PH1089686",
             "operator_details": {"operator_name": "ALTONIAN COACHES LIMITED"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH1026770", "licence_status": "Valid"},
             "licence_number": "PH1026770",
             "operator_details": {"operator_name": "BUGLER COACHES LTD"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH0006633", "licence_status": "Valid"},
             "licence_number": "PH0006633",
             "operator_details": {"operator_name": "BATH BUS COMPANY LTD"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH0000132", "licence_status": "Valid"},
             "licence_number": "PH0000132",
             "operator_details": {"operator_name": "FIRST WEST OF ENGLAND LIMITED"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH0006019", "licence_status": "Valid"},
             "licence_number": "PH0006019",
             "operator_details": {"operator_name": "WAYNE EVANS"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH0005985", "licence_status": "Valid"},
             "licence_number": "PH0005985",
             "operator_details": {"operator_name": "EUROCOACHES LTD"},
+            "error": None,
         },
         {
             "licence_details": {"licence_number": "PH0005031", "licence_status": "Valid"},
             "licence_number": "PH0005031",
             "operator_details": {"operator_name": "CHELTENHAM & GLOUCESTER OMNIBUS CO LTD"},
+            "error": None,
         },
     ]
 }
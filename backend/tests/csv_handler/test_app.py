@@ -3,9 +3,11 @@ from fastapi.testclient import TestClient
 from app import app
 from os import remove
 import uuid
-from auth.verifier import operator
+from datetime import date, datetime
+from auth.verifier import operator, operator_or_programmatic_access
 from utils.pydant_model import AuthenticatedEntity
-from utils.exceptions import PreviousProcessNotCompleted
+from utils.exceptions import LimitIsNotSet, PreviousProcessNotCompleted
+from utils.jobs import LocalJobQueue
 import pytest
 
 client = TestClient(app)
@@ -16,11 +18,14 @@ def app_dependency_override():
     app.dependency_overrides[operator] = lambda: AuthenticatedEntity(
         type="user", name="testuser", group="testgroup"
     )
+    app.dependency_overrides[operator_or_programmatic_access] = app.dependency_overrides[
+        operator
+    ]
     yield
     app.dependency_overrides = {}
 
 
-@patch("utils.db.DBManager.get_records", return_value=[])
+@patch("utils.db.DBManager.get_records", return_value=([], None))
 def test_search_records(app_dependency_override):
     params = {
         "licenseNumber": "ABC123",
@@ -39,7 +44,24 @@ def test_search_records(app_dependency_override):
     assert response.json() == {"Results": []}
 
 
-@patch("utils.db.DBManager.get_records", return_value=[])
+@patch(
+    "utils.db.DBManager.get_records",
+    return_value=([{"registrationNumber": "PD1/1"}], "next-token"),
+)
+def test_search_records_next_page(mock_get_records):
+    response = client.get("api/v1/search?licenseNumber=PC1&limit=1&cursor=token")
+
+    assert response.status_code == 200
+    assert mock_get_records.call_args.kwargs["cursor"] == "token"
+    assert mock_get_records.call_args.kwargs["license_number"] == "PC1"
+    assert response.json() == {
+        "Results": [{"registrationNumber": "PD1/1"}],
+        "NextPage": "testserver/api/v1/search?licenseNumber=PC1&latestOnly=True"
+        "&limit=1&strictMode=False&activeOnly=False&cursor=next-token",
+    }
+
+
+@patch("utils.db.DBManager.get_records", return_value=([], None))
 def test_search_records_validation_error(app_dependency_override):
     response = client.get(
         "api/v1/search?latestOnly=InvalidValue",
@@ -76,7 +98,7 @@ def test_create_upload_file_without_authentications(file_name):
     assert response.status_code == 401
     assert response.json() == {"detail": "Not authenticated"}
 
-@patch("app.process_csv_file", side_effect=PreviousProcessNotCompleted)
+@patch("app.enqueue_csv_file", side_effect=PreviousProcessNotCompleted)
 def test_create_upload_file_previous_process_not_completed(
     mock_process, file_name, app_dependency_override
 ):
@@ -89,7 +111,7 @@ def test_create_upload_file_previous_process_not_completed(
     assert response.status_code == 422
     assert response.json() == {"detail": {"message": "Previous process is not completed yet"}}
 
-@patch("app.process_csv_file", side_effect=Exception("Unexpected error"))
+@patch("app.enqueue_csv_file", side_effect=Exception("Unexpected error"))
 def test_create_upload_file_generic_exception(
     mock_process, file_name, app_dependency_override
 ):
@@ -102,21 +124,213 @@ def test_create_upload_file_generic_exception(
     assert response.status_code == 400
     assert response.json() == {"detail": {"message": "Encountered an error while processing the file"}}
 
-@patch("app.process_csv_file")
-def test_create_upload_file(mock_process, file_name, app_dependency_override):
-    response = client.post(
-        "api/v1/upload-file/",
-        files={"file": open(file_name, "rb")},
-        headers={"Authorization": "Bearer localdev"},
-    )
+@patch("app.process_upload_job")
+@patch("app.enqueue_csv_file")
+def test_create_upload_file(
+    mock_enqueue, mock_process, file_name, app_dependency_override
+):
+    job_queue = MagicMock()
+    with patch("app.get_job_queue", return_value=job_queue):
+        response = client.post(
+            "api/v1/upload-file/",
+            files={"file": open(file_name, "rb")},
+            headers={"Authorization": "Bearer localdev"},
+        )
     assert response.status_code == 200
     assert response.json()["message"] == "File is being processed"
-    assert "report_id" in response.json()
-    mock_process.assert_called_once()
+    report_id = response.json()["report_id"]
+    mock_enqueue.assert_called_once()
+    _, _, enqueued_report_id, enqueued_queue = mock_enqueue.call_args.args
+    assert enqueued_report_id == report_id
+    assert enqueued_queue is job_queue
+    # The job is left to the worker consuming the queue
+    mock_process.assert_not_called()
+
+
+@patch("app.process_upload_job")
+def test_create_upload_file_local_queue(mock_process, file_name, app_dependency_override):
+    """Test the local queue is processed after the response without a worker."""
+    job_queue = LocalJobQueue()
+
+    def enqueue(content, entity, report_id, queue):
+        queue.send(report_id)
+
+    with patch("app.get_job_queue", return_value=job_queue), patch(
+        "app.enqueue_csv_file", side_effect=enqueue
+    ):
+        response = client.post(
+            "api/v1/upload-file/",
+            files={"file": open(file_name, "rb")},
+            headers={"Authorization": "Bearer localdev"},
+        )
+    assert response.status_code == 200
+    mock_process.assert_called_once_with(response.json()["report_id"])
+    assert len(job_queue.jobs) == 0
 
-@patch("utils.db.DBManager.get_records", return_value=[])
+@patch("utils.db.DBManager.get_records", return_value=([], None))
 def test_search_records_options(mock_get_records):
     response = client.get("api/v1/search")
     assert response.status_code == 200
     assert response.json() == {"Results": []}
-    
\ No newline at end of file
+    
+
+@patch(
+    "utils.db.DBManager.get_record_required_attention_percentage",
+    return_value=(
+        [{"licence_number": "PC1", "total_services": 2, "requires_attention": 50.0}],
+        datetime(2024, 3, 1, 9, 30),
+    ),
+)
+def test_view_registrations_status(mock_summary, app_dependency_override):
+    response = client.get("api/v1/view-registrations/status")
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"licence_number": "PC1", "total_services": 2, "requires_attention": 50.0}
+    ]
+    assert response.headers["Last-Modified"] == "Fri, 01 Mar 2024 09:30:00 GMT"
+
+
+def stream_all_records(*args, **kwargs):
+    return ["registrationNumber", "endDate"], iter(
+        [
+            {"registrationNumber": "PD1/1", "endDate": date(2100, 1, 1)},
+            {"registrationNumber": "PD1/2", "endDate": date(2025, 6, 30)},
+        ]
+    )
+
+
+@patch("utils.db.DBManager.stream_all_records", side_effect=stream_all_records)
+def test_get_all_records_ndjson(mock_stream, app_dependency_override):
+    response = client.get(
+        "api/v1/all-records",
+        headers={"Accept": "application/x-ndjson", "Accept-Encoding": "identity"},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "content-encoding" not in response.headers
+    assert response.text == (
+        '{"registrationNumber": "PD1/1", "endDate": "2100-01-01"}\n'
+        '{"registrationNumber": "PD1/2", "endDate": "2025-06-30"}\n'
+    )
+
+
+@patch("utils.db.DBManager.stream_all_records", side_effect=stream_all_records)
+def test_get_all_records_csv_gzip(mock_stream, app_dependency_override):
+    response = client.get(
+        "api/v1/all-records",
+        headers={
+            "Accept": "application/json;q=0.5, text/csv",
+            "Accept-Encoding": "gzip",
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-encoding"] == "gzip"
+    # The test client decompresses the body
+    assert response.text.splitlines() == [
+        "registrationNumber,endDate",
+        "PD1/1,2100-01-01",
+        "PD1/2,2025-06-30",
+    ]
+
+
+@patch("utils.db.DBManager.get_all_records", return_value=[])
+def test_get_all_records_json(mock_get_all_records, app_dependency_override):
+    response = client.get("api/v1/all-records")
+
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+@patch(
+    "utils.db.DBManager.get_staged_process",
+    return_value=[{"stage_id": "report", "created_at": "2024-01-01"}],
+)
+@patch(
+    "utils.db.DBManager.get_staged_records",
+    return_value=(
+        [
+            {
+                "licence_number": "PC1",
+                "operator_name": "Blue Sky Buses",
+                "registration_numbers": ["PD1/1", "PD1/2"],
+            }
+        ],
+        True,
+    ),
+)
+def test_get_staged_records(mock_staged_records, mock_process, app_dependency_override):
+    response = client.get("api/v1/stage?limit=1&page=2")
+
+    assert response.status_code == 200
+    assert mock_staged_records.call_args.kwargs == {"limit": 1, "page": 2}
+    assert response.json() == {
+        "records": [
+            {
+                "licence_number": "PC1",
+                "operator_name": "Blue Sky Buses",
+                "registration_numbers": ["PD1/1", "PD1/2"],
+            }
+        ],
+        "status": "Completed",
+        "stage_id": "report",
+        "next_step": "Commit or Discard",
+        "next_page": 3,
+    }
+
+
+@patch(
+    "utils.db.DBManager.get_staged_process",
+    return_value=[{"stage_id": "report", "created_at": "2024-01-01"}],
+)
+@patch(
+    "utils.db.DBManager.get_staged_records",
+    side_effect=LimitIsNotSet("Limit must be provided when page is provided"),
+)
+def test_get_staged_records_page_without_limit(
+    mock_staged_records, mock_process, app_dependency_override
+):
+    response = client.get("api/v1/stage?page=2")
+
+    assert response.status_code == 422
+
+
+@patch(
+    "utils.db.DBManager.get_report",
+    return_value=(
+        {
+            "invalid_records": [
+                {
+                    "count": 3,
+                    "description": "CSV data structure check",
+                    "records": {"2": [{"routeNumber": "Field required"}]},
+                }
+            ],
+            "valid_records_count": 1,
+        },
+        True,
+    ),
+)
+def test_get_report_page(mock_get_report, app_dependency_override):
+    response = client.get(
+        "api/v1/get-report?report_id=report-1&category=CSV data structure check&limit=1"
+    )
+
+    assert response.status_code == 200
+    assert mock_get_report.call_args.kwargs == {
+        "category": "CSV data structure check",
+        "limit": 1,
+        "page": None,
+    }
+    assert response.json()["next_page"] == 2
+    assert response.json()["Report"]["invalid_records"][0]["count"] == 3
+
+
+@patch("utils.db.DBManager.get_report", return_value=None)
+def test_get_report_not_found(mock_get_report, app_dependency_override):
+    response = client.get("api/v1/get-report?report_id=report-1")
+
+    assert response.status_code == 404
@@ -0,0 +1,176 @@
+import json
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+
+from utils.aws import (
+    BackoffWait,
+    ClamAVClient,
+    NotificationWait,
+    notification_object_key,
+)
+
+
+class LocalS3:
+    """In-memory stand-in for the S3 client, the scan result is tagged after
+    the object tags have been read `scan_after` times"""
+
+    def __init__(self, status="clean", scan_after=2):
+        self.objects = {}
+        self.status = status
+        self.scan_after = scan_after
+        self.tag_reads = 0
+
+    def put_object(self, Body, Bucket, Key):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {"Body": BytesIO(self.objects[(Bucket, Key)])}
+
+    def get_object_tagging(self, Bucket, Key):
+        self.tag_reads += 1
+        if self.tag_reads <= self.scan_after:
+            return {"TagSet": []}
+        return {"TagSet": [{"Key": "av-status", "Value": self.status}]}
+
+    def delete_object(self, Bucket, Key):
+        del self.objects[(Bucket, Key)]
+
+
+class LocalSQS:
+    """In-memory stand-in for the SQS client"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.deleted = []
+        self.released = []
+        self.receives = 0
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        self.receives += 1
+        messages, self.messages = self.messages, []
+        return {"Messages": messages}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.released.append(ReceiptHandle)
+
+
+@pytest.fixture
+def local_s3():
+    s3 = LocalS3()
+    clients = {"s3": s3}
+    with patch("utils.aws.get_boto_client", side_effect=clients.__getitem__):
+        yield s3, clients
+
+
+@patch("utils.aws.sleep")
+def test_backoff_wait_scan_clean(mock_sleep, local_s3):
+    s3, _ = local_s3
+    wait = BackoffWait(initial_delay=0.25, max_delay=0.75, timeout=60)
+
+    clamav_client = ClamAVClient("report", b"data", wait)
+    clamav_client.upload()
+
+    assert clamav_client.scan_status() == "clean"
+    assert s3.tag_reads == 3
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.25, 0.5]
+    assert s3.objects == {}
+
+
+@patch("utils.aws.sleep")
+def test_backoff_wait_scan_infected(mock_sleep, local_s3):
+    s3, _ = local_s3
+    s3.status = "infected"
+
+    clamav_client = ClamAVClient("report", b"data", BackoffWait())
+    clamav_client.upload()
+
+    assert clamav_client.scan_status() == "infected"
+    assert s3.objects == {}
+
+
+@patch("utils.aws.sleep")
+def test_backoff_wait_deadline(mock_sleep, local_s3):
+    s3, _ = local_s3
+    s3.scan_after = 100
+
+    clamav_client = ClamAVClient("report", b"data", BackoffWait(timeout=0))
+    clamav_client.upload()
+
+    assert clamav_client.scan_status() is None
+    assert s3.tag_reads == 1
+    mock_sleep.assert_not_called()
+
+
+@patch("utils.aws.sleep")
+def test_upload_then_scan_status(mock_sleep, local_s3):
+    s3, _ = local_s3
+    ClamAVClient("report", b"data").upload()
+
+    clamav_client = ClamAVClient("report", wait_strategy=BackoffWait())
+    assert clamav_client.scan_status(delete=False) == "clean"
+    assert clamav_client.open().read() == b"data"
+    clamav_client.delete()
+    assert s3.objects == {}
+
+
+def test_notification_wait(local_s3):
+    s3, clients = local_s3
+    s3.scan_after = 0
+    notification = {"Message": json.dumps({"key": "dev/report.csv"})}
+    clients["sqs"] = sqs = LocalSQS(
+        [
+            {"Body": json.dumps({"key": "dev/other.csv"}), "ReceiptHandle": "other"},
+            # The key of the file is only part of the key of this file
+            {"Body": json.dumps({"key": "dev/report.csv.bak"}), "ReceiptHandle": "bak"},
+            {"Body": "not a notification dev/report.csv", "ReceiptHandle": "text"},
+            {"Body": json.dumps(notification), "ReceiptHandle": "report"},
+        ]
+    )
+    wait = NotificationWait("https://sqs.local/queue", timeout=60)
+
+    clamav_client = ClamAVClient("report", b"data", wait)
+    clamav_client.upload()
+
+    assert clamav_client.scan_status() == "clean"
+    assert sqs.deleted == ["report"]
+    # The other notifications are left invisible until their visibility timeout
+    assert sqs.released == []
+    assert s3.tag_reads == 1
+
+
+def test_notification_wait_direct_notification(local_s3):
+    s3, clients = local_s3
+    s3.scan_after = 0
+    clients["sqs"] = sqs = LocalSQS(
+        [{"Body": json.dumps({"key": "dev/report.csv"}), "ReceiptHandle": "report"}]
+    )
+    wait = NotificationWait("https://sqs.local/queue", timeout=60)
+
+    clamav_client = ClamAVClient("report", b"data", wait)
+    clamav_client.upload()
+
+    assert clamav_client.scan_status() == "clean"
+    assert sqs.deleted == ["report"]
+    assert sqs.receives == 1
+
+
+@pytest.mark.parametrize(
+    "body, object_key",
+    [
+        (json.dumps({"key": "dev/report.csv"}), "dev/report.csv"),
+        (
+            json.dumps({"Message": json.dumps({"key": "dev/report.csv"})}),
+            "dev/report.csv",
+        ),
+        (json.dumps({"Message": "dev/report.csv"}), None),
+        (json.dumps(["dev/report.csv"]), None),
+        ("dev/report.csv", None),
+    ],
+)
+def test_notification_object_key(body, object_key):
+    assert notification_object_key(body) == object_key
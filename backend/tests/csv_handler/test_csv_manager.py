@@ -1,51 +1,130 @@
-from unittest.mock import MagicMock
-from managers.csv_manager import CSVManager
-from utils.pydant_model import AuthenticatedEntity
+from io import BytesIO
+import pytest
+from unittest.mock import MagicMock, patch
+from managers.csv_manager import CSVManager, enqueue_csv_file, process_upload_job
+from utils.constants import StageStatus
+from utils.jobs import LocalJobQueue
+from utils.pydant_model import AuthenticatedEntity, UploadJob
 
 _mock_entity = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
 
 
+class InMemoryReport:
+    """ReportWriter keeping the entries in memory"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.counts = {
+            description: len(records) for description, records in self.entries.items()
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def write(self, category, records):
+        self.entries.setdefault(category, {}).update(records)
+        self.counts[category] = len(self.entries[category])
+
+    def remove(self, category, row_numbers):
+        records = self.entries.get(category, {})
+        removed = {idx for idx in row_numbers if records.pop(idx, None) is not None}
+        self.counts[category] = len(records)
+        return removed
+
+
 def test_validation_and_insertion_steps():
     # Arrange
-    data = "license_number,name\n123,John Doe\n456,Jane Smith\n789,Invalid Record"
-    csv_manager = CSVManager(data, authenticated_entity=_mock_entity)
-    csv_manager._validate_csv_data = MagicMock(
-        return_value={
-            "valid_records": {
-                "2": MagicMock(),
-                "3": MagicMock(),
-            },
-            "invalid_records": {
-                "4": [{"license_number": "789", "name": "Invalid Record"}]
-            },
-        }
-    )
+    csv_manager = CSVManager(iter([]), authenticated_entity=_mock_entity)
+    batches = [
+        {
+            "valid_records": {"2": MagicMock(), "3": MagicMock()},
+            "invalid_records": [
+                {
+                    "records": {"4": [{"routeNumber": "Field required"}]},
+                    "description": "CSV data structure check",
+                }
+            ],
+        },
+        {
+            "valid_records": {"5": MagicMock()},
+            "invalid_records": [
+                {"records": {}, "description": "CSV data structure check"}
+            ],
+        },
+    ]
+    csv_manager._validate_csv_data = MagicMock(return_value=iter(batches))
+    csv_manager._check_duplicate_records = MagicMock()
+
+    def check_licence_number_existence(records):
+        if "5" in records["valid_records"]:
+            del records["valid_records"]["5"]
+            records["invalid_records"].append(
+                {
+                    "records": {"5": [{"LicenceNumber": "Licence number is not found in the OTC DB"}]},
+                    "description": "Warning - Record failed due to OTC validation",
+                }
+            )
+
     csv_manager._check_licence_number_existence = MagicMock(
-        return_value={
-            "valid_records": [{"license_number": "123", "name": "John Doe"}],
-            "invalid_records": [{"license_number": "456", "name": "Invalid Record"}],
-        }
+        side_effect=check_licence_number_existence
     )
+    csv_manager._registration_writer = MagicMock()
+    report = InMemoryReport()
+    csv_manager._report_writer = MagicMock(return_value=report)
     csv_manager._send_to_db = MagicMock()
     csv_manager._send_report_to_db = MagicMock()
-    csv_manager._check_duplicate_records = MagicMock()
-    csv_manager._remove_licence_details = MagicMock(
-        return_value={
-            "valid_records": [{"license_number": "123", "name": "John Doe"}],
-            "invalid_records": [{"license_number": "456", "name": "Invalid Record"}],
-        }
-    )
 
     # Act
     csv_manager.validation_and_insertion_steps()
 
-    # Assert — function returns None (sends report to DB, no return value)
-    csv_manager._validate_csv_data.assert_called_once()
-    csv_manager._check_duplicate_records.assert_called_once()
-    csv_manager._check_licence_number_existence.assert_called_once()
-    csv_manager._send_to_db.assert_called_once()
-    csv_manager._remove_licence_details.assert_called_once()
+    # Assert — each batch goes through every step, a single report is sent
+    assert csv_manager._check_duplicate_records.call_count == 2
+    assert csv_manager._check_licence_number_existence.call_count == 2
+    assert csv_manager._send_to_db.call_count == 2
+    csv_manager._registration_writer.assert_called_once()
     csv_manager._send_report_to_db.assert_called_once()
+    assert csv_manager._send_report_to_db.call_args.args[0] == {
+        "invalid_records": [
+            {"count": 1, "description": "CSV data structure check"},
+            {"count": 1, "description": "Warning - Record failed due to OTC validation"},
+        ],
+        "valid_records_count": 2,
+    }
+    # The invalid records are sent to the report entries
+    assert report.entries == {
+        "CSV data structure check": {"4": [{"routeNumber": "Field required"}]},
+        "Warning - Record failed due to OTC validation": {
+            "5": [{"LicenceNumber": "Licence number is not found in the OTC DB"}]
+        },
+        "OTC lookup failed, retry": {},
+        "Record already exists": {},
+    }
+
+
+def test_validate_csv_data_in_batches():
+    from utils.mocker import MockData
+
+    record, _ = MockData.mock_user_csv_record()
+    row = record.model_dump(by_alias=True)
+    row.update(
+        {
+            "receivedDate": "01/01/2000",
+            "grantedDate": "01/02/2000",
+            "effectiveDate": "01/03/2000",
+            "endDate": "",
+        }
+    )
+    rows = [row, {**row, "routeNumber": "2-A"}, row]
+    csv_manager = CSVManager(iter(rows), authenticated_entity=_mock_entity, batch_size=2)
+
+    batches = list(csv_manager._validate_csv_data())
+
+    assert [list(batch["valid_records"]) for batch in batches] == [["2"], ["4"]]
+    assert list(batches[0]["invalid_records"][0]["records"]) == ["3"]
+    assert batches[1]["invalid_records"][0]["records"] == {}
 
 
 def test_validate_csv_data():
@@ -71,3 +150,227 @@ def test_validate_csv_data():
 
     # Assert
     assert result == {"valid_records": {}, "invalid_records": {}}
+
+
+def test_check_duplicate_records():
+    from utils.mocker import MockData
+
+    record, other = MockData.mock_user_csv_record()
+    variation = record.model_copy(update={"variation_number": 2})
+    csv_manager = CSVManager("", authenticated_entity=_mock_entity)
+    first_batch = {"valid_records": {"2": record, "3": other, "4": variation}}
+    second_batch = {"valid_records": {"5": record.model_copy(), "6": record.model_copy()}}
+    report = InMemoryReport(
+        {
+            "CSV data structure check": {"7": [{"routeNumber": "Field required"}]},
+            "Warning - Record failed due to OTC validation": {},
+            "Record already exists": {},
+        }
+    )
+    writer = MagicMock()
+
+    csv_manager._check_duplicate_records(first_batch)
+    csv_manager._check_duplicate_records(second_batch)
+    removed_count = csv_manager._report_duplicate_records(report, writer)
+
+    # The first record of the key was inserted with its batch, then removed
+    assert list(first_batch["valid_records"]) == ["2", "3", "4"]
+    assert second_batch["valid_records"] == {}
+    assert removed_count == 1
+    writer.delete.assert_called_once_with(
+        {("PC7654322", 1, "PD7654321/87654321", "2")}
+    )
+    assert report.entries["CSV data structure check"] == {
+        "7": [{"routeNumber": "Field required"}],
+        "2": [{"": "Duplicate of record 5, 6"}],
+        "5": [{"": "Duplicate of record 2, 6"}],
+        "6": [{"": "Duplicate of record 2, 5"}],
+    }
+
+
+def test_report_duplicate_records_not_inserted():
+    from utils.mocker import MockData
+
+    record, _ = MockData.mock_user_csv_record()
+    csv_manager = CSVManager("", authenticated_entity=_mock_entity)
+    report = InMemoryReport(
+        {
+            "CSV data structure check": {},
+            "Warning - Record failed due to OTC validation": {},
+            "Record already exists": {"2": [{"Duplicated Record": "Record already exists in the database"}]},
+        }
+    )
+    writer = MagicMock()
+
+    csv_manager._check_duplicate_records({"valid_records": {"2": record}})
+    csv_manager._check_duplicate_records({"valid_records": {"3": record.model_copy()}})
+
+    assert csv_manager._report_duplicate_records(report, writer) == 0
+    writer.delete.assert_not_called()
+    assert report.entries["Record already exists"] == {}
+    assert report.counts["Record already exists"] == 0
+    assert list(report.entries["CSV data structure check"]) == ["2", "3"]
+
+
+@patch("managers.csv_manager.ClamAVClient")
+@patch("managers.csv_manager.initiate_stage_process", return_value=7)
+def test_enqueue_csv_file(mock_initiate, mock_clamav):
+    job_queue = LocalJobQueue()
+
+    job = enqueue_csv_file(b"content", _mock_entity, "report-1", job_queue)
+
+    mock_initiate.assert_called_once_with("testuser", "testgroup", "report-1")
+    mock_clamav.assert_called_once_with("report-1", b"content")
+    mock_clamav.return_value.upload.assert_called_once()
+    assert list(job_queue.jobs) == [job]
+    assert job == UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+
+
+@patch("managers.csv_manager.report_exists", return_value=False)
+@patch("managers.csv_manager.send_report_to_db")
+@patch("managers.csv_manager.complete_stage_process")
+@patch("managers.csv_manager.update_stage_process")
+@patch("managers.csv_manager.restart_stage_process", return_value=True)
+@patch("managers.csv_manager.ClamAVClient")
+def test_process_upload_job(
+    mock_clamav, mock_restart, mock_update, mock_complete, mock_report, mock_report_exists
+):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+    mock_clamav.return_value.open.return_value = BytesIO(b"licenceNumber\nPC1\nPC2")
+    mock_clamav.return_value.scan_status.return_value = "clean"
+
+    def validation_and_insertion_steps(csv_manager):
+        assert list(csv_manager.csv_data) == [
+            {"licenceNumber": "PC1"},
+            {"licenceNumber": "PC2"},
+        ]
+
+    with patch.object(
+        CSVManager,
+        "validation_and_insertion_steps",
+        autospec=True,
+        side_effect=validation_and_insertion_steps,
+    ) as mock_steps:
+        process_upload_job(job)
+
+    mock_steps.assert_called_once()
+    mock_clamav.return_value.scan_status.assert_called_once_with(delete=False)
+    mock_clamav.return_value.delete.assert_called_once()
+    mock_restart.assert_called_once_with(7)
+    mock_update.assert_called_once_with(7, StageStatus.Validating)
+    mock_complete.assert_called_once_with(7)
+    mock_report.assert_not_called()
+
+
+@patch("managers.csv_manager.report_exists", return_value=False)
+@patch("managers.csv_manager.send_report_to_db")
+@patch("managers.csv_manager.complete_stage_process")
+@patch("managers.csv_manager.update_stage_process")
+@patch("managers.csv_manager.restart_stage_process", return_value=True)
+@patch("managers.csv_manager.ClamAVClient")
+def test_process_upload_job_infected(
+    mock_clamav, mock_restart, mock_update, mock_complete, mock_report, mock_report_exists
+):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+    mock_clamav.return_value.scan_status.return_value = "infected"
+
+    with patch.object(CSVManager, "validation_and_insertion_steps") as mock_steps:
+        process_upload_job(job)
+
+    mock_steps.assert_not_called()
+    mock_report.assert_called_once_with(
+        {"invalid_file": [{"description": "File is infected"}]},
+        "testuser",
+        "testgroup",
+        "report-1",
+    )
+    mock_complete.assert_called_once_with(7)
+
+
+@pytest.mark.parametrize(
+    "scan_status",
+    [{"return_value": None}, {"side_effect": Exception("S3 is unavailable")}],
+)
+@patch("managers.csv_manager.report_exists", return_value=False)
+@patch("managers.csv_manager.send_report_to_db")
+@patch("managers.csv_manager.complete_stage_process")
+@patch("managers.csv_manager.update_stage_process")
+@patch("managers.csv_manager.restart_stage_process", return_value=True)
+@patch("managers.csv_manager.ClamAVClient")
+def test_process_upload_job_scan_failure(
+    mock_clamav, mock_restart, mock_update, mock_complete, mock_report, mock_report_exists, scan_status
+):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+    mock_clamav.return_value.scan_status.configure_mock(**scan_status)
+
+    with patch.object(CSVManager, "validation_and_insertion_steps") as mock_steps:
+        process_upload_job(job)
+
+    # A failure of the scan is not reported as an infected file, nor retried
+    mock_steps.assert_not_called()
+    mock_report.assert_called_once_with(
+        {"invalid_file": [{"description": "File could not be processed"}]},
+        "testuser",
+        "testgroup",
+        "report-1",
+    )
+    mock_clamav.return_value.delete.assert_called_once()
+    mock_complete.assert_called_once_with(7)
+
+
+@patch("managers.csv_manager.report_exists", return_value=True)
+@patch("managers.csv_manager.send_report_to_db")
+@patch("managers.csv_manager.complete_stage_process")
+@patch("managers.csv_manager.update_stage_process")
+@patch("managers.csv_manager.restart_stage_process", return_value=True)
+@patch("managers.csv_manager.ClamAVClient")
+def test_process_upload_job_redelivered(
+    mock_clamav, mock_restart, mock_update, mock_complete, mock_report, mock_report_exists
+):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+
+    process_upload_job(job)
+
+    mock_report_exists.assert_called_once_with("report-1")
+    mock_clamav.assert_not_called()
+    mock_restart.assert_not_called()
+    mock_report.assert_not_called()
+
+
+@patch("managers.csv_manager.report_exists", return_value=False)
+@patch("managers.csv_manager.send_report_to_db")
+@patch("managers.csv_manager.complete_stage_process")
+@patch("managers.csv_manager.update_stage_process")
+@patch("managers.csv_manager.restart_stage_process", return_value=False)
+@patch("managers.csv_manager.ClamAVClient")
+def test_process_upload_job_stage_discarded(
+    mock_clamav, mock_restart, mock_update, mock_complete, mock_report, mock_report_exists
+):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+
+    with patch.object(CSVManager, "validation_and_insertion_steps") as mock_steps:
+        process_upload_job(job)
+
+    # The stage was discarded as stale, the user may have started another upload
+    mock_steps.assert_not_called()
+    mock_clamav.return_value.scan_status.assert_not_called()
+    mock_clamav.return_value.delete.assert_called_once()
+    mock_report.assert_called_once_with(
+        {"invalid_file": [{"description": "File could not be processed"}]},
+        "testuser",
+        "testgroup",
+        "report-1",
+    )
+    mock_complete.assert_not_called()
@@ -0,0 +1,41 @@
+from io import BytesIO
+from unittest.mock import patch
+
+from utils.csv_stream import detect_encoding, iter_csv_rows
+
+
+def test_detect_encoding():
+    assert detect_encoding("licenceNumber,via\nPC1,Café".encode("utf-8")) == "utf-8-sig"
+    # A character cut at the end of the prefix is not a decoding error
+    assert detect_encoding("Café".encode("utf-8")[:-1]) == "utf-8-sig"
+    assert detect_encoding("Café".encode("latin-1"), final=True) == "latin-1"
+    assert detect_encoding("Café\n".encode("latin-1")) == "latin-1"
+
+
+def test_iter_csv_rows_utf8_with_bom():
+    content = '﻿licenceNumber,via\nPC1,Café\nPC2,"Main Street\nNorth"\n'
+    rows = iter_csv_rows(BytesIO(content.encode("utf-8")))
+
+    assert list(rows) == [
+        {"licenceNumber": "PC1", "via": "Café"},
+        {"licenceNumber": "PC2", "via": "Main Street\nNorth"},
+    ]
+
+
+def test_iter_csv_rows_latin1():
+    content = "licenceNumber,via\nPC1,Café\n".encode("latin-1")
+
+    assert list(iter_csv_rows(BytesIO(content))) == [
+        {"licenceNumber": "PC1", "via": "Café"}
+    ]
+
+
+@patch("utils.csv_stream.ENCODING_DETECTION_PREFIX_SIZE", 32)
+def test_iter_csv_rows_invalid_byte_after_prefix():
+    content = "licenceNumber,via\n" + "PC1,Main Street\n" * 4
+    content = content.encode("utf-8") + "PC2,Café\n".encode("latin-1")
+
+    rows = list(iter_csv_rows(BytesIO(content)))
+
+    assert len(rows) == 5
+    assert rows[-1] == {"licenceNumber": "PC2", "via": "Café"}
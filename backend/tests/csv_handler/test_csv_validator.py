@@ -1,6 +1,12 @@
 from pydantic import ValidationError
 
-from utils.csv_validator import Registration, extract_field_mgs_type_from_errors
+from utils.csv_validator import (
+    Registration,
+    extract_field_mgs_type_from_errors,
+    iter_validated_records,
+    validate_registration_batch,
+    validate_registrations,
+)
 
 
 def test_extract_field_mgs_type_from_errors():
@@ -64,3 +70,71 @@ def test_registration_model():
         assert isinstance(registration, Registration)
     except ValidationError:
         assert False, "Registration object is not valid"
+
+
+def _csv_row(**values):
+    row = {
+        "licenceNumber": "PC7654321",
+        "registrationNumber": "PD7654321/87654321",
+        "routeNumber": "2",
+        "routeDescription": "City Center - Suburb - Main Street",
+        "variationNumber": "2",
+        "startPoint": "City Center",
+        "finishPoint": "Suburb",
+        "via": "Main Street",
+        "subsidised": "Fully",
+        "subsidyDetail": "Transport for Local Authority (LA)",
+        "isShortNotice": "False",
+        "receivedDate": "01/02/2000",
+        "grantedDate": "01/03/2000",
+        "effectiveDate": "01/04/2000",
+        "endDate": "",
+        "operatorName": "Blue Sky Buses",
+        "busServiceTypeId": "Limited",
+        "busServiceTypeDescription": "Limited Stopping",
+        "trafficAreaId": "D",
+        "applicationType": "change",
+        "publicationText": "Change of Route",
+        "otherDetails": "Operates only on weekdays",
+    }
+    row.update(values)
+    return row
+
+
+def test_validate_registration_batch_matches_record_validation():
+    rows = [
+        _csv_row(),
+        _csv_row(routeNumber="2-A", receivedDate="2000-02-01"),
+        _csv_row(registrationNumber="PD7654321", variationNumber="two"),
+        _csv_row(endDate="01/05/2000"),
+    ]
+
+    valid_records, invalid_records = validate_registration_batch(rows)
+
+    assert (valid_records, invalid_records) == validate_registrations(rows)
+    assert list(valid_records) == [0, 3]
+    assert valid_records[3].end_date.isoformat() == "2000-05-01"
+    assert invalid_records[1] == [
+        {
+            "routeNumber": "Value error, invalid characters found in route number, please avoid using any of (_ - / . ,)"
+        },
+        {
+            "receivedDate": "Value error, time data '2000-02-01' does not match format '%d/%m/%Y'"
+        },
+    ]
+    assert [list(error) for error in invalid_records[2]] == [
+        ["registrationNumber"],
+        ["variationNumber"],
+    ]
+
+
+def test_iter_validated_records_unexpected_error():
+    # A missing date column fails the date parser with a TypeError, the record is left out
+    rows = [_csv_row(), _csv_row(grantedDate=None), _csv_row(routeNumber="2/A")]
+
+    records = list(iter_validated_records(rows, batch_size=2))
+
+    assert [(idx, errors is None) for idx, _, errors in records] == [
+        ("2", True),
+        ("4", False),
+    ]
@@ -1,29 +1,53 @@
-import os
+import json
+from datetime import date, datetime, timedelta
 from unittest.mock import Mock, patch
 import pytest
-from sqlalchemy import Column, Integer, String, create_engine
-from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    JSON,
+    String,
+    create_engine,
+    insert,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query, Session, declarative_base
+from sqlalchemy.sql.functions import array_agg
 
-from utils.db import AutoMappingModels, DBManager, add_or_get_record, CreateEngine
+from utils.db import (
+    AutoMappingModels,
+    DBManager,
+    ModelsRegistry,
+    CreateEngine,
+    RegistrationWriter,
+    ReportWriter,
+    encode_page_token,
+    fetch_cached_licences,
+    initiate_stage_process,
+    restart_stage_process,
+    send_report_to_db,
+    store_cached_licences,
+)
+from utils.exceptions import (
+    GroupIsNotFound,
+    InvalidPageToken,
+    LimitExceeded,
+    LimitIsNotSet,
+    NoStagedProcess,
+    PreviousProcessNotCompleted,
+    StagingProcessInProgress,
+)
+from utils.mocker import MockData
+from utils.pydant_model import AuthenticatedEntity, LicenceRecord, SearchQuery
 
 Base = declarative_base()
 
 
-@pytest.fixture
-def mocked_db():
-    # Implement your mocked database setup here
-    # For example, you can use an in-memory SQLite database
-    # and return a session object
-    # Make sure to import the necessary modules and classes
-
-    # Example implementation:
-    engine = create_engine("sqlite:///:memory:")
-    session = Session(engine)
-    Base.metadata.create_all(engine)
-    yield session
-    session.close()
-
-
 class TestModel(Base):
     __test__ = False
     __tablename__ = "test_model"
@@ -31,33 +55,6 @@ class TestModel(Base):
     name = Column(String(255))
 
 
-def test_add_or_get_record_when_record_does_not_exist(mocked_db):
-    session = mocked_db
-    record = TestModel(name="Test Record")
-    result = add_or_get_record("name", "Test Record", session, TestModel, record)
-    assert result == 1  # Assuming the id of the new record is 1
-
-
-def test_add_or_get_record_when_record_exists(mocked_db):
-    session = mocked_db
-    existing_record = TestModel(id=1, name="Test Record")
-    session.add(existing_record)
-    session.commit()
-
-    record = TestModel(name="Test Record")
-    result = add_or_get_record("name", "Test Record", session, TestModel, record)
-    assert result == 1  # Assuming the id of the existing record is 1
-
-
-def test_add_or_get_record_with_exception(mocked_db):
-    session = mocked_db
-    record = TestModel(name="Test Record")
-    session.query = Mock(side_effect=Exception("Test Exception"))
-
-    result = add_or_get_record("name", "Test Record", session, TestModel, record)
-    assert result is None
-
-
 class TestAutoMappingModels:
     @pytest.fixture
     def auto_mapping_models(self):
@@ -91,39 +88,1074 @@ class TestAutoMappingModels:
         assert isinstance(tables["OTCLicence"], type(auto_mapping_models.OTCLicence))
 
 
-class TestDBManager:
+class TestModelsRegistry:
     @pytest.fixture
-    def mocked_db(self):
-        engine = create_engine("sqlite:///test_db_file.csv")
-        session = Session(engine)
-        Base.metadata.create_all(engine)
-        yield session
-        session.close()
-        # remove the file
-        os.remove("test_db_file.csv")
-
-    @patch("utils.db.add_or_get_record", return_value=1)
-    def test_fetch_operator_record(self, mocked_db):
-        session = mocked_db
-        OTCOperator = TestModel
-        operator_record = TestModel()
-        operator_name = "Test Operator"
-
-        result = DBManager.fetch_operator_record(
-            operator_name, session, OTCOperator, operator_record
+    def registry(self):
+        mock_base = Mock()
+        engines = []
+
+        def new_engine():
+            engine = create_engine("sqlite:///:memory:")
+            engines.append(engine)
+            return engine
+
+        ModelsRegistry.reset()
+        with patch("utils.db.CreateEngine.get_engine", side_effect=new_engine), \
+             patch("utils.db.automap_base", return_value=mock_base) as automap:
+            yield ModelsRegistry, engines, automap
+        ModelsRegistry.reset()
+
+    def test_models_are_built_once(self, registry):
+        registry, engines, automap = registry
+        first = registry.get_models()
+        second = registry.get_models()
+        assert first is second
+        assert len(engines) == 1
+        automap.assert_called_once()
+
+    def test_sessions_share_the_engine(self, registry):
+        registry, engines, _ = registry
+        session_one = registry.get_session()
+        session_two = registry.get_session()
+        assert session_one is not session_two
+        assert session_one.get_bind() is engines[0]
+        assert session_two.get_bind() is engines[0]
+
+    def test_engine_is_replaced_when_token_expires(self, registry):
+        registry, engines, automap = registry
+        models = registry.get_models()
+        registry._expires_at = 0
+        assert registry.get_models() is models
+        assert len(engines) == 2
+        assert models.engine is engines[1]
+        assert registry.get_session().get_bind() is engines[1]
+        # The schema is not reflected again
+        automap.assert_called_once()
+
+    def test_engine_is_replaced_after_disconnect(self, registry):
+        registry, engines, _ = registry
+        registry.get_models()
+        registry._on_engine_error(Mock(is_disconnect=True))
+        registry.get_models()
+        assert len(engines) == 2
+        registry._on_engine_error(Mock(is_disconnect=False))
+        registry.get_models()
+        assert len(engines) == 2
+
+
+IngestionBase = declarative_base()
+
+
+class IngestionOperator(IngestionBase):
+    __tablename__ = "otc_operator"
+    id = Column(Integer, primary_key=True)
+    operator_name = Column(String(255), unique=True)
+
+
+class IngestionLicence(IngestionBase):
+    __tablename__ = "otc_licence"
+    id = Column(Integer, primary_key=True)
+    licence_number = Column(String(255), unique=True)
+    licence_status = Column(String(255))
+
+
+class IngestionStage(IngestionBase):
+    __tablename__ = "pdbrd_stage"
+    id = Column(Integer, primary_key=True)
+    stage_id = Column(String(255))
+    stage_user = Column(Integer)
+    stage_status = Column(String(255))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class IngestionRegistration(IngestionBase):
+    __tablename__ = "pdbrd_registration"
+    id = Column(Integer, primary_key=True)
+    otc_licence_id = Column(Integer)
+    route_number = Column(String(255))
+    route_description = Column(String(255))
+    variation_number = Column(Integer)
+    start_point = Column(String(255))
+    finish_point = Column(String(255))
+    via = Column(String(255))
+    subsidised = Column(String(10))
+    subsidy_detail = Column(String(255))
+    is_short_notice = Column(Boolean)
+    received_date = Column(Date)
+    granted_date = Column(Date)
+    effective_date = Column(Date)
+    end_date = Column(Date)
+    otc_operator_id = Column(Integer)
+    bus_service_type_id = Column(String(255))
+    bus_service_type_description = Column(String(255))
+    registration_number = Column(String(255))
+    traffic_area_id = Column(String(255))
+    application_type = Column(String(255))
+    publication_text = Column(String(255))
+    other_details = Column(String(255))
+    group_id = Column(Integer)
+    pdbrd_stage_id = Column(Integer)
+
+
+class IngestionGroup(IngestionBase):
+    __tablename__ = "pdbrd_group"
+    id = Column(Integer, primary_key=True)
+    local_auth = Column(String(255))
+    licence_status_refreshed_at = Column(DateTime)
+
+
+class IngestionCatalogue(IngestionBase):
+    __tablename__ = "bods_data_catalogue"
+    id = Column(Integer, primary_key=True)
+    xml_service_code = Column(String(255))
+    requires_attention = Column(Boolean)
+    timeliness_status = Column(String(255))
+
+
+class IngestionLicenceStatusSummary(IngestionBase):
+    __tablename__ = "pdbrd_licence_status_summary"
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer)
+    licence_number = Column(String(255))
+    operator_name = Column(String(255))
+    licence_status = Column(String(255))
+    requires_attention = Column(Float)
+    total_services = Column(Integer)
+    registrations_not_in_bods = Column(Integer)
+
+
+class IngestionLicenceCache(IngestionBase):
+    __tablename__ = "otc_licence_cache"
+    licence_number = Column(String(255), primary_key=True)
+    otc_licence_number = Column(String(255))
+    licence_status = Column(String(255))
+    operator_name = Column(String(255))
+    found = Column(Boolean, nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+
+
+class IngestionReport(IngestionBase):
+    __tablename__ = "pdbrd_report"
+    id = Column(Integer, primary_key=True)
+    report_id = Column(String(255))
+    user_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    report = Column(JSON)
+
+
+class IngestionReportEntry(IngestionBase):
+    __tablename__ = "pdbrd_report_entry"
+    report_id = Column(String(255), primary_key=True)
+    category = Column(String(255), primary_key=True)
+    row_number = Column(Integer, primary_key=True)
+    errors = Column(JSON, nullable=False)
+
+
+class TestRegistrationWriter:
+    @pytest.fixture
+    def engine(self):
+        engine = create_engine("sqlite:///:memory:")
+        IngestionBase.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(IngestionStage(id=1, stage_status="in_progress"))
+            session.commit()
+        models = Mock()
+        models.get_tables.return_value = {
+            "OTCOperator": IngestionOperator,
+            "OTCLicence": IngestionLicence,
+            "PDBRDRegistration": IngestionRegistration,
+            "PDBRDStage": IngestionStage,
+        }
+        with patch(
+            "utils.db.initiate_db_variables",
+            side_effect=lambda: (models, Session(engine)),
+        ), patch(
+            "utils.db.DBGroup.get_or_create_user", return_value=Mock(group_id=7)
+        ):
+            yield engine
+
+    @staticmethod
+    def licence(licence_number, operator_name):
+        return LicenceRecord(
+            licence_number=licence_number,
+            licence_details={
+                "licence_number": licence_number,
+                "licence_status": "Valid",
+            },
+            operator_details={"operator_name": operator_name},
+        )
+
+    def upload(self):
+        first, second = MockData.mock_user_csv_record()
+        third = first.model_copy(update={"variation_number": 2})
+        return {
+            "valid_records": {
+                "2": [first, self.licence("PC7654322", "Blue Sky Buses")],
+                "3": [second, self.licence("PC7654323", "Red Sky Buses")],
+                "4": [third, self.licence("PC7654322", "Blue Sky Buses")],
+            },
+            "invalid_records": [],
+        }
+
+    @staticmethod
+    def write(valid_records):
+        with RegistrationWriter("group", "user", 1) as writer:
+            return writer.write(valid_records)
+
+    def test_registration_writer_inserts_records(self, engine):
+        assert self.write(self.upload()["valid_records"]) == {}
+
+        with Session(engine) as session:
+            assert session.query(IngestionOperator).count() == 2
+            assert session.query(IngestionLicence).count() == 2
+            registrations = session.query(IngestionRegistration).all()
+            assert len(registrations) == 3
+            assert {r.group_id for r in registrations} == {7}
+            assert {r.pdbrd_stage_id for r in registrations} == {1}
+            assert session.get(IngestionStage, 1).stage_status == "completed"
+
+    def test_registration_writer_reports_existing_records(self, engine):
+        self.write(self.upload()["valid_records"])
+
+        assert self.write(self.upload()["valid_records"]) == {
+            idx: [{"Duplicated Record": "Record already exists in the database"}]
+            for idx in ["2", "3", "4"]
+        }
+        with Session(engine) as session:
+            assert session.query(IngestionOperator).count() == 2
+            assert session.query(IngestionLicence).count() == 2
+            assert session.query(IngestionRegistration).count() == 3
+
+    @pytest.fixture
+    def unique_registrations(self, engine):
+        # The unique key of the registrations of pdbrd_registration
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "create unique index uq_registration on pdbrd_registration "
+                "(otc_licence_id, registration_number, variation_number, group_id, route_number)"
+            )
+        return engine
+
+    def test_registration_writer_reports_existing_records_of_another_operator(
+        self, unique_registrations
+    ):
+        engine = unique_registrations
+        self.write(self.upload()["valid_records"])
+        valid_records = self.upload()["valid_records"]
+        # The operator of the licence was renamed since the first upload
+        valid_records["2"][1] = self.licence("PC7654322", "Blue Sky Coaches")
+
+        assert list(self.write(valid_records)) == ["2", "3", "4"]
+        with Session(engine) as session:
+            assert session.query(IngestionRegistration).count() == 3
+
+    def test_registration_writer_skips_conflicting_records(self, unique_registrations):
+        engine = unique_registrations
+        self.write({"2": self.upload()["valid_records"]["2"]})
+        # Inserted by a concurrent upload after the lookup
+        with patch(
+            "utils.db.DBManager.fetch_existing_registration_keys", return_value=set()
+        ):
+            already_exists_records = self.write(self.upload()["valid_records"])
+
+        # Only the conflicting record is rejected, not the whole batch
+        assert list(already_exists_records) == ["2"]
+        with Session(engine) as session:
+            assert session.query(IngestionRegistration).count() == 3
+
+    def test_registration_writer_batches(self, engine):
+        upload = self.upload()["valid_records"]
+        with RegistrationWriter("group", "user", 1) as writer:
+            assert writer.write({"2": upload["2"], "3": upload["3"]}) == {}
+            # The registrations of the earlier batch are found by the later one
+            assert list(writer.write({"5": upload["2"], "4": upload["4"]})) == ["5"]
+            assert writer.delete({("PC7654323", 1, "PD7654321/87654321", "2")}) == 1
+
+        with Session(engine) as session:
+            assert session.query(IngestionOperator).count() == 2
+            assert session.query(IngestionLicence).count() == 2
+            assert session.query(IngestionRegistration).count() == 2
+            assert session.get(IngestionStage, 1).stage_status == "completed"
+
+    def test_registration_writer_rolls_back(self, engine):
+        upload = self.upload()["valid_records"]
+        with pytest.raises(ValueError):
+            with RegistrationWriter("group", "user", 1) as writer:
+                writer.write(upload)
+                raise ValueError("Upload failed")
+
+        with Session(engine) as session:
+            assert session.query(IngestionRegistration).count() == 0
+            assert session.get(IngestionStage, 1).stage_status == "in_progress"
+
+
+class TestGetRecords:
+    @pytest.fixture
+    def engine(self):
+        engine = create_engine("sqlite:///:memory:")
+        IngestionBase.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(IngestionOperator(id=1, operator_name="Blue Sky Buses"))
+            session.add(IngestionLicence(id=1, licence_number="PC1", licence_status="Valid"))
+            for idx, (registration_number, route_number, variation_number) in enumerate(
+                [
+                    ("PD1/2", "1", 1),
+                    ("PD1/1", "2", 0),
+                    ("PD1/1", "1", 1),
+                    ("PD1/1", "1", 0),
+                    ("PD1/3", "1", 0),
+                ]
+            ):
+                session.add(
+                    IngestionRegistration(
+                        id=idx + 1,
+                        otc_licence_id=1,
+                        otc_operator_id=1,
+                        registration_number=registration_number,
+                        route_number=route_number,
+                        variation_number=variation_number,
+                        group_id=7,
+                    )
+                )
+            session.commit()
+        models = Mock(
+            PDBRDRegistration=IngestionRegistration,
+            OTCOperator=IngestionOperator,
+            OTCLicence=IngestionLicence,
+        )
+        with patch(
+            "utils.db.initiate_db_variables",
+            side_effect=lambda: (models, Session(engine)),
+        ):
+            yield engine
+
+    @staticmethod
+    def keys(records):
+        return [
+            (r["registrationNumber"], r["routeNumber"], r["variationNumber"])
+            for r in records
+        ]
+
+    def test_get_records_follows_cursor(self, engine):
+        pages = []
+        records, cursor = DBManager.get_records(limit=2)
+        pages.append(self.keys(records))
+        while cursor:
+            records, cursor = DBManager.get_records(limit=2, cursor=cursor)
+            pages.append(self.keys(records))
+
+        assert pages == [
+            [("PD1/1", "1", 0), ("PD1/1", "1", 1)],
+            [("PD1/1", "2", 0), ("PD1/2", "1", 1)],
+            [("PD1/3", "1", 0)],
+        ]
+
+    def test_get_latest_records_follows_cursor(self, engine):
+        records, cursor = DBManager.get_records(exclude_variations=True, limit=2)
+        assert self.keys(records) == [("PD1/1", "1", 1), ("PD1/1", "2", 0)]
+
+        records, cursor = DBManager.get_records(
+            exclude_variations=True, limit=2, cursor=cursor
+        )
+        assert self.keys(records) == [("PD1/2", "1", 1), ("PD1/3", "1", 0)]
+        assert cursor is None
+
+    def test_get_records_with_null_keys_follows_cursor(self, engine):
+        with Session(engine) as session:
+            for idx, (registration_number, route_number, variation_number) in enumerate(
+                [("PD1/1", None, 0), ("PD1/2", None, None), ("PD1/1", None, 1)]
+            ):
+                session.add(
+                    IngestionRegistration(
+                        id=idx + 6,
+                        otc_licence_id=1,
+                        otc_operator_id=1,
+                        registration_number=registration_number,
+                        route_number=route_number,
+                        variation_number=variation_number,
+                        group_id=7,
+                    )
+                )
+            session.commit()
+
+        records, cursor = DBManager.get_records(limit=2)
+        pages = [self.keys(records)]
+        while cursor:
+            records, cursor = DBManager.get_records(limit=2, cursor=cursor)
+            pages.append(self.keys(records))
+        assert pages == [
+            [("PD1/1", None, 0), ("PD1/1", None, 1)],
+            [("PD1/1", "1", 0), ("PD1/1", "1", 1)],
+            [("PD1/1", "2", 0), ("PD1/2", None, None)],
+            [("PD1/2", "1", 1), ("PD1/3", "1", 0)],
+        ]
+
+        records, cursor = DBManager.get_records(exclude_variations=True, limit=2)
+        pages = [self.keys(records)]
+        while cursor:
+            records, cursor = DBManager.get_records(
+                exclude_variations=True, limit=2, cursor=cursor
+            )
+            pages.append(self.keys(records))
+        assert pages == [
+            [("PD1/1", None, 1), ("PD1/1", "1", 1)],
+            [("PD1/1", "2", 0), ("PD1/2", None, None)],
+            [("PD1/2", "1", 1), ("PD1/3", "1", 0)],
+        ]
+
+    def test_get_records_by_page(self, engine):
+        records, cursor = DBManager.get_records(limit=2, page=2)
+        assert self.keys(records) == [("PD1/1", "2", 0), ("PD1/2", "1", 1)]
+        # The cursor of a page continues where the page ends
+        records, cursor = DBManager.get_records(limit=2, cursor=cursor)
+        assert self.keys(records) == [("PD1/3", "1", 0)]
+        assert cursor is None
+
+        records, cursor = DBManager.get_records(limit=2, page=3)
+        assert self.keys(records) == [("PD1/3", "1", 0)]
+        assert cursor is None
+        with pytest.raises(LimitExceeded):
+            DBManager.get_records(limit=2, page=4)
+        with pytest.raises(LimitIsNotSet):
+            DBManager.get_records(page=1)
+
+    def test_get_records_invalid_cursor(self, engine):
+        with pytest.raises(InvalidPageToken):
+            DBManager.get_records(limit=2, cursor="not a token")
+        with pytest.raises(InvalidPageToken):
+            DBManager.get_records(limit=2, cursor=encode_page_token(["PD1/1"]))
+
+    @pytest.mark.parametrize(
+        "kwargs, exception",
+        [
+            ({"page": 1}, LimitIsNotSet),
+            ({"limit": 2, "page": 4}, LimitExceeded),
+            ({"limit": 2, "cursor": "not a token"}, InvalidPageToken),
+        ],
+    )
+    def test_session_is_closed_on_error(self, engine, kwargs, exception):
+        with patch.object(Session, "close", autospec=True) as close:
+            with pytest.raises(exception):
+                DBManager.get_records(**kwargs)
+        close.assert_called_once()
+
+    def test_construct_next_page_url(self):
+        search_query = SearchQuery(
+            licenseNumber="PC1", operatorName="Blue Sky", limit=2, page=3
+        )
+
+        assert DBManager.construct_next_page_url(search_query, None, "host", "/search") is None
+        assert DBManager.construct_next_page_url(search_query, "abc", "host", "/search") == (
+            "host/search?licenseNumber=PC1&operatorName=Blue+Sky&latestOnly=False&limit=2&strictMode=False"
+            "&activeOnly=False&cursor=abc"
+        )
+
+
+def add_registration(session, registration_number, variation_number, **overrides):
+    values = {
+        "otc_licence_id": 1,
+        "otc_operator_id": 1,
+        "registration_number": registration_number,
+        "route_number": "1",
+        "variation_number": variation_number,
+        "application_type": "New",
+        "effective_date": date(2020, 1, 1),
+        "group_id": 7,
+    }
+    values.update(overrides)
+    session.add(IngestionRegistration(**values))
+
+
+@pytest.fixture
+def group_registrations():
+    engine = create_engine("sqlite:///:memory:")
+    IngestionBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(IngestionGroup(id=7, local_auth="testgroup"))
+        session.add(IngestionOperator(id=1, operator_name="Blue Sky Buses"))
+        session.add(IngestionLicence(id=1, licence_number="PC1", licence_status="Valid"))
+        session.add(IngestionCatalogue(xml_service_code="PD1/1", requires_attention=False))
+        session.add(IngestionCatalogue(xml_service_code="PD1/2", requires_attention=True))
+        session.add(IngestionStage(id=1, stage_id="report", stage_user=1))
+        for registration_number, variation_number, overrides in [
+            ("PD1/1", 0, {}),
+            ("PD1/1", 1, {}),
+            ("PD1/2", 0, {}),
+            ("PD1/3", 0, {}),
+            ("PD1/4", 0, {"pdbrd_stage_id": 1}),
+            ("PD1/5", 0, {"application_type": "Cancellation"}),
+            ("PD1/6", 0, {"end_date": date(2021, 1, 1)}),
+            ("PD1/7", 0, {"group_id": 8}),
+        ]:
+            add_registration(session, registration_number, variation_number, **overrides)
+        session.commit()
+    models = Mock(
+        PDBRDRegistration=IngestionRegistration,
+        OTCOperator=IngestionOperator,
+        OTCLicence=IngestionLicence,
+        BODSDataCatalogue=IngestionCatalogue,
+        PDBRDGroup=IngestionGroup,
+        PDBRDStage=IngestionStage,
+        PDBRDLicenceStatusSummary=IngestionLicenceStatusSummary,
+    )
+    models.get_tables.return_value = {"PDBRDStage": IngestionStage}
+    with patch(
+        "utils.db.initiate_db_variables",
+        side_effect=lambda: (models, Session(engine)),
+    ), patch(
+        "utils.db.DBGroup.get_user", return_value=Mock(id=1, group_id=7)
+    ):
+        yield engine
+
+
+class TestLicenceStatusSummary:
+    @pytest.fixture
+    def engine(self, group_registrations):
+        return group_registrations
+
+    @staticmethod
+    def summary(total_services, requires_attention, not_in_bods):
+        return [
+            {
+                "licence_number": "PC1",
+                "operator_name": "Blue Sky Buses",
+                "licence_status": "Valid",
+                "requires_attention": requires_attention,
+                "total_services": total_services,
+                "Registrations_not_in_BODS": not_in_bods,
+            }
+        ]
+
+    def test_summary_is_computed_once(self, engine):
+        user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+        records, refreshed_at = DBManager.get_record_required_attention_percentage(user)
+        assert records == self.summary(3, 66.67, 1)
+        assert refreshed_at is not None
+
+        with Session(engine) as session:
+            add_registration(session, "PD1/8", 0)
+            session.commit()
+        # Served from the summary until it is invalidated
+        assert DBManager.get_record_required_attention_percentage(user)[0] == records
+
+        with Session(engine) as session:
+            session.get(IngestionGroup, 7).licence_status_refreshed_at = None
+            session.commit()
+        records, _ = DBManager.get_record_required_attention_percentage(user)
+        assert records == self.summary(4, 75.0, 2)
+
+    def test_summary_is_refreshed_on_commit(self, engine):
+        user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+        DBManager.get_record_required_attention_percentage(user)
+        with Session(engine) as session:
+            add_registration(session, "PD1/8", 0)
+            session.commit()
+
+        assert DBManager.commit_staged_records(user, "report")["count"] == 1
+        records, _ = DBManager.get_record_required_attention_percentage(user)
+        # PD1/8 and the committed PD1/4 are counted
+        assert records == self.summary(5, 80.0, 3)
+
+    def test_commit_invalidates_the_groups_with_the_same_services(self, engine):
+        user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+        with Session(engine) as session:
+            for group_id in (8, 9):
+                session.add(
+                    IngestionGroup(
+                        id=group_id,
+                        local_auth=f"group{group_id}",
+                        licence_status_refreshed_at=datetime.now(),
+                    )
+                )
+            add_registration(session, "PD1/9", 0, group_id=9)
+            # A later variation of the PD1/7 registration of group 8
+            add_registration(session, "PD1/7", 1, pdbrd_stage_id=1)
+            session.commit()
+
+        DBManager.commit_staged_records(user, "report")
+
+        with Session(engine) as session:
+            refreshed_at = dict(
+                session.query(IngestionGroup.id, IngestionGroup.licence_status_refreshed_at)
+            )
+        assert refreshed_at[7] is not None
+        assert refreshed_at[8] is None
+        assert refreshed_at[9] is not None
+
+    def test_summary_of_unknown_group(self, engine):
+        user = AuthenticatedEntity(type="user", name="testuser", group="othergroup")
+        with pytest.raises(GroupIsNotFound):
+            DBManager.get_record_required_attention_percentage(user)
+
+
+class TestCommitStagedRecords:
+    user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+
+    @staticmethod
+    def stage_ids(engine):
+        with Session(engine) as session:
+            return dict(
+                session.query(
+                    IngestionRegistration.registration_number,
+                    IngestionRegistration.pdbrd_stage_id,
+                )
+            )
+
+    def test_commit(self, group_registrations):
+        result = DBManager.commit_staged_records(self.user, "report")
+
+        assert result["count"] == 1
+        assert result["elapsed_ms"] >= 0
+        assert self.stage_ids(group_registrations)["PD1/4"] is None
+        with Session(group_registrations) as session:
+            assert session.query(IngestionStage).count() == 0
+
+    def test_discard(self, group_registrations):
+        assert DBManager.commit_staged_records(self.user, "report", commit=False)["count"] == 1
+
+        assert "PD1/4" not in self.stage_ids(group_registrations)
+        assert "PD1/1" in self.stage_ids(group_registrations)
+        with Session(group_registrations) as session:
+            assert session.query(IngestionStage).count() == 0
+
+    def test_unknown_stage(self, group_registrations):
+        assert DBManager.commit_staged_records(self.user, "unknown") is False
+        assert self.stage_ids(group_registrations)["PD1/4"] == 1
+
+    def test_commit_large_stage(self, group_registrations):
+        with Session(group_registrations) as session:
+            session.execute(
+                insert(IngestionRegistration),
+                [
+                    {"registration_number": f"PD2/{n}", "group_id": 7, "pdbrd_stage_id": 1}
+                    for n in range(10_000)
+                ],
+            )
+            session.commit()
+
+        result = DBManager.commit_staged_records(self.user, "report")
+
+        assert result["count"] == 10_001
+        assert result["elapsed_ms"] < 1000
+        with Session(group_registrations) as session:
+            assert (
+                session.query(IngestionRegistration)
+                .filter(IngestionRegistration.pdbrd_stage_id.isnot(None))
+                .count()
+                == 0
+            )
+
+
+class TestStageRecovery:
+    @pytest.fixture
+    def engine(self, group_registrations):
+        with Session(group_registrations) as session:
+            # The upload job of the staged process was lost two hours ago
+            session.query(IngestionStage).update(
+                {
+                    "stage_status": "validating",
+                    "updated_at": datetime.utcnow() - timedelta(hours=2),
+                }
+            )
+            session.commit()
+        with patch(
+            "utils.db.DBGroup.get_or_create_user", return_value=Mock(id=1, group_id=7)
+        ):
+            yield group_registrations
+
+    @staticmethod
+    def registration_numbers(engine):
+        with Session(engine) as session:
+            return {
+                registration.registration_number
+                for registration in session.query(IngestionRegistration)
+            }
+
+    def test_stale_stage_is_discarded(self, engine):
+        stage_id = initiate_stage_process("testuser", "testgroup", "new-report")
+
+        assert "PD1/4" not in self.registration_numbers(engine)
+        with Session(engine) as session:
+            stage = session.get(IngestionStage, stage_id)
+            assert session.query(IngestionStage).count() == 1
+            assert stage.stage_id == "new-report"
+            assert stage.stage_status == "queued"
+
+    def test_stage_in_progress_is_kept(self, engine):
+        with Session(engine) as session:
+            session.query(IngestionStage).update({"updated_at": datetime.utcnow()})
+            session.commit()
+
+        with pytest.raises(PreviousProcessNotCompleted):
+            initiate_stage_process("testuser", "testgroup", "new-report")
+        with pytest.raises(StagingProcessInProgress):
+            DBManager.get_staged_process(
+                AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+            )
+        assert "PD1/4" in self.registration_numbers(engine)
+
+    def test_stale_stage_is_not_staged(self, engine):
+        with pytest.raises(NoStagedProcess):
+            DBManager.get_staged_process(
+                AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+            )
+        assert "PD1/4" not in self.registration_numbers(engine)
+
+    def test_restart_discards_the_earlier_attempt(self, engine):
+        assert restart_stage_process(1) is True
+
+        assert "PD1/4" not in self.registration_numbers(engine)
+        assert "PD1/1" in self.registration_numbers(engine)
+        with Session(engine) as session:
+            stage = session.get(IngestionStage, 1)
+            assert stage.stage_status == "scanning"
+            assert stage.updated_at > datetime.utcnow() - timedelta(minutes=1)
+
+    def test_restart_of_discarded_stage(self, engine):
+        assert restart_stage_process(2) is False
+
+
+@compiles(array_agg, "sqlite")
+def sqlite_array_agg(element, compiler, **kw):
+    # SQLite has no arrays, the aggregate is read as a JSON array
+    return f"json_group_array({compiler.process(element.clauses, **kw)})"
+
+
+def decode_registration_numbers(records):
+    return [
+        {**record, "registration_numbers": json.loads(record["registration_numbers"])}
+        for record in records
+    ]
+
+
+class TestGetStagedRecords:
+    user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+
+    @pytest.fixture
+    def engine(self, group_registrations):
+        with Session(group_registrations) as session:
+            session.query(IngestionStage).update({"stage_status": "completed"})
+            session.add(IngestionOperator(id=2, operator_name="Red Buses"))
+            session.add(IngestionLicence(id=2, licence_number="PC2", licence_status="Valid"))
+            session.add(IngestionLicence(id=3, licence_number="PC3", licence_status="Valid"))
+            add_registration(session, "PD1/8", 0, pdbrd_stage_id=1)
+            add_registration(
+                session, "PD2/1", 0, otc_licence_id=2, otc_operator_id=2, pdbrd_stage_id=1
+            )
+            add_registration(
+                session, "PD3/1", 0, otc_licence_id=3, otc_operator_id=2, pdbrd_stage_id=1
+            )
+            session.commit()
+        return group_registrations
+
+    def test_grouped_by_licence(self, engine):
+        records, has_next_page = DBManager.get_staged_records(self.user, "report")
+
+        assert decode_registration_numbers(records) == [
+            {
+                "licence_number": "PC1",
+                "operator_name": "Blue Sky Buses",
+                "registration_numbers": ["PD1/4", "PD1/8"],
+            },
+            {
+                "licence_number": "PC2",
+                "operator_name": "Red Buses",
+                "registration_numbers": ["PD2/1"],
+            },
+            {
+                "licence_number": "PC3",
+                "operator_name": "Red Buses",
+                "registration_numbers": ["PD3/1"],
+            },
+        ]
+        assert has_next_page is False
+
+    def test_pages_of_licences(self, engine):
+        records, has_next_page = DBManager.get_staged_records(self.user, "report", limit=2)
+        assert [record["licence_number"] for record in records] == ["PC1", "PC2"]
+        assert has_next_page is True
+
+        records, has_next_page = DBManager.get_staged_records(
+            self.user, "report", limit=2, page=2
+        )
+        assert [record["licence_number"] for record in records] == ["PC3"]
+        assert has_next_page is False
+
+    def test_page_without_limit(self, engine):
+        with pytest.raises(LimitIsNotSet):
+            DBManager.get_staged_records(self.user, "report", page=2)
+
+    def test_page_exceeded(self, engine):
+        with pytest.raises(LimitExceeded):
+            DBManager.get_staged_records(self.user, "report", limit=2, page=3)
+
+    def test_session_is_closed_on_error(self, engine):
+        with patch.object(Session, "close", autospec=True) as close:
+            with pytest.raises(NoStagedProcess):
+                DBManager.get_staged_records(self.user, "unknown")
+            with pytest.raises(LimitIsNotSet):
+                DBManager.get_staged_records(self.user, "report", page=2)
+        assert close.call_count == 2
+
+    def test_aggregated_in_postgres(self, engine):
+        with patch.object(Query, "all", autospec=True, return_value=[]) as query_all:
+            DBManager.get_staged_records(self.user, "report", limit=2)
+        query = query_all.call_args.args[0]
+        sql = str(query.statement.compile(dialect=postgresql.dialect()))
+
+        assert "array_agg(pdbrd_registration.registration_number)" in sql
+        assert "GROUP BY otc_licence.licence_number, otc_operator.operator_name" in sql
+        assert "LIMIT" in sql
+
+
+class TestStreamAllRecords:
+    def test_stream_all_records(self, group_registrations):
+        user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+        fieldnames, records = DBManager.stream_all_records(
+            user, latest_only=False, active_only=True, batch_size=2
+        )
+
+        assert fieldnames[:2] == ["registrationNumber", "routeNumber"]
+        records = list(records)
+        assert sorted(
+            (r["registrationNumber"], r["variationNumber"]) for r in records
+        ) == [("PD1/1", 0), ("PD1/1", 1), ("PD1/2", 0), ("PD1/3", 0)]
+        assert all(list(r) == fieldnames for r in records)
+        assert DBManager.get_all_records(user) == records
+
+    def test_stream_latest_records(self, group_registrations):
+        user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+        fieldnames, records = DBManager.stream_all_records(
+            user, latest_only=True, active_only=True
+        )
+
+        assert "variation_rank" not in fieldnames
+        assert [(r["registrationNumber"], r["variationNumber"]) for r in records] == [
+            ("PD1/1", 1),
+            ("PD1/2", 0),
+            ("PD1/3", 0),
+        ]
+
+
+def test_licence_cache_is_upserted():
+    engine = create_engine("sqlite:///:memory:")
+    IngestionBase.metadata.create_all(engine)
+    models = Mock(OTCLicenceCache=IngestionLicenceCache)
+    first, second = datetime(2024, 3, 1), datetime(2024, 3, 2)
+    entry = {
+        "licence_number": "PC1",
+        "otc_licence_number": "PC1",
+        "licence_status": "Valid",
+        "operator_name": "Blue Sky Buses",
+        "found": True,
+        "fetched_at": first,
+    }
+    with patch(
+        "utils.db.initiate_db_variables",
+        side_effect=lambda: (models, Session(engine)),
+    ):
+        store_cached_licences(
+            [entry, {**entry, "licence_number": "PC2", "found": False, "fetched_at": first}]
         )
+        store_cached_licences([{**entry, "licence_status": "Revoked", "fetched_at": second}])
+
+        cached = fetch_cached_licences({"PC1", "PC2", "PC3"})
+
+    assert set(cached) == {"PC1", "PC2"}
+    assert cached["PC1"] == {**entry, "licence_status": "Revoked", "fetched_at": second}
+    assert cached["PC2"]["found"] is False
+
+
+class TestReports:
+    user = AuthenticatedEntity(type="user", name="testuser", group="testgroup")
+    structure = "CSV data structure check"
+    otc = "Warning - Record failed due to OTC validation"
+
+    @pytest.fixture
+    def engine(self):
+        engine = create_engine("sqlite:///:memory:")
+        IngestionBase.metadata.create_all(engine)
+        models = Mock(PDBRDReport=IngestionReport, PDBRDReportEntry=IngestionReportEntry)
+        with patch(
+            "utils.db.initiate_db_variables",
+            side_effect=lambda: (models, Session(engine)),
+        ), patch("utils.db.DBGroup.get_user", return_value=Mock(id=1, group_id=7)):
+            yield engine
+
+    def write_report(self, engine):
+        with ReportWriter("report") as report:
+            report.write(
+                self.structure,
+                {str(idx): [{"routeNumber": "Field required"}] for idx in range(2, 7)},
+            )
+            report.write(self.otc, {"7": [{"LicenceNumber": "Licence number is not found"}]})
+            assert report.remove(self.otc, {"7", "8"}) == {"7"}
+            report.write(self.otc, {"8": [{"LicenceNumber": "Licence number is not found"}]})
+            counts = dict(report.counts)
+        with Session(engine) as session:
+            session.add(
+                IngestionReport(
+                    report_id="report",
+                    user_id=1,
+                    report={
+                        "invalid_records": [
+                            {"count": count, "description": description}
+                            for description, count in counts.items()
+                        ],
+                        "valid_records_count": 3,
+                    },
+                )
+            )
+            session.commit()
+        return counts
+
+    @staticmethod
+    def count(engine, Model):
+        with Session(engine) as session:
+            return session.query(Model).count()
+
+    def test_whole_report(self, engine):
+        assert self.write_report(engine) == {self.structure: 5, self.otc: 1}
+
+        report, has_next_page = DBManager.get_report(self.user, "report")
+
+        assert has_next_page is False
+        assert report == {
+            "invalid_records": [
+                {
+                    "count": 5,
+                    "description": self.structure,
+                    "records": {
+                        str(idx): [{"routeNumber": "Field required"}] for idx in range(2, 7)
+                    },
+                },
+                {
+                    "count": 1,
+                    "description": self.otc,
+                    "records": {"8": [{"LicenceNumber": "Licence number is not found"}]},
+                },
+            ],
+            "valid_records_count": 3,
+        }
+        assert self.count(engine, IngestionReport) == 0
+        assert self.count(engine, IngestionReportEntry) == 0
+
+    def test_pages(self, engine):
+        self.write_report(engine)
+
+        pages = []
+        for page in (1, 2):
+            report, has_next_page = DBManager.get_report(
+                self.user, "report", limit=4, page=page
+            )
+            pages.append(
+                [
+                    (records["description"], list(records["records"]))
+                    for records in report["invalid_records"]
+                ]
+            )
+            if page == 1:
+                assert has_next_page is True
+                assert self.count(engine, IngestionReport) == 1
+
+        assert pages == [
+            [(self.structure, ["2", "3", "4", "5"]), (self.otc, [])],
+            [(self.structure, ["6"]), (self.otc, ["8"])],
+        ]
+        assert has_next_page is False
+        assert self.count(engine, IngestionReportEntry) == 0
+
+    def test_category(self, engine):
+        self.write_report(engine)
+
+        report, has_next_page = DBManager.get_report(self.user, "report", category=self.otc)
 
-        assert result == 1
+        assert [records["description"] for records in report["invalid_records"]] == [self.otc]
+        assert has_next_page is False
+        # The report is kept for the other categories
+        assert self.count(engine, IngestionReportEntry) == 6
 
-    @patch("utils.db.add_or_get_record", return_value=1)
-    def test_fetch_licence_record(self, mocked_db):
-        session = mocked_db
-        OTCLicence = TestModel
-        licence_record = TestModel()
-        licence_number = "Test Licence"
+    def test_page_exceeded(self, engine):
+        self.write_report(engine)
 
-        result = DBManager.fetch_licence_record(
-            licence_number, session, OTCLicence, licence_record
+        with pytest.raises(LimitExceeded):
+            DBManager.get_report(self.user, "report", limit=4, page=3)
+
+    def test_whole_report_read_in_chunks(self, engine):
+        self.write_report(engine)
+
+        with patch("utils.db.REPORT_PAGE_SIZE", 2):
+            report, has_next_page = DBManager.get_report(self.user, "report")
+
+        assert [list(records["records"]) for records in report["invalid_records"]] == [
+            ["2", "3", "4", "5", "6"],
+            ["8"],
+        ]
+        assert has_next_page is False
+        assert self.count(engine, IngestionReport) == 0
+        assert self.count(engine, IngestionReportEntry) == 0
+
+    def test_default_page_size(self, engine):
+        self.write_report(engine)
+
+        with patch("utils.db.REPORT_PAGE_SIZE", 4):
+            report, has_next_page = DBManager.get_report(self.user, "report", page=1)
+            assert [len(records["records"]) for records in report["invalid_records"]] == [4, 0]
+            assert has_next_page is True
+            # The report is kept until its last page is read
+            assert self.count(engine, IngestionReportEntry) == 6
+
+            report, has_next_page = DBManager.get_report(self.user, "report", page=2)
+            assert [len(records["records"]) for records in report["invalid_records"]] == [1, 1]
+            assert has_next_page is False
+        assert self.count(engine, IngestionReport) == 0
+        assert self.count(engine, IngestionReportEntry) == 0
+
+    def test_expired_reports_are_deleted(self, engine):
+        self.write_report(engine)
+        with ReportWriter("report-2") as report:
+            report.write(self.structure, {"2": [{"routeNumber": "Field required"}]})
+        with Session(engine) as session:
+            session.query(IngestionReport).update(
+                {"created_at": datetime.utcnow() - timedelta(days=8)}
+            )
+            session.commit()
+        # The report read by category only is kept for the other categories
+        DBManager.get_report(self.user, "report", category=self.otc)
+
+        with patch("utils.db.DBGroup.get_or_create_user", return_value=Mock(id=1)):
+            send_report_to_db({"valid_records_count": 1}, "testuser", "testgroup", "report-2")
+
+        with Session(engine) as session:
+            assert [report.report_id for report in session.query(IngestionReport)] == [
+                "report-2"
+            ]
+            assert [entry.report_id for entry in session.query(IngestionReportEntry)] == [
+                "report-2"
+            ]
+
+    def test_report_without_entries(self, engine):
+        with Session(engine) as session:
+            session.add(
+                IngestionReport(
+                    report_id="report",
+                    user_id=1,
+                    report={"invalid_file": [{"description": "File is infected"}]},
+                )
+            )
+            session.commit()
+
+        assert DBManager.get_report(self.user, "report", limit=4) == (
+            {"invalid_file": [{"description": "File is infected"}]},
+            False,
         )
+        assert DBManager.get_report(self.user, "report") is None
+
+    def test_entries_are_removed_when_the_upload_fails(self, engine):
+        with pytest.raises(ValueError):
+            with ReportWriter("report") as report:
+                report.write(self.structure, {"2": [{"routeNumber": "Field required"}]})
+                raise ValueError("Upload failed")
 
-        assert result == 1
+        assert self.count(engine, IngestionReportEntry) == 0
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cognitojwt import CognitoJWTException
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+from auth.jwks import JWKSCache, VerifiedClaimsCache, decode_token
+
+
+def generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    public_jwk = jwk.construct(public_pem, "RS256").to_dict()
+    public_jwk.update({"kid": kid, "use": "sig"})
+    return private_pem, public_jwk
+
+
+def sign(private_pem, kid, **claims):
+    claims = {"sub": "1234", "exp": int(time.time()) + 3600, **claims}
+    return jwt.encode(claims, private_pem, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture
+def jwks_server():
+    """Local stand-in of the Cognito JWKS endpoint, counting its requests"""
+    state = {"keys": [], "requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"] += 1
+            body = json.dumps({"keys": state["keys"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{server.server_port}/.well-known/jwks.json"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_keys_are_fetched_once(jwks_server):
+    private_pem, public_jwk = generate_key("key-1")
+    jwks_server["keys"] = [public_jwk]
+    cache = JWKSCache(jwks_server["url"], ttl=3600, min_refetch_interval=0)
+
+    assert decode_token(sign(private_pem, "key-1"), cache)["sub"] == "1234"
+    assert decode_token(sign(private_pem, "key-1", sub="5678"), cache)["sub"] == "5678"
+    assert jwks_server["requests"] == 1
+
+
+def test_keys_are_refetched_on_unknown_kid(jwks_server):
+    old_pem, old_jwk = generate_key("key-1")
+    new_pem, new_jwk = generate_key("key-2")
+    jwks_server["keys"] = [old_jwk]
+    cache = JWKSCache(jwks_server["url"], ttl=3600, min_refetch_interval=0)
+    decode_token(sign(old_pem, "key-1"), cache)
+
+    # The user pool rotated its keys
+    jwks_server["keys"] = [old_jwk, new_jwk]
+    assert decode_token(sign(new_pem, "key-2"), cache)["sub"] == "1234"
+    assert jwks_server["requests"] == 2
+
+    with pytest.raises(CognitoJWTException):
+        decode_token(sign(new_pem, "key-3"), cache)
+    assert jwks_server["requests"] == 3
+
+
+def test_unknown_kid_refetches_are_throttled(jwks_server):
+    private_pem, public_jwk = generate_key("key-1")
+    jwks_server["keys"] = [public_jwk]
+    cache = JWKSCache(jwks_server["url"], ttl=3600, min_refetch_interval=60)
+    decode_token(sign(private_pem, "key-1"), cache)
+
+    for _ in range(3):
+        with pytest.raises(CognitoJWTException):
+            decode_token(sign(private_pem, "forged"), cache)
+    assert jwks_server["requests"] == 1
+
+
+def test_keys_are_refreshed_after_ttl(jwks_server):
+    private_pem, public_jwk = generate_key("key-1")
+    jwks_server["keys"] = [public_jwk]
+    cache = JWKSCache(jwks_server["url"], ttl=0, min_refetch_interval=60)
+
+    decode_token(sign(private_pem, "key-1"), cache)
+    decode_token(sign(private_pem, "key-1"), cache)
+    assert jwks_server["requests"] == 2
+
+
+def test_invalid_tokens_are_rejected(jwks_server):
+    private_pem, public_jwk = generate_key("key-1")
+    other_pem, _ = generate_key("key-1")
+    jwks_server["keys"] = [public_jwk]
+    cache = JWKSCache(jwks_server["url"], ttl=3600, min_refetch_interval=0)
+
+    with pytest.raises(CognitoJWTException, match="Signature"):
+        decode_token(sign(other_pem, "key-1"), cache)
+    with pytest.raises(CognitoJWTException, match="expired"):
+        decode_token(sign(private_pem, "key-1", exp=int(time.time()) - 1), cache)
+
+
+def test_verified_claims_cache():
+    cache = VerifiedClaimsCache(maxsize=2)
+    now = int(time.time())
+    cache.set("token-1", {"sub": "1", "exp": now + 60})
+    cache.set("token-2", {"sub": "2", "exp": now + 60})
+    assert cache.get("token-1") == {"sub": "1", "exp": now + 60}
+
+    # token-2 is the least recently used
+    cache.set("token-3", {"sub": "3", "exp": now + 60})
+    assert cache.get("token-2") is None
+    assert cache.get("token-1")["sub"] == "1"
+
+    cache.set("token-4", {"sub": "4", "exp": now - 1})
+    assert cache.get("token-4") is None
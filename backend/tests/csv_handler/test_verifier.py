@@ -1,5 +1,6 @@
+import time
 from unittest.mock import MagicMock, patch
-from auth.verifier import TokenVerifier, token_verifier
+from auth.verifier import TokenVerifier, get_jwks_cache, token_verifier
 import pytest
 from utils.exceptions import AppClientIdIsNotSet, RegionIsNotSet, UserPoolIdIsNotSet
 from cognitojwt import CognitoJWTException
@@ -9,19 +10,20 @@ from fastapi import HTTPException
 @patch("auth.verifier.AWS_REGION", "test_region")
 @patch("auth.verifier.USERPOOL_ID", "test_userpool_id")
 @patch("auth.verifier.APP_CLIENT_ID", "test_app_client_id")
-@patch("cognitojwt.decode")
-def test_verify_token_valid_token(mock_cognitojwt_decode):
+@patch("auth.verifier.decode_token", return_value={"sub": "1234", "exp": 0})
+def test_verify_token_valid_token(mock_decode_token):
     # Create a valid token
     token = "valid_token"
     # Create an instance of TokenVerifier
     verifier = TokenVerifier(token)
-    verifier.verify_token()
-    # mock_cognitojwt_decode.return_value = {"sub": "1234"}
-    # assert verifier.token == "valid_token"
-    mock_cognitojwt_decode.assert_called_once_with(
+    assert verifier.verify_token() is True
+    assert verifier.claims == {"sub": "1234", "exp": 0}
+    mock_decode_token.assert_called_once_with(
         "valid_token",
-        "test_region",
-        "test_userpool_id",
+        get_jwks_cache("test_region", "test_userpool_id"),
+    )
+    assert get_jwks_cache("test_region", "test_userpool_id").keys_url == (
+        "https://cognito-idp.test_region.amazonaws.com/test_userpool_id/.well-known/jwks.json"
     )
 
 
@@ -52,7 +54,7 @@ def test_verify_token_missing_region():
 @patch("auth.verifier.AWS_REGION", "test_region")
 @patch("auth.verifier.USERPOOL_ID", "test_userpool_id")
 @patch("auth.verifier.APP_CLIENT_ID", "test_app_client_id")
-@patch("cognitojwt.decode")
+@patch("auth.verifier.decode_token")
 def test_verify_token_invalid_token(mock_cognitojwt_decode):
     # mock_cognitojwt_decode.side_effect = Exception("Invalid token")
     # Create an invalid token
@@ -82,3 +84,17 @@ def test_token_verifier_invalid_token(mock_verify_token, mock_log):
     mock_log.assert_called_once_with("Token verification status: False")
     # Acit
     # Asisert
+
+
+@patch("auth.verifier.AWS_REGION", "test_region")
+@patch("auth.verifier.USERPOOL_ID", "test_userpool_id")
+@patch("auth.verifier.APP_CLIENT_ID", "test_app_client_id")
+@patch("auth.verifier.decode_token")
+def test_verify_token_reuses_verified_claims(mock_decode_token):
+    mock_decode_token.return_value = {"sub": "1234", "exp": time.time() + 60}
+
+    assert TokenVerifier("session_token").verify_token() is True
+    verifier = TokenVerifier("session_token")
+    assert verifier.verify_token() is True
+    assert verifier.claims["sub"] == "1234"
+    mock_decode_token.assert_called_once()
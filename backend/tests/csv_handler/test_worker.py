@@ -0,0 +1,22 @@
+from unittest.mock import patch
+
+from utils.pydant_model import UploadJob
+from worker import lambda_handler
+
+
+@patch("worker.process_upload_job")
+def test_lambda_handler(mock_process):
+    job = UploadJob(
+        report_id="report-1", stage_id=7, user_name="testuser", group_name="testgroup"
+    )
+    event = {
+        "Records": [
+            {"messageId": "1", "body": job.model_dump_json()},
+            {"messageId": "2", "body": "not a job"},
+        ]
+    }
+
+    response = lambda_handler(event, None)
+
+    mock_process.assert_called_once_with(job)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
@@ -1,9 +1,19 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pytest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import requests
 from os import path
-from src.data_catalogue.app import DATA_CATALOGUE_URL, lambda_handler
-from zipfile import BadZipFile
+from io import BytesIO, TextIOWrapper
+import src.data_catalogue.app as data_catalogue_app
+from src.data_catalogue.app import (
+    DATA_CATALOGUE_URL,
+    copy_field,
+    iter_catalogue_entries,
+    iter_hashed_entries,
+    lambda_handler,
+)
+from zipfile import BadZipFile, ZipFile
 
 test_script_path = path.dirname(path.abspath(__file__))
 text_zip_path = path.join(test_script_path, "assets", "text.zip")
@@ -38,3 +48,273 @@ def test_valid_file(requests_mock):
             lambda_handler(None, None)
         except Exception as e:
             pytest.fail(f"Failed to refresh database {e}")
+
+
+INDEX_DEFINITION = (
+    "CREATE INDEX idx_bods_data_catalogue_xml_service_code "
+    "ON public.bods_data_catalogue USING btree (xml_service_code)"
+)
+
+
+@pytest.fixture
+def copied():
+    """The statements executed and the CSV sent to COPY by the refresh"""
+    copied = {
+        "statements": [],
+        "parameters": [],
+        "copy": [],
+        "stored": [],
+        "validators": None,
+    }
+
+    def execute(statement, *args):
+        copied["statements"].append(str(statement))
+        copied["parameters"].append(args[0] if args else None)
+        result = MagicMock()
+        if "from bods_data_catalogue_source" in str(statement):
+            result.mappings.return_value.first.return_value = copied["validators"]
+        elif "pg_indexes" in str(statement):
+            result.all.return_value = [
+                ("idx_bods_data_catalogue_xml_service_code", INDEX_DEFINITION)
+            ]
+        else:
+            result.all.return_value = copied["stored"]
+        return result
+
+    with patch("src.data_catalogue.app.Session") as mock_session:
+        session = mock_session.return_value.__enter__.return_value
+        session.execute.side_effect = execute
+        cursor = session.connection.return_value.connection.cursor.return_value
+        # psycopg2 reads the file in chunks of 8192 characters
+        cursor.copy_expert.side_effect = lambda sql, file: copied["copy"].append(
+            "".join(iter(lambda: file.read(8192), ""))
+        )
+        copied["session"] = session
+        yield copied
+
+
+def test_catalogue_is_copied_into_staging_table_and_swapped(requests_mock, copied):
+    requests_mock.get(DATA_CATALOGUE_URL, content=open(valid_zip_path, "rb").read())
+    assert lambda_handler({"mode": "full"}, None) == {"mode": "full", "rows": 5}
+
+    rows = copied["copy"][0].splitlines()
+    assert len(rows) == 5
+    assert rows[0].startswith(
+        '"PF0007157/3",21,"Normal Stopping","Published","Up to date",False,"'
+    )
+    # Blank fields are left unquoted, and loaded as NULL
+    assert rows[1].startswith(
+        '"UZ000KBUS/CS",,,"Published","OTC variation not published",True,"'
+    )
+    statements = copied["statements"]
+    assert statements.index(
+        "alter table bods_data_catalogue rename to bods_data_catalogue_previous"
+    ) < statements.index("alter table bods_data_catalogue_staging rename to bods_data_catalogue")
+    assert (
+        "CREATE INDEX idx_bods_data_catalogue_xml_service_code_staging "
+        "ON public.bods_data_catalogue_staging USING btree (xml_service_code)"
+    ) in statements
+    assert statements[-3:-1] == [
+        "alter index idx_bods_data_catalogue_xml_service_code_staging "
+        "rename to idx_bods_data_catalogue_xml_service_code",
+        "update pdbrd_group set licence_status_refreshed_at = null",
+    ]
+    copied["session"].commit.assert_called_once()
+
+
+def test_copy_fields():
+    assert copy_field(None) == ""
+    assert copy_field("") == '""'
+    assert copy_field('Say "hi", then\nleave') == '"Say ""hi"", then\nleave"'
+    assert copy_field(21) == "21"
+    assert copy_field(False) == "False"
+
+
+def test_invalid_row_is_not_swapped(requests_mock, copied):
+    zipped = BytesIO()
+    with ZipFile(zipped, "w") as zipfile:
+        zipfile.writestr(
+            "timetables_data_catalogue.csv",
+            "XML:Service Code,OTC:Variation Number,OTC:Service Type Description,"
+            "Published Status,Timeliness Status,Requires Attention\n"
+            "PF1:1,1,Normal Stopping,Published,Up to date,No\n"
+            "PF1:2,not a number,Normal Stopping,Published,Up to date,No\n",
+        )
+    requests_mock.get(DATA_CATALOGUE_URL, content=zipped.getvalue())
+    with pytest.raises(ValueError, match="line 3"):
+        lambda_handler({"mode": "full"}, None)
+
+    assert not any("rename" in statement for statement in copied["statements"])
+    copied["session"].commit.assert_not_called()
+    copied["session"].rollback.assert_called_once()
+
+
+def test_incremental_refresh_applies_only_changes(requests_mock, copied):
+    with ZipFile(valid_zip_path) as zipfile:
+        with zipfile.open("timetables_data_catalogue.csv") as csv_file:
+            hashes = [
+                row_hash
+                for _, row_hash in iter_hashed_entries(
+                    iter_catalogue_entries(TextIOWrapper(csv_file))
+                )
+            ]
+    copied["stored"] = [
+        (1, hashes[0], "PF0007157/3", 21),
+        (2, hashes[1], "UZ000KBUS/CS", None),
+        (3, hashes[2], "PF0007157/1", 17),
+        # Changed since the last refresh
+        (4, "previous", "PF0007157/19", 21),
+        # Removed from the catalogue
+        (5, "removed", "PF0000001/1", 1),
+        (6, None, "PF0000002/1", 1),
+    ]
+    requests_mock.get(DATA_CATALOGUE_URL, content=open(valid_zip_path, "rb").read())
+
+    summary = lambda_handler({}, None)
+
+    assert summary == {
+        "mode": "incremental",
+        "rows": 5,
+        "rows_inserted": 2,
+        "rows_deleted": 3,
+        "inserted": 1,
+        "updated": 1,
+        "deleted": 2,
+        "unchanged": 3,
+        "service_codes": ["PF0000001/1", "PF0000002/1", "PF0007157/19", "PF0007157/24"],
+    }
+    rows = copied["copy"][0].splitlines()
+    assert [row.split(",")[0] for row in rows] == ['"PF0007157/19"', '"PF0007157/24"']
+    statements = copied["statements"]
+    delete = statements.index("delete from bods_data_catalogue where id = any(:ids)")
+    assert copied["parameters"][delete] == {"ids": [4, 5, 6]}
+    # Only the groups with registrations of the changed services are invalidated
+    assert "update pdbrd_group set licence_status_refreshed_at = null where id in" in statements[-2]
+    assert copied["parameters"][-2] == {"service_codes": summary["service_codes"]}
+    assert not any("rename" in statement for statement in statements)
+
+
+def test_incremental_refresh_copies_blank_fields_as_null(requests_mock, copied):
+    with ZipFile(valid_zip_path) as zipfile:
+        with zipfile.open("timetables_data_catalogue.csv") as csv_file:
+            hashed_entries = list(
+                iter_hashed_entries(iter_catalogue_entries(TextIOWrapper(csv_file)))
+            )
+    # Every row is unchanged but the one without a variation number
+    copied["stored"] = [
+        (id, row_hash, entry.xml_service_code, entry.variation_number)
+        for id, (entry, row_hash) in enumerate(hashed_entries, 1)
+        if entry.xml_service_code != "UZ000KBUS/CS"
+    ]
+    requests_mock.get(DATA_CATALOGUE_URL, content=open(valid_zip_path, "rb").read())
+
+    summary = lambda_handler({}, None)
+
+    assert summary["rows_inserted"] == 1
+    assert copied["copy"][0].startswith(
+        '"UZ000KBUS/CS",,,"Published","OTC variation not published",True,"'
+    )
+
+
+def test_incremental_refresh_without_changes(requests_mock, copied):
+    with ZipFile(valid_zip_path) as zipfile:
+        with zipfile.open("timetables_data_catalogue.csv") as csv_file:
+            copied["stored"] = [
+                (id, row_hash, entry.xml_service_code, entry.variation_number)
+                for id, (entry, row_hash) in enumerate(
+                    iter_hashed_entries(iter_catalogue_entries(TextIOWrapper(csv_file)))
+                )
+            ]
+    requests_mock.get(DATA_CATALOGUE_URL, content=open(valid_zip_path, "rb").read())
+
+    summary = lambda_handler({}, None)
+
+    assert summary["unchanged"] == 5
+    assert summary["service_codes"] == []
+    assert copied["copy"] == [""]
+    assert not any(
+        statement.startswith(("delete", "update")) for statement in copied["statements"]
+    )
+
+
+@pytest.fixture
+def catalogue_server(monkeypatch):
+    """Local stand-in of the BODS catalogue endpoint, honouring conditional requests"""
+    state = {"etag": '"v1"', "last_modified": "Wed, 01 May 2024 10:00:00 GMT", "requests": []}
+    with open(valid_zip_path, "rb") as f:
+        body = f.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"].append(dict(self.headers))
+            if self.headers.get("If-None-Match") == state["etag"]:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", state["etag"])
+            self.send_header("Last-Modified", state["last_modified"])
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/catalogue/"
+    monkeypatch.setattr(data_catalogue_app, "DATA_CATALOGUE_URL", url)
+    state["url"] = url
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_catalogue_is_downloaded_and_its_validators_stored(catalogue_server, copied):
+    summary = lambda_handler({}, None)
+
+    assert summary["rows"] == 5
+    assert "If-None-Match" not in catalogue_server["requests"][0]
+    assert copied["parameters"][-1] == {
+        "url": catalogue_server["url"],
+        "etag": '"v1"',
+        "last_modified": "Wed, 01 May 2024 10:00:00 GMT",
+    }
+    copied["session"].commit.assert_called_once()
+
+
+def test_unchanged_catalogue_is_not_refreshed(catalogue_server, copied):
+    copied["validators"] = {
+        "etag": '"v1"',
+        "last_modified": "Wed, 01 May 2024 10:00:00 GMT",
+    }
+
+    assert lambda_handler({}, None) == {"mode": "incremental", "not_modified": True}
+
+    assert catalogue_server["requests"][0]["If-None-Match"] == '"v1"'
+    assert catalogue_server["requests"][0]["If-Modified-Since"] == (
+        "Wed, 01 May 2024 10:00:00 GMT"
+    )
+    assert copied["copy"] == []
+    copied["session"].commit.assert_not_called()
+
+
+def test_changed_catalogue_is_refreshed(catalogue_server, copied):
+    copied["validators"] = {"etag": '"v0"', "last_modified": None}
+
+    assert lambda_handler({}, None)["rows"] == 5
+
+    assert catalogue_server["requests"][0]["If-None-Match"] == '"v0"'
+    assert "If-Modified-Since" not in catalogue_server["requests"][0]
+    assert copied["parameters"][-1]["etag"] == '"v1"'
+
+
+def test_full_refresh_is_not_conditional(catalogue_server, copied):
+    copied["validators"] = {"etag": '"v1"', "last_modified": None}
+
+    assert lambda_handler({"mode": "full"}, None) == {"mode": "full", "rows": 5}
+
+    assert "If-None-Match" not in catalogue_server["requests"][0]
@@ -9,7 +9,8 @@ environ["OTC_API_KEY"] = "testkey"
 environ["OTC_API_URL"] = "https://example.com"
 
 from fastapi.testclient import TestClient
-from src.otc_client.app import OTCAuthenticator, app
+import src.otc_client.app as otc_app
+from src.otc_client.app import OTCAuthenticator, TokenBucket, app, get_otc_client
 
 
 from assets.validotcresponses import (
@@ -27,6 +28,14 @@ environ["OTC_API_URL"] = "https://example.com"
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def reset_otc_client():
+    # The client and its token are shared by the requests of a container
+    otc_app._otc_client = None
+    yield
+    otc_app._otc_client = None
+
+
 def test_authenticator_success(requests_mock):
     requests_mock.post(
         "https://example.com/testid/oauth2/v2.0/token", json=VALID_AUTH_RESPONSE
@@ -35,6 +44,37 @@ def test_authenticator_success(requests_mock):
     assert authenticator.token == VALID_AUTH_RESPONSE["access_token"]
 
 
+def test_token_is_reused_across_requests(requests_mock):
+    token_mock = requests_mock.post(
+        "https://example.com/testid/oauth2/v2.0/token", json=VALID_AUTH_RESPONSE
+    )
+    requests_mock.get(
+        "https://example.com/?limit=1&page=1&identifier=NOTAVALIDLICENCE&latestVariation=true",
+        status_code=204,
+    )
+    for _ in range(2):
+        returned_output = client.post("/api/v1/otc/licences", json=["NOTAVALIDLICENCE"])
+        assert returned_output.status_code == 200
+
+    assert get_otc_client() is otc_app._otc_client
+    assert token_mock.call_count == 1
+    assert requests_mock.last_request.headers["Authorization"] == (
+        VALID_AUTH_RESPONSE["access_token"]
+    )
+
+
+def test_token_is_refreshed_before_expiry(requests_mock):
+    token_mock = requests_mock.post(
+        "https://example.com/testid/oauth2/v2.0/token",
+        json={**VALID_AUTH_RESPONSE, "expires_in": 60},
+    )
+    authenticator = OTCAuthenticator()
+    # The token expires within the refresh margin
+    authenticator.token
+    authenticator.token
+    assert token_mock.call_count == 2
+
+
 def test_authenticator_fail(requests_mock, caplog):
     requests_mock.post("https://example.com/testid/oauth2/v2.0/token", status_code=400)
     returned_output = client.post("/api/v1/otc/licences", json=["NOTAVALIDLICENCE"])
@@ -70,7 +110,19 @@ def test_invalid_input():
 
 
 _expected_none = {
-    "licences": [{"licence_details": None, "licence_number": "NOTAVALIDLICENCE", "operator_details": None}]
+    "licences": [
+        {"licence_details": None, "licence_number": "NOTAVALIDLICENCE", "operator_details": None, "error": None}
+    ]
+}
+_expected_malformed = {
+    "licences": [
+        {
+            "licence_details": None,
+            "licence_number": "NOTAVALIDLICENCE",
+            "operator_details": None,
+            "error": "malformed_response",
+        }
+    ]
 }
 
 @pytest.mark.parametrize(
@@ -78,12 +130,12 @@ _expected_none = {
     [
         pytest.param(
             {"notReport": None},
-            400, None, None,
+            200, "Could not parse license", _expected_malformed,
             id="missing_report_key",
         ),
         pytest.param(
             {"report": None},
-            400, None, None,
+            200, "Could not parse license", _expected_malformed,
             id="report_is_none",
         ),
         pytest.param(
@@ -105,6 +157,7 @@ _expected_none = {
                         "licence_details": {"licence_number": "NOTAVALIDLICENCE", "licence_status": None},
                         "licence_number": "NOTAVALIDLICENCE",
                         "operator_details": None,
+                        "error": None,
                     }
                 ]
             },
@@ -124,3 +177,83 @@ def test_malformed_response(requests_mock, caplog, mock_json, expected_status, e
             assert expected_log in caplog.text
         if expected_output:
             assert returned_output.json() == expected_output
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(otc_app, "RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(otc_app, "RETRY_MAX_DELAY", 0.01)
+
+
+def _licence_url(licence):
+    return f"https://example.com/?limit=1&page=1&identifier={licence}&latestVariation=true"
+
+
+def _licences_by_number(returned_output):
+    return {licence["licence_number"]: licence for licence in returned_output.json()["licences"]}
+
+
+def test_throttled_licence_is_retried(requests_mock, fast_retries):
+    licence_mock = requests_mock.get(
+        _licence_url("PH1020951"),
+        [
+            {"status_code": 429, "headers": {"Retry-After": "0"}},
+            {"status_code": 503},
+            {"json": VALID_RESPONSES["PH1020951"]},
+        ],
+    )
+    with patch("src.otc_client.app.OTCAuthenticator"):
+        returned_output = client.post("/api/v1/otc/licences", json=["PH1020951"])
+
+    assert returned_output.status_code == 200
+    assert licence_mock.call_count == 3
+    licence = _licences_by_number(returned_output)["PH1020951"]
+    assert licence["error"] is None
+    assert licence["operator_details"] == {"operator_name": "STAGECOACH DEVON LTD"}
+
+
+def test_failed_licences_do_not_fail_the_request(requests_mock, fast_retries, monkeypatch):
+    monkeypatch.setattr(otc_app, "MAX_RETRIES", 2)
+    requests_mock.get(_licence_url("PH1020951"), json=VALID_RESPONSES["PH1020951"])
+    throttled_mock = requests_mock.get(_licence_url("THROTTLED"), status_code=429)
+    requests_mock.get(_licence_url("FORBIDDEN"), status_code=403)
+    with patch("src.otc_client.app.OTCAuthenticator"):
+        returned_output = client.post(
+            "/api/v1/otc/licences", json=["PH1020951", "THROTTLED", "FORBIDDEN"]
+        )
+
+    assert returned_output.status_code == 200
+    licences = _licences_by_number(returned_output)
+    assert licences["PH1020951"]["error"] is None
+    assert licences["THROTTLED"] == {
+        "licence_number": "THROTTLED",
+        "licence_details": None,
+        "operator_details": None,
+        "error": "rate_limited",
+    }
+    assert throttled_mock.call_count == 3
+    assert licences["FORBIDDEN"]["error"] == "http_error"
+
+
+def test_licence_timeout(requests_mock, monkeypatch):
+    monkeypatch.setattr(otc_app, "LICENCE_TIMEOUT", 0.05)
+    monkeypatch.setattr(otc_app, "retry_delay", lambda attempt, retry_after=None: 1)
+    licence_mock = requests_mock.get(_licence_url("PH1020951"), status_code=502)
+    with patch("src.otc_client.app.OTCAuthenticator"):
+        returned_output = client.post("/api/v1/otc/licences", json=["PH1020951"])
+
+    # The backoff would outlast the licence timeout, so it is not retried
+    assert _licences_by_number(returned_output)["PH1020951"]["error"] == "timeout"
+    assert licence_mock.call_count == 1
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.acquire()
+    assert bucket.acquire()
+    # The next token is refilled in a second
+    assert not bucket.acquire(deadline=otc_app.time.monotonic() + 0.1)
+
+    bucket = TokenBucket(rate=100, capacity=1)
+    assert bucket.acquire()
+    assert bucket.acquire(deadline=otc_app.time.monotonic() + 0.5)
@@ -0,0 +1,203 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+import pytest
+from utils.mocker import MockData
+from utils.validate import (
+    index_licence_details,
+    licence_cache_metrics,
+    licence_detail,
+    lookup_licences,
+    validate_licence_number_existence,
+)
+
+
+def test_index_licence_details():
+    otc_api_response = MockData.mock_otc_licencd_and_operator_api([])
+    licence_index = index_licence_details(otc_api_response)
+
+    assert list(licence_index) == ["PC7654322", "x001"]
+    assert licence_detail("PC7654322", licence_index).operator_details.operator_name == "string"
+    assert licence_detail("x001", licence_index).licence_details is None
+    assert licence_detail("x002", licence_index) is None
+
+
+def test_index_licence_details_with_invalid_response():
+    assert index_licence_details(None) == {}
+
+
+def test_index_licence_details_skips_malformed_licences():
+    licences = MockData.mock_otc_licencd_and_operator_api([])["licences"]
+    licence_index = index_licence_details(
+        {"licences": [{"licence_number": "PC1"}, *licences]}
+    )
+
+    # The licences after the malformed one are still indexed
+    assert list(licence_index) == ["PC7654322", "x001"]
+
+
+def otc_api_response(*not_found):
+    response = MockData.mock_otc_licencd_and_operator_api([])
+    response["licences"] += [
+        {"licence_number": licence_number, "licence_details": None, "operator_details": None}
+        for licence_number in not_found
+    ]
+    return response
+
+
+@patch("utils.validate.store_cached_licences")
+@patch("utils.validate.fetch_cached_licences", return_value={})
+@patch("utils.validate.verify_otc_api", return_value=otc_api_response("x002"))
+def test_validate_licence_number_existence(mock_verify_otc_api, *_):
+    found, not_found = MockData.mock_user_csv_record()
+    uploaded_records = {
+        "valid_records": {"2": found, "3": not_found},
+        "invalid_records": [],
+    }
+
+    validate_licence_number_existence(uploaded_records)
+
+    mock_verify_otc_api.assert_called_once()
+    assert list(uploaded_records["valid_records"]) == ["2"]
+    record, licence = uploaded_records["valid_records"]["2"]
+    assert record is found
+    assert licence.licence_number == "PC7654322"
+    assert uploaded_records["invalid_records"] == [
+        {
+            "records": {
+                "3": [{"LicenceNumber": "Licence number is not found in the OTC DB"}]
+            },
+            "description": "Warning - Record failed due to OTC validation",
+        }
+    ]
+
+
+def cache_entry(licence_number, found=True, age=timedelta(0)):
+    return {
+        "licence_number": licence_number,
+        "otc_licence_number": licence_number if found else None,
+        "licence_status": "Valid" if found else None,
+        "operator_name": "Blue Sky Buses" if found else None,
+        "found": found,
+        "fetched_at": datetime.now(timezone.utc).replace(tzinfo=None) - age,
+    }
+
+
+@pytest.fixture
+def licence_cache():
+    cache = {}
+    with patch(
+        "utils.validate.fetch_cached_licences",
+        side_effect=lambda numbers: {n: cache[n] for n in numbers if n in cache},
+    ), patch(
+        "utils.validate.store_cached_licences",
+        side_effect=lambda entries: cache.update(
+            {entry["licence_number"]: entry for entry in entries}
+        ),
+    ):
+        yield cache
+
+
+@patch(
+    "utils.validate.verify_otc_api",
+    return_value=MockData.mock_otc_licencd_and_operator_api([]),
+)
+def test_lookup_licences_reads_through_the_cache(mock_verify_otc_api, licence_cache):
+    licence_cache_metrics.clear()
+    licences = lookup_licences({"PC7654322", "x001"})
+    assert licences["PC7654322"].operator_details.operator_name == "string"
+    assert licences["x001"].licence_details is None
+    assert licence_cache["PC7654322"]["found"] is True
+    # Licences not found are cached too
+    assert licence_cache["x001"]["found"] is False
+
+    licences = lookup_licences({"PC7654322", "x001"})
+    mock_verify_otc_api.assert_called_once()
+    assert licences["PC7654322"].licence_details.licence_number == "string"
+    assert licences["x001"] is None
+    assert licence_cache_metrics == {"misses": 2, "hits": 1, "negative_hits": 1}
+
+
+@patch(
+    "utils.validate.verify_otc_api",
+    return_value=MockData.mock_otc_licencd_and_operator_api([]),
+)
+def test_lookup_licences_refreshes_stale_entries(mock_verify_otc_api, licence_cache):
+    licence_cache["PC7654322"] = cache_entry("PC7654322", age=timedelta(days=2))
+    licence_cache["x001"] = cache_entry("x001", found=False, age=timedelta(minutes=5))
+    licence_cache["PC1"] = cache_entry("PC1", found=False, age=timedelta(hours=2))
+
+    licences = lookup_licences({"PC7654322", "x001", "PC1"})
+
+    mock_verify_otc_api.assert_called_once_with({"PC7654322", "PC1"})
+    assert licences["PC7654322"].operator_details.operator_name == "string"
+    assert licences["x001"] is None
+    # Licences missing from the response of the OTC API failed, and are not cached
+    assert licences["PC1"].error == "lookup_failed"
+    assert licence_cache["PC1"]["fetched_at"] < licence_cache["PC7654322"]["fetched_at"]
+
+
+@patch("utils.validate.verify_otc_api", return_value=None)
+def test_lookup_licences_does_not_cache_failures(mock_verify_otc_api, licence_cache):
+    assert lookup_licences({"PC7654322"})["PC7654322"].error == "lookup_failed"
+    assert licence_cache == {}
+
+
+@patch(
+    "utils.validate.verify_otc_api",
+    return_value={
+        "licences": [
+            {
+                "licence_number": "PC7654322",
+                "licence_details": None,
+                "operator_details": None,
+                "error": "rate_limited",
+            }
+        ]
+    },
+)
+def test_lookup_licences_does_not_cache_licence_errors(mock_verify_otc_api, licence_cache):
+    # A licence the OTC API could not fetch is not cached as not found
+    assert lookup_licences({"PC7654322"})["PC7654322"].error == "rate_limited"
+    assert licence_cache == {}
+
+
+@patch("utils.validate.store_cached_licences")
+@patch("utils.validate.fetch_cached_licences", return_value={})
+@patch("utils.validate.verify_otc_api")
+def test_validate_licence_number_existence_lookup_failed(mock_verify_otc_api, *_):
+    found, not_found = MockData.mock_user_csv_record()
+    response = otc_api_response("x002")
+    response["licences"][0].update(
+        {"licence_details": None, "operator_details": None, "error": "timeout"}
+    )
+    mock_verify_otc_api.return_value = response
+    uploaded_records = {
+        "valid_records": {"2": found, "3": not_found},
+        "invalid_records": [],
+    }
+    licence_index = {}
+
+    validate_licence_number_existence(uploaded_records, licence_index)
+
+    assert uploaded_records["valid_records"] == {}
+    assert uploaded_records["invalid_records"] == [
+        {
+            "records": {
+                "3": [{"LicenceNumber": "Licence number is not found in the OTC DB"}]
+            },
+            "description": "Warning - Record failed due to OTC validation",
+        },
+        {
+            "records": {
+                "2": [
+                    {
+                        "LicenceNumber": "Licence number could not be checked in the OTC DB, please retry"
+                    }
+                ]
+            },
+            "description": "OTC lookup failed, retry",
+        },
+    ]
+    # The licence is looked up again by the next batch
+    assert "PC7654322" not in licence_index
+    assert licence_index["x002"].licence_details is None
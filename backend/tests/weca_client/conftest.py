@@ -0,0 +1,56 @@
+import importlib
+import sys
+from os import path
+
+import pytest
+
+WECA_CLIENT_PATH = path.join(
+    path.dirname(path.abspath(__file__)), "..", "..", "src", "weca_client"
+)
+# weca_client's packages and modules have the same names as csv_handler's
+WECA_PACKAGES = ("utils", "managers")
+WECA_MODULES = ("app",)
+
+
+def _is_weca_package_module(name):
+    return name in WECA_MODULES or any(
+        name == package or name.startswith(f"{package}.") for package in WECA_PACKAGES
+    )
+
+
+@pytest.fixture(scope="session")
+def import_weca_module():
+    """Import a module of weca_client, the csv_handler modules of the same
+    names are restored afterwards"""
+
+    def _import(name):
+        shadowed = {
+            module_name: module
+            for module_name, module in sys.modules.items()
+            if _is_weca_package_module(module_name)
+        }
+        for module_name in shadowed:
+            del sys.modules[module_name]
+        # csv_handler's utils is a regular package, it is found before weca_client's
+        # namespace package wherever it is on the path
+        sys_path = list(sys.path)
+        sys.path[:] = [WECA_CLIENT_PATH] + [
+            entry
+            for entry in sys_path
+            if not any(
+                path.isdir(path.join(entry, package)) for package in WECA_PACKAGES
+            )
+        ]
+        try:
+            return importlib.import_module(name)
+        finally:
+            sys.path[:] = sys_path
+            for module_name in [
+                module_name
+                for module_name in sys.modules
+                if _is_weca_package_module(module_name)
+            ]:
+                del sys.modules[module_name]
+            sys.modules.update(shadowed)
+
+    return _import
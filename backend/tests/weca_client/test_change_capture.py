@@ -0,0 +1,154 @@
+import pytest
+
+
+class FakeFingerprints:
+    """RecordFingerprints keeping the fingerprints in memory"""
+
+    def __init__(self, stored=None):
+        self.stored = stored or {}
+
+    def fetch(self, keys):
+        return {key: self.stored[key] for key in keys if key in self.stored}
+
+    def store(self, fingerprints):
+        self.stored.update(fingerprints)
+
+
+@pytest.fixture
+def weca_data(import_weca_module):
+    return import_weca_module("utils.data")
+
+
+@pytest.fixture
+def ChangeCapture(import_weca_module):
+    return import_weca_module("managers.change_capture").ChangeCapture
+
+
+def weca_record(
+    registration_number, route_number="1", licence_number="PH0000001", **fields
+):
+    return {
+        "operatorlicence_istervices": licence_number,
+        "serialnum_ervi": registration_number,
+        "servicenumbers_icespt7a": route_number,
+        "variation_ervi": 0,
+        **fields,
+    }
+
+
+def test_record_key_includes_licence_number(weca_data):
+    assert weca_data.record_key(weca_record("PH0000001/1")) == (
+        "PH0000001",
+        "PH0000001/1",
+        "1",
+        0,
+    )
+    assert weca_data.record_key(
+        weca_record("PH0000001/1", licence_number="PH0000002")
+    ) != weca_data.record_key(weca_record("PH0000001/1"))
+    assert weca_data.record_key({"serialnum_ervi": "PH0000001/1"}) is None
+
+
+def test_filter_changed(ChangeCapture, weca_data):
+    unchanged = weca_record("PH0000001/1")
+    changed = weca_record("PH0000001/2", via="New Street")
+    new = weca_record("PH0000001/3")
+    keyless = {"serialnum_ervi": "PH0000001/4"}
+    fingerprints = FakeFingerprints(
+        {
+            weca_data.record_key(unchanged): weca_data.record_fingerprint(unchanged),
+            weca_data.record_key(changed): "fingerprint of the old record",
+        }
+    )
+    change_capture = ChangeCapture(fingerprints)
+
+    changed_records, pending = change_capture.filter_changed(
+        [unchanged, changed, new, keyless], start_index=500
+    )
+
+    assert changed_records == [changed, new, keyless]
+    # Records are numbered by their position in the report
+    assert [record_number for record_number, _, _ in pending] == ["503", "504", "505"]
+    assert pending[0][1:] == (
+        weca_data.record_key(changed),
+        weca_data.record_fingerprint(changed),
+    )
+    assert pending[2][1] is None
+    assert change_capture.summary() == {
+        "new": 2,
+        "changed": 1,
+        "unchanged": 1,
+        "ingested": 0,
+    }
+
+
+def test_filter_changed_disabled(ChangeCapture, weca_data):
+    record = weca_record("PH0000001/1")
+    fingerprints = FakeFingerprints(
+        {weca_data.record_key(record): weca_data.record_fingerprint(record)}
+    )
+    change_capture = ChangeCapture(fingerprints, enabled=False)
+
+    changed_records, pending = change_capture.filter_changed([record])
+
+    assert changed_records == [record]
+    assert change_capture.summary()["unchanged"] == 1
+
+
+def test_filter_changed_lookup_failure(ChangeCapture):
+    class FailingFingerprints(FakeFingerprints):
+        def fetch(self, keys):
+            raise ConnectionError("Database is unavailable")
+
+    record = weca_record("PH0000001/1")
+    change_capture = ChangeCapture(FailingFingerprints())
+
+    changed_records, _ = change_capture.filter_changed([record])
+
+    assert changed_records == [record]
+    assert change_capture.summary()["new"] == 1
+
+
+def test_filter_changed_reports_duplicates_of_unchanged_records(
+    ChangeCapture, weca_data
+):
+    unchanged = weca_record("PH0000001/1")
+    fingerprints = FakeFingerprints(
+        {weca_data.record_key(unchanged): weca_data.record_fingerprint(unchanged)}
+    )
+    change_capture = ChangeCapture(fingerprints)
+    seen_records = {}
+
+    changed_records, _ = change_capture.filter_changed([unchanged], 0, seen_records)
+    assert changed_records == []
+    assert seen_records == {("PH0000001", 0, "PH0000001/1", "1"): ["2"]}
+
+    # The same record again in a later batch is passed on to be reported as a duplicate
+    changed_records, pending = change_capture.filter_changed(
+        [unchanged], 1, seen_records
+    )
+    assert changed_records == [unchanged]
+    assert [record_number for record_number, _, _ in pending] == ["3"]
+    assert seen_records == {("PH0000001", 0, "PH0000001/1", "1"): ["2"]}
+
+
+def test_store_ingested(ChangeCapture, weca_data):
+    records = [
+        weca_record("PH0000001/1"),
+        weca_record("PH0000001/2"),
+        {"serialnum_ervi": "PH0000001/3"},
+    ]
+    fingerprints = FakeFingerprints()
+    change_capture = ChangeCapture(fingerprints)
+    _, pending = change_capture.filter_changed(records, start_index=1000)
+
+    # Record 1003 was rejected, record 1004 has no key to store
+    change_capture.store_ingested(pending, {"1002", "1004"})
+
+    assert fingerprints.stored == {
+        weca_data.record_key(records[0]): weca_data.record_fingerprint(records[0])
+    }
+    assert change_capture.summary()["ingested"] == 1
+    # The rejected record is compared again on the next run
+    changed_records, _ = change_capture.filter_changed(records, start_index=1000)
+    assert changed_records == records[1:]
@@ -0,0 +1,103 @@
+from unittest.mock import patch
+
+import pytest
+
+from src.weca_client.utils.json_stream import batched, iter_report_data
+
+REPORT = (
+    b'{"fields": [{"name": "serialnum_ervi"}], '
+    b'"data": [{"serialnum_ervi": "PH0000001/1", "variation_ervi": 12345}, '
+    b'{"serialnum_ervi": "PH0000001/\\u00e92", "variation_ervi": -1.5e3}]}'
+)
+RECORDS = [
+    {"serialnum_ervi": "PH0000001/1", "variation_ervi": 12345},
+    {"serialnum_ervi": "PH0000001/é2", "variation_ervi": -1.5e3},
+]
+
+
+def chunked(content, size):
+    return [content[start : start + size] for start in range(0, len(content), size)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, len(REPORT)])
+def test_iter_report_data(chunk_size):
+    fields = []
+
+    records = list(iter_report_data(chunked(REPORT, chunk_size), fields))
+
+    assert records == RECORDS
+    assert fields == [{"name": "serialnum_ervi"}]
+
+
+def test_iter_report_data_chunk_boundary_inside_number():
+    # The number would be parsed as 12 if the next chunk was not read
+    chunks = [b'{"data": [{"variation_ervi": 12', b"345}, 6", b"7]}"]
+
+    assert list(iter_report_data(chunks)) == [{"variation_ervi": 12345}, 67]
+
+
+def test_iter_report_data_chunk_boundary_inside_string():
+    content = '{"data": [{"via": "Café \\"Main\\" Street"}]}'.encode("utf-8")
+    # Splits the two bytes of é and the escaped quote
+    split = content.index("é".encode("utf-8")) + 1
+    chunks = [content[:split], content[split : split + 3], content[split + 3 :]]
+
+    assert list(iter_report_data(chunks)) == [{"via": 'Café "Main" Street'}]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [b'{"data": []}', b'{"fields": [], "data": [ ]}', b"{}", b' { "data" : [\n] } '],
+)
+def test_iter_report_data_empty(content):
+    assert list(iter_report_data(chunked(content, 2))) == []
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"",
+        b"[]",
+        b'{"data": [{"serialnum_ervi": "PH0000001/1"}',
+        b'{"data": [{"serialnum_ervi": "PH0000001/1"} {"serialnum_ervi": "PH0000001/2"}]}',
+        b'{"data": [{"serialnum_ervi": "PH0000001/1"}, {"serialnum_ervi": ',
+        b'{"data": [{"serialnum_ervi": "PH0000001/1"}]',
+    ],
+)
+def test_iter_report_data_malformed(content):
+    with pytest.raises(ValueError):
+        list(iter_report_data(chunked(content, 5)))
+
+
+def test_iter_report_data_returns_records_before_error():
+    records = iter_report_data(
+        [b'{"data": [{"variation_ervi": 1}, {"variation_ervi": ']
+    )
+
+    assert next(records) == {"variation_ervi": 1}
+    with pytest.raises(ValueError):
+        next(records)
+
+
+def test_iter_report_data_value_too_long():
+    read_chunks = []
+
+    def chunks():
+        yield b'{"data": [{"serialnum_ervi": "PH0000001/1"}, {"serialnum_ervi": "'
+        # A string which is never closed, the rest of the stream is not read
+        while True:
+            read_chunks.append(None)
+            yield b"x" * 100
+
+    records = iter_report_data(chunks())
+    with patch("src.weca_client.utils.json_stream.MAX_VALUE_SIZE", 1000):
+        assert next(records) == {"serialnum_ervi": "PH0000001/1"}
+        with pytest.raises(ValueError, match="longer than 1000 characters"):
+            next(records)
+
+    assert len(read_chunks) <= 11
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
@@ -0,0 +1,81 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from src.weca_client.utils.weca_api import WecaClient
+
+
+@pytest.fixture
+def records_manager(import_weca_module):
+    return import_weca_module("managers.records_manager")
+
+
+def test_report_duplicate_records(records_manager):
+    seen_records = {
+        ("PH0000001", 0, "PH0000001/1", "1"): ["2", "1502", "7"],
+        ("PH0000001", 0, "PH0000001/2", "1"): ["3"],
+    }
+
+    with patch.object(records_manager, "delete_registrations") as delete_registrations:
+        duplicated_records = records_manager.report_duplicate_records(
+            seen_records, "weca"
+        )
+
+    # All the records of the key are reported, and the first one is deleted
+    assert duplicated_records == {
+        "records": {
+            "2": [{"": "Duplicate of record 1502, 7"}],
+            "7": [{"": "Duplicate of record 2, 1502"}],
+            "1502": [{"": "Duplicate of record 2, 7"}],
+        },
+        "description": "CSV data structure check",
+    }
+    delete_registrations.assert_called_once_with(
+        {("PH0000001", 0, "PH0000001/1", "1")}, "weca"
+    )
+
+
+def test_report_duplicate_records_without_duplicates(records_manager):
+    with patch.object(records_manager, "delete_registrations") as delete_registrations:
+        duplicated_records = records_manager.report_duplicate_records(
+            {("PH0000001", 0, "PH0000001/1", "1"): ["2"]}, "weca"
+        )
+
+    assert duplicated_records["records"] == {}
+    delete_registrations.assert_not_called()
+
+
+def test_check_duplicate_records_across_batches(records_manager):
+    record = MagicMock(
+        licence_number="PH0000001",
+        variation_number=0,
+        registration_number="PH0000001/1",
+        route_number="1",
+    )
+    seen_records = {("PH0000001", 0, "PH0000001/1", "1"): ["2"]}
+    manager = records_manager.RecordsManager(
+        [], MagicMock(group="weca", name="weca_api"), seen_records=seen_records
+    )
+    records = {"invalid_records": [], "valid_records": {"502": record}}
+
+    manager._check_duplicate_records(records)
+
+    # The duplicate of the earlier batch is put aside until the report is read
+    assert records == {"invalid_records": [], "valid_records": {}}
+    assert seen_records == {("PH0000001", 0, "PH0000001/1", "1"): ["2", "502"]}
+
+
+def test_iter_weca_services_malformed_report():
+    response = MagicMock()
+    response.iter_content.return_value = [
+        b'{"fields": [], "data": [{"serialnum_ervi": "PH0000001/1"}, {"serial'
+    ]
+    records = []
+
+    with patch.object(WecaClient, "_make_request", return_value=response):
+        with pytest.raises(ValueError):
+            for record in WecaClient().iter_weca_services():
+                records.append(record)
+
+    assert records == [{"serialnum_ervi": "PH0000001/1"}]
+    response.close.assert_called_once()
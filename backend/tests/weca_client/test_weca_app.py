@@ -0,0 +1,126 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.weca_client.utils.data import record_fingerprint, record_key
+
+REPORT_SIZE = 5_000
+# The body is written in pieces, it is received across many response chunks
+WRITE_SIZE = 16 * 1024
+
+
+def synthetic_record(n):
+    return {
+        "operatorlicence_istervices": f"PH{n // 10:07d}",
+        "serialnum_ervi": f"PH{n // 10:07d}/{n}",
+        "servicenumbers_icespt7a": str(n % 100),
+        "variation_ervi": n % 3,
+        "description": "Bristol Temple Meads - Cribbs Causeway " * 4,
+    }
+
+
+@pytest.fixture
+def weca_app(import_weca_module):
+    return import_weca_module("app")
+
+
+@pytest.fixture
+def weca_server(weca_app, monkeypatch):
+    """Local stand-in of the WECA report endpoint"""
+    records = [synthetic_record(n) for n in range(REPORT_SIZE)]
+    body = json.dumps(
+        {
+            "fields": [
+                {
+                    "id": "serialnum_ervi",
+                    "name": "serialnum_ervi",
+                    "desc": "Registration Number",
+                    "datatype": "string",
+                }
+            ],
+            "data": records,
+        }
+    ).encode("utf-8")
+    state = {"records": records, "requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            state["requests"] += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            for start in range(0, len(body), WRITE_SIZE):
+                self.wfile.write(body[start : start + WRITE_SIZE])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # The module of WecaClient, as imported by the weca_client app
+    weca_api = weca_app.WecaClient._make_request.__globals__
+    monkeypatch.setitem(
+        weca_api, "WECA_API_URL", f"http://127.0.0.1:{server.server_port}/"
+    )
+    state["batch_size"] = weca_api["WECA_BATCH_SIZE"]
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_lambda_handler_ingests_report_batch_by_batch(
+    weca_app, weca_server, monkeypatch
+):
+    records = weca_server["records"]
+    # The first records were ingested by an earlier run and have not changed
+    unchanged = {
+        record_key(record): record_fingerprint(record) for record in records[:1000]
+    }
+    stored = {}
+    batches = []
+
+    class Fingerprints:
+        def __init__(self, group_name):
+            pass
+
+        def fetch(self, keys):
+            return {key: unchanged[key] for key in keys if key in unchanged}
+
+        def store(self, fingerprints):
+            stored.update(fingerprints)
+
+    class RecordsManager:
+        def __init__(self, csv_data, authenticated_entity, record_numbers, **kwargs):
+            batches.append((list(csv_data), record_numbers))
+            self.ingested_records = set(record_numbers)
+
+        def validation_and_insertion_steps(self):
+            pass
+
+    monkeypatch.setattr(weca_app, "RecordFingerprints", Fingerprints)
+    monkeypatch.setattr(weca_app, "RecordsManager", RecordsManager)
+    monkeypatch.setattr(weca_app, "USER_TYPE", "user")
+
+    summary = weca_app.lambda_handler({}, None)
+
+    assert weca_server["requests"] == 1
+    assert summary == {
+        "new": REPORT_SIZE - 1000,
+        "changed": 0,
+        "unchanged": 1000,
+        "ingested": REPORT_SIZE - 1000,
+        "duplicated": 0,
+    }
+    # Batches made only of unchanged records are not validated
+    batch_size = weca_server["batch_size"]
+    assert all(len(batch) <= batch_size for batch, _ in batches)
+    assert [record for batch, _ in batches for record in batch] == records[1000:]
+    # The records keep their row number in the report
+    assert [number for _, numbers in batches for number in numbers] == [
+        f"{n + 2}" for n in range(1000, REPORT_SIZE)
+    ]
+    assert stored.keys() == {record_key(record) for record in records[1000:]}
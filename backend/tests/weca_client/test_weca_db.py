@@ -0,0 +1,58 @@
+from datetime import datetime
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+Base = declarative_base()
+
+
+class Group(Base):
+    __tablename__ = "pdbrd_group"
+    id = Column(Integer, primary_key=True)
+    licence_status_refreshed_at = Column(DateTime)
+
+
+class Registration(Base):
+    __tablename__ = "pdbrd_registration"
+    id = Column(Integer, primary_key=True)
+    registration_number = Column(String(255))
+    route_number = Column(String(255))
+    group_id = Column(Integer)
+
+
+@pytest.fixture
+def weca_db(import_weca_module):
+    return import_weca_module("utils.db")
+
+
+def test_invalidate_licence_status_summaries(weca_db):
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    models = Mock(PDBRDGroup=Group, PDBRDRegistration=Registration)
+    with Session(engine) as session:
+        for group_id in (1, 2, 3, 4):
+            session.add(Group(id=group_id, licence_status_refreshed_at=datetime.now()))
+        session.add(
+            Registration(registration_number="PD1/1", route_number="1", group_id=2)
+        )
+        session.add(
+            Registration(registration_number="PD1/1", route_number="2", group_id=3)
+        )
+        session.add(
+            Registration(registration_number="PD1/2", route_number="1", group_id=4)
+        )
+        session.commit()
+
+        weca_db.invalidate_licence_status_summaries(
+            session, models, {("PD1/1", "1"), ("PD1/3", "1")}, 1
+        )
+        session.commit()
+
+        refreshed_at = dict(session.query(Group.id, Group.licence_status_refreshed_at))
+    # The WECA group, and the groups with registrations of the same services
+    assert refreshed_at[1] is None
+    assert refreshed_at[2] is None
+    assert refreshed_at[3] is not None
+    assert refreshed_at[4] is not None
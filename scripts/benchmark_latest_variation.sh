@@ -0,0 +1,118 @@
+#!/usr/bin/env bash
+# Compare the latest variation queries of /search and /all-records: the self-join
+# with DISTINCT ON they used to run, the row_number() ranking of
+# latest_variation_query, and the full query without "latest only".
+# The registrations are seeded in a transaction which is rolled back, so run it
+# against a local database only.
+#
+# Usage: POSTGRES_DB=pdbrd_db scripts/benchmark_latest_variation.sh [routes] [variations_per_route]
+set -o errexit
+set -o nounset
+
+ROUTES="${1:-50000}"
+VARIATIONS="${2:-4}"
+PG_EXEC=(psql "host=${POSTGRES_HOST:-localhost} port=${POSTGRES_PORT:-5432} user=${POSTGRES_USER} password=${POSTGRES_PASSWORD} dbname=${POSTGRES_DB} gssencmode=disable"
+    --no-psqlrc --quiet --set ON_ERROR_STOP=1 --set routes="${ROUTES}" --set variations="${VARIATIONS}")
+
+"${PG_EXEC[@]}" <<'SQL'
+BEGIN;
+
+\echo '--- seeding' :routes 'routes with up to' :variations 'variations each'
+INSERT INTO pdbrd_group (local_auth) VALUES ('latest-variation-benchmark') RETURNING id AS group_id \gset
+INSERT INTO otc_operator (operator_name)
+    SELECT 'Benchmark operator ' || o FROM generate_series(1, 100) o;
+INSERT INTO otc_licence (licence_number, licence_status)
+    SELECT 'PB' || lpad(l::text, 7, '0'), 'Valid' FROM generate_series(1, 100) l;
+INSERT INTO pdbrd_registration (
+    otc_licence_id, otc_operator_id, registration_number, route_number, variation_number,
+    application_type, effective_date, group_id
+)
+SELECT l.id, o.id,
+       l.licence_number || '/' || (r / 4), (r % 4)::text, v,
+       (ARRAY['New', 'Change', 'Variation', 'Cancellation'])[1 + (r + v) % 4],
+       current_date - (r % 1000), :group_id
+FROM generate_series(1, :routes) r
+CROSS JOIN LATERAL generate_series(0, r % :variations) v
+JOIN otc_licence l ON l.licence_number = 'PB' || lpad((1 + r % 100)::text, 7, '0')
+JOIN otc_operator o ON o.operator_name = 'Benchmark operator ' || (1 + r % 100);
+ANALYZE pdbrd_registration;
+ANALYZE otc_licence;
+ANALYZE otc_operator;
+
+\echo '=== /all-records: full query'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT r.registration_number, r.route_number, r.variation_number, o.operator_name,
+       l.licence_number, c.requires_attention
+FROM pdbrd_registration r
+JOIN otc_operator o ON r.otc_operator_id = o.id
+JOIN otc_licence l ON r.otc_licence_id = l.id
+LEFT OUTER JOIN bods_data_catalogue c ON c.xml_service_code = r.registration_number
+WHERE r.pdbrd_stage_id IS NULL AND r.group_id = :group_id;
+
+\echo '=== /all-records latestOnly: self-join with DISTINCT ON (before)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT DISTINCT ON (p.registration_number, p.route_number) records.*
+FROM (
+    SELECT r.registration_number, r.route_number, r.variation_number, o.operator_name,
+           l.licence_number, c.requires_attention
+    FROM pdbrd_registration r
+    JOIN otc_operator o ON r.otc_operator_id = o.id
+    JOIN otc_licence l ON r.otc_licence_id = l.id
+    LEFT OUTER JOIN bods_data_catalogue c ON c.xml_service_code = r.registration_number
+    WHERE r.pdbrd_stage_id IS NULL
+) records
+JOIN pdbrd_registration p ON records.registration_number = p.registration_number
+    AND records.route_number = p.route_number
+    AND records.variation_number = p.variation_number
+WHERE p.group_id = :group_id
+ORDER BY p.registration_number, p.route_number, p.variation_number DESC;
+
+\echo '=== /all-records latestOnly: row_number() ranking (after)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT ranked.registration_number, ranked.route_number, ranked.variation_number,
+       ranked.operator_name, ranked.licence_number, ranked.requires_attention
+FROM (
+    SELECT r.registration_number, r.route_number, r.variation_number, o.operator_name,
+           l.licence_number, c.requires_attention,
+           row_number() OVER (PARTITION BY r.registration_number, r.route_number
+                              ORDER BY r.variation_number DESC, r.id) AS variation_rank
+    FROM pdbrd_registration r
+    JOIN otc_operator o ON r.otc_operator_id = o.id
+    JOIN otc_licence l ON r.otc_licence_id = l.id
+    LEFT OUTER JOIN bods_data_catalogue c ON c.xml_service_code = r.registration_number
+    WHERE r.pdbrd_stage_id IS NULL AND r.group_id = :group_id
+) ranked
+WHERE ranked.variation_rank = 1
+ORDER BY ranked.registration_number, ranked.route_number;
+
+\echo '=== /search latestOnly, first page: DISTINCT ON (before)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT DISTINCT ON (r.registration_number, r.route_number)
+       r.registration_number, r.route_number, r.variation_number, o.operator_name, l.licence_number
+FROM pdbrd_registration r
+JOIN otc_operator o ON r.otc_operator_id = o.id
+JOIN otc_licence l ON r.otc_licence_id = l.id
+WHERE r.registration_number LIKE 'PB%'
+ORDER BY r.registration_number, r.route_number, r.variation_number DESC, r.id
+LIMIT 101;
+
+\echo '=== /search latestOnly, first page: row_number() ranking (after)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT ranked.registration_number, ranked.route_number, ranked.variation_number,
+       ranked.operator_name, ranked.licence_number
+FROM (
+    SELECT r.registration_number, r.route_number, r.variation_number, o.operator_name,
+           l.licence_number,
+           row_number() OVER (PARTITION BY r.registration_number, r.route_number
+                              ORDER BY r.variation_number DESC, r.id) AS variation_rank
+    FROM pdbrd_registration r
+    JOIN otc_operator o ON r.otc_operator_id = o.id
+    JOIN otc_licence l ON r.otc_licence_id = l.id
+    WHERE r.registration_number LIKE 'PB%'
+) ranked
+WHERE ranked.variation_rank = 1
+ORDER BY ranked.registration_number, ranked.route_number
+LIMIT 101;
+
+ROLLBACK;
+SQL
@@ -0,0 +1,86 @@
+#!/usr/bin/env bash
+# Compare the plans of the registration read paths without and with the indexes
+# of sql/j.registrationIndexes.sql. The "before" plans are run in a transaction
+# dropping the indexes, which is rolled back, so run it against a local or dev
+# database only.
+#
+# Usage: POSTGRES_DB=pdbrd_db scripts/explain_registration_indexes.sh [group_id] [search_term]
+set -o errexit
+set -o nounset
+
+GROUP_ID="${1:-1}"
+SEARCH_TERM="${2:-PD}"
+PG_EXEC=(psql "host=${POSTGRES_HOST:-localhost} port=${POSTGRES_PORT:-5432} user=${POSTGRES_USER} password=${POSTGRES_PASSWORD} dbname=${POSTGRES_DB} gssencmode=disable"
+    --no-psqlrc --quiet --set ON_ERROR_STOP=1 --set group_id="${GROUP_ID}" --set search="%${SEARCH_TERM}%")
+
+QUERIES=$(cat <<'SQL'
+\echo '--- get_all_records: committed registrations of the group with the data catalogue'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT r.registration_number, r.route_number, r.variation_number,
+       l.licence_number, o.operator_name, c.requires_attention, c.timeliness_status
+FROM pdbrd_registration r
+JOIN otc_operator o ON r.otc_operator_id = o.id
+JOIN otc_licence l ON r.otc_licence_id = l.id
+LEFT OUTER JOIN bods_data_catalogue c ON c.xml_service_code = r.registration_number
+WHERE r.pdbrd_stage_id IS NULL
+  AND r.group_id = :group_id
+  AND r.application_type IN ('New', 'Change', 'Variation')
+  AND r.effective_date <= current_date
+  AND (r.end_date > current_date OR r.end_date IS NULL);
+
+\echo '--- latest variation of each committed registration of the group'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT DISTINCT ON (r.registration_number, r.route_number)
+       r.registration_number, r.route_number, r.variation_number
+FROM pdbrd_registration r
+WHERE r.pdbrd_stage_id IS NULL AND r.group_id = :group_id
+ORDER BY r.registration_number, r.route_number, r.variation_number DESC;
+
+\echo '--- search: LIKE filters'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT r.registration_number, r.route_number, r.variation_number
+FROM pdbrd_registration r
+JOIN otc_operator o ON r.otc_operator_id = o.id
+JOIN otc_licence l ON r.otc_licence_id = l.id
+WHERE r.pdbrd_stage_id IS NULL
+  AND r.group_id = :group_id
+  AND r.registration_number LIKE :'search';
+
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT r.registration_number, r.route_number, r.variation_number
+FROM pdbrd_registration r
+JOIN otc_operator o ON r.otc_operator_id = o.id
+WHERE o.operator_name LIKE :'search';
+
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT r.registration_number, r.route_number, r.variation_number
+FROM pdbrd_registration r
+JOIN otc_licence l ON r.otc_licence_id = l.id
+WHERE l.licence_number LIKE :'search';
+SQL
+)
+
+"${PG_EXEC[@]}" <<SQL
+ANALYZE pdbrd_registration;
+ANALYZE bods_data_catalogue;
+ANALYZE otc_licence;
+ANALYZE otc_operator;
+SQL
+
+echo "==== BEFORE: without the registration indexes ===="
+"${PG_EXEC[@]}" <<SQL
+BEGIN;
+DROP INDEX IF EXISTS idx_bods_data_catalogue_xml_service_code;
+DROP INDEX IF EXISTS idx_pdbrd_registration_committed_latest;
+DROP INDEX IF EXISTS idx_pdbrd_registration_registration_number_trgm;
+DROP INDEX IF EXISTS idx_pdbrd_registration_route_number_trgm;
+DROP INDEX IF EXISTS idx_otc_licence_licence_number_trgm;
+DROP INDEX IF EXISTS idx_otc_operator_operator_name_trgm;
+${QUERIES}
+ROLLBACK;
+SQL
+
+echo "==== AFTER: with the registration indexes ===="
+"${PG_EXEC[@]}" <<SQL
+${QUERIES}
+SQL
@@ -0,0 +1,25 @@
+-- Indexes of the registration read paths, see scripts/explain_registration_indexes.sh
+
+-- Outer join of the registrations on the data catalogue
+CREATE INDEX IF NOT EXISTS idx_bods_data_catalogue_xml_service_code
+    ON bods_data_catalogue (xml_service_code);
+
+-- Latest variation of the committed registrations of a group
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_committed_latest
+    ON pdbrd_registration (group_id, registration_number, route_number, variation_number DESC)
+    WHERE pdbrd_stage_id IS NULL;
+
+-- LIKE '%...%' filters of the search
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_registration_number_trgm
+    ON pdbrd_registration USING GIN (registration_number gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_route_number_trgm
+    ON pdbrd_registration USING GIN (route_number gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_otc_licence_licence_number_trgm
+    ON otc_licence USING GIN (licence_number gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_otc_operator_operator_name_trgm
+    ON otc_operator USING GIN (operator_name gin_trgm_ops);
@@ -0,0 +1,22 @@
+-- Per group summary of the active registrations by licence, read by /view-registrations/status
+CREATE TABLE IF NOT EXISTS pdbrd_licence_status_summary (
+    id SERIAL PRIMARY KEY,
+    group_id INTEGER NOT NULL,
+    licence_number VARCHAR(255),
+    operator_name VARCHAR(255),
+    licence_status VARCHAR(255),
+    requires_attention NUMERIC(5, 2),
+    total_services INTEGER,
+    registrations_not_in_bods INTEGER
+);
+
+SELECT create_constraint_if_not_exists(
+    'pdbrd_licence_status_summary',
+    'fk_licence_status_summary_group',
+    'ALTER TABLE pdbrd_licence_status_summary ADD CONSTRAINT fk_licence_status_summary_group FOREIGN KEY (group_id) REFERENCES pdbrd_group(id) ON DELETE CASCADE;');
+
+CREATE INDEX IF NOT EXISTS idx_pdbrd_licence_status_summary_group
+    ON pdbrd_licence_status_summary (group_id, total_services DESC);
+
+-- When the summary of the group was last computed, NULL when it is stale
+ALTER TABLE pdbrd_group ADD COLUMN IF NOT EXISTS licence_status_refreshed_at TIMESTAMP;
@@ -0,0 +1,4 @@
+-- Ranking of the variations of each registration route by latest_variation_query,
+-- see scripts/benchmark_latest_variation.sh
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_variation_rank
+    ON pdbrd_registration (registration_number, route_number, variation_number DESC, id);
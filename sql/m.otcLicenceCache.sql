@@ -0,0 +1,10 @@
+-- Licences looked up on the OTC API, read before calling the API again.
+-- Licences not found on the OTC API are kept with found = FALSE.
+CREATE TABLE IF NOT EXISTS otc_licence_cache (
+    licence_number VARCHAR(255) PRIMARY KEY,
+    otc_licence_number VARCHAR(255),
+    licence_status VARCHAR(255),
+    operator_name VARCHAR(255),
+    found BOOLEAN NOT NULL,
+    fetched_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,2 @@
+-- Hash of each catalogue row, compared by the incremental refresh of the catalogue
+ALTER TABLE bods_data_catalogue ADD COLUMN IF NOT EXISTS row_hash VARCHAR(64);
@@ -0,0 +1,8 @@
+-- Validators of the catalogue downloaded by the last refresh, sent back as
+-- If-None-Match/If-Modified-Since so an unchanged catalogue is not downloaded
+CREATE TABLE IF NOT EXISTS bods_data_catalogue_source (
+    url VARCHAR(255) PRIMARY KEY,
+    etag VARCHAR(255),
+    last_modified VARCHAR(255),
+    refreshed_at TIMESTAMP NOT NULL
+);
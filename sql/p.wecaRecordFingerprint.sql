@@ -0,0 +1,18 @@
+-- Content fingerprint of each WECA record ingested, records whose fingerprint
+-- has not changed since the last run, and whose registration is still in
+-- pdbrd_registration, are skipped before validation
+CREATE TABLE IF NOT EXISTS weca_record_fingerprint (
+    group_id INTEGER NOT NULL,
+    licence_number VARCHAR(255) NOT NULL,
+    registration_number VARCHAR(255) NOT NULL,
+    route_number VARCHAR(255) NOT NULL,
+    variation_number INTEGER NOT NULL,
+    fingerprint VARCHAR(64) NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (group_id, licence_number, registration_number, route_number, variation_number)
+);
+
+SELECT create_constraint_if_not_exists(
+    'weca_record_fingerprint',
+    'fk_weca_record_fingerprint_group',
+    'ALTER TABLE weca_record_fingerprint ADD CONSTRAINT fk_weca_record_fingerprint_group FOREIGN KEY (group_id) REFERENCES pdbrd_group(id) ON DELETE CASCADE;');
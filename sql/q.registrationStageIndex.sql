@@ -0,0 +1,5 @@
+-- Staged registrations of an upload, committed or discarded by
+-- DBManager.commit_staged_records in a single statement
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_stage
+    ON pdbrd_registration (pdbrd_stage_id)
+    WHERE pdbrd_stage_id IS NOT NULL;
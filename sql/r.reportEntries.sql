@@ -0,0 +1,13 @@
+-- Invalid records of the upload reports, one row per record and category.
+-- pdbrd_report.report only keeps the number of records of each category,
+-- the entries are read page by page by /get-report.
+CREATE TABLE IF NOT EXISTS pdbrd_report_entry (
+    report_id VARCHAR(255) NOT NULL,
+    category VARCHAR(255) NOT NULL,
+    row_number INTEGER NOT NULL,
+    errors JSONB NOT NULL,
+    PRIMARY KEY (report_id, category, row_number)
+);
+
+CREATE INDEX IF NOT EXISTS idx_pdbrd_report_report_id
+    ON pdbrd_report (report_id);
@@ -0,0 +1,3 @@
+-- Last update of a staged process, a process which is not completed and not
+-- updated for STAGE_TIMEOUT is discarded as its upload job is lost
+ALTER TABLE pdbrd_stage ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,9 @@
+-- Cursor of the /search pages, the sort key is coalesced so that NULL keys
+-- are not dropped by the cursor comparison, see DBManager.get_records
+CREATE INDEX IF NOT EXISTS idx_pdbrd_registration_search_cursor
+    ON pdbrd_registration (
+        COALESCE(registration_number, ''),
+        COALESCE(route_number, ''),
+        COALESCE(variation_number, -1),
+        id
+    );